@@ -0,0 +1,249 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `AsyncioCommandLoop`, an alternative to the
+main command loop `ControllerOfLyxAndInterpreters.server_notify_loop` which is
+used when the `use_asyncio_loop` config setting is true.
+
+In the ordinary loop nothing else is serviced while a command runs: key
+presses, the GUI menu and requests to halt all wait until, for example, a
+long-running cell finishes.  Here those are cooperating parts of an asyncio
+event loop:
+
+* The Lyx server output pipe is always read by the event loop.  LFUN replies
+  are handed to the futures of the thread which sent the LFUNs, and NOTIFY
+  events (key presses) are handled as soon as they arrive.
+
+* Commands are put on a queue and run one at a time in a worker thread, since
+  the code which talks to Lyx and to the interpreters is synchronous.  While a
+  command runs, further commands are queued behind it on the controller's
+  `CoalescingCommandQueue`, which merges repeated commands.
+
+* The "cancel running command" command is handled right away in the event
+  loop: it interrupts the interpreter evaluating the current cell, stops any
+  multi-cell evaluation before the next cell, and drops any queued commands.
+
+* The GUI menu, when open, is polled from the event loop.  Popups opened by a
+  command are run in the event loop thread too, since tk is not thread-safe.
+  The event loop waits while a popup is open.
+
+* A Lyx Notebook key pressed during a multi-cell evaluation asks whether to
+  halt it, as in the ordinary loop, rather than queueing its command.
+
+"""
+
+import sys
+import asyncio
+import threading
+import traceback
+import concurrent.futures
+
+from . import gui
+
+gui_poll_time = 0.25 # Time between polling the GUI when it is open, in seconds.
+
+
+class AsyncioCommandLoop:
+    """Run the commands for the keys pressed in Lyx from an asyncio event loop.
+    The `controller` is the `ControllerOfLyxAndInterpreters` instance."""
+
+    def __init__(self, controller):
+        self.controller = controller
+        self.lyx_process = controller.lyx_process
+        self.keymap = controller.keymap
+        self.command_queue = controller.command_queue
+        self.menu_choices = controller.get_menu_choices()
+        self.window = None
+        self.running_key_action = None # The command running in the worker thread.
+
+    def run(self):
+        """Run the event loop until Lyx Notebook exits."""
+        try:
+            asyncio.run(self.main())
+        except KeyboardInterrupt:
+            print("\nLyX Notebook exiting after keyboard interrupt.  Bye.")
+        sys.exit(0)
+
+    async def main(self):
+        """The top-level coroutine of the event loop."""
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.current_thread()
+        self.commands_queued = asyncio.Event() # Set when the command queue is nonempty.
+        self.exit_future = self.loop.create_future()
+
+        # From now on only the event loop reads from the Lyx server.
+        self.lyx_process.server_events_read_elsewhere = True
+        self.server_pipe_fd = self.lyx_process.lyx_server_pipe_out
+        self.loop.add_reader(self.server_pipe_fd, self.read_server_events)
+        gui.gui_thread_caller = self.call_in_loop_thread
+
+        tasks = [asyncio.create_task(self.run_commands()),
+                 asyncio.create_task(self.poll_gui())]
+        try:
+            await self.exit_future
+        finally:
+            for task in tasks:
+                task.cancel()
+            self.loop.remove_reader(self.server_pipe_fd)
+            gui.gui_thread_caller = None
+
+    def exit(self):
+        """Make the event loop exit."""
+        if not self.exit_future.done():
+            self.exit_future.set_result(None)
+
+    #
+    # Reading from the Lyx server.
+    #
+
+    def read_server_events(self):
+        """Called when the server output pipe is readable.  Dispatches the LFUN
+        replies and handles the NOTIFY events."""
+        for event in self.lyx_process.dispatch_available_server_events():
+            self.handle_key(event.data)
+        if self.lyx_process.event_reader.at_eof:
+            # No writer, so the pipe would always be readable; check back later.
+            self.loop.remove_reader(self.server_pipe_fd)
+            self.loop.call_later(gui_poll_time, self.resume_reading_server)
+
+    def resume_reading_server(self):
+        """Start reading the server output pipe again after it hit EOF, unless
+        the pipes are gone."""
+        if not self.lyx_process.lyx_named_pipes_exist():
+            print("LyX server named pipes no longer exist; LyX must have closed.")
+            print("Exiting the LyX Notebook program.")
+            self.exit()
+            return
+        self.lyx_process.event_reader.at_eof = False
+        self.loop.add_reader(self.server_pipe_fd, self.read_server_events)
+
+    #
+    # Handling commands.
+    #
+
+    def handle_key(self, key_pressed):
+        """Handle a key press reported by a NOTIFY event."""
+        if key_pressed in self.keymap:
+            self.handle_key_action(self.keymap[key_pressed])
+
+    def handle_key_action(self, key_action):
+        """Handle a command, from a key press or the GUI menu.  Commands which
+        only affect the loop are done immediately, the rest are queued."""
+        if key_action == "toggle gui":
+            if not self.window:
+                self.window = gui.main_lyxnotebook_gui_window(
+                                                  menu_items_list=self.menu_choices)
+            else:
+                gui.close_menu(self.window)
+                self.window = None
+        elif key_action == "cancel running command":
+            self.cancel()
+        elif key_action == "kill lyx notebook process":
+            self.exit()
+        elif self.running_key_action and self.controller.checking_for_halt:
+            # The key is a request to halt the multi-cell evaluation, which
+            # asks the user between cells; its command is not run.
+            self.controller.halt_key_pressed.set()
+        else:
+            if self.running_key_action:
+                print("Queued user command '{}' behind running command '{}'."
+                      .format(key_action, self.running_key_action))
+            self.command_queue.push(key_action)
+            self.commands_queued.set()
+
+    def cancel(self):
+        """Cancel the running command and drop any queued commands."""
+        for command in self.command_queue.clear():
+            print("Dropped queued user command:", command.key_action)
+        self.commands_queued.clear()
+        if self.running_key_action:
+            print("Cancelling user command:", self.running_key_action)
+            self.controller.request_cancel()
+
+    async def run_commands(self):
+        """Run the queued commands, one at a time, in a worker thread."""
+        while True:
+            await self.commands_queued.wait()
+            command = self.command_queue.pop()
+            if not self.command_queue:
+                self.commands_queued.clear()
+            self.controller.cancel_requested.clear()
+            self.running_key_action = command.key_action
+            try:
+                await self.run_in_worker_thread(self.run_command, command)
+            finally:
+                self.running_key_action = None
+
+    def run_command(self, command):
+        """Run a single `QueuedCommand`; called in the worker thread."""
+        message = "Processing user command: " + command.key_action
+        if command.count > 1:
+            message += " (x{})".format(command.count)
+        self.lyx_process.show_message(message)
+        self.controller.respond_to_key_action(command.key_action, count=command.count)
+
+    def run_in_worker_thread(self, function, *args):
+        """Run `function` in a new daemon thread, returning an asyncio future
+        which is done when it returns.  Exceptions are printed rather than
+        raised, and `SystemExit` makes the event loop exit."""
+        done_future = self.loop.create_future()
+
+        def set_done():
+            if not done_future.done():
+                done_future.set_result(None)
+
+        def worker():
+            try:
+                function(*args)
+            except SystemExit:
+                self.loop.call_soon_threadsafe(self.exit)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                self.loop.call_soon_threadsafe(set_done)
+
+        # A daemon thread, unlike an executor's threads, doesn't block exiting.
+        threading.Thread(target=worker, daemon=True).start()
+        return done_future
+
+    def call_in_loop_thread(self, function):
+        """Call `function` with no arguments in the event loop thread, which
+        owns the GUI, and return its result.  From another thread this waits for
+        the event loop to make the call."""
+        if threading.current_thread() is self.loop_thread:
+            return function()
+        result_future = concurrent.futures.Future()
+
+        def call():
+            try:
+                result_future.set_result(function())
+            except Exception as err:
+                result_future.set_exception(err)
+
+        self.loop.call_soon_threadsafe(call)
+        return result_future.result()
+
+    #
+    # The GUI menu.
+    #
+
+    async def poll_gui(self):
+        """Poll the GUI menu window for selected commands while it is open."""
+        while True:
+            await asyncio.sleep(gui_poll_time)
+            if not self.window:
+                continue
+            choice_str = gui.read_menu_event(self.window, self.menu_choices,
+                                             timeout=0) # Time in ms.
+            if choice_str:
+                if choice_str.rstrip().endswith("toggle gui"):
+                    self.handle_key_action("toggle gui")
+                else:
+                    # Strip off the beginning part which shows the shortcut.
+                    self.handle_key_action(choice_str[5:].strip())
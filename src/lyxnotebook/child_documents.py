@@ -0,0 +1,165 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module gets the cells of a master document together with the cells of
+its child documents, the .lyx files it pulls in with include insets like
+
+    \\begin_inset CommandInset include
+    LatexCommand include
+    filename "chapter1.lyx"
+
+    \\end_inset
+
+Lyx exports only the master buffer, so the children are read from their files
+(relative filenames are relative to the directory of the including file).
+Children can have children of their own.  All the files are first scanned for
+their includes, then the children are parsed in parallel in a process pool with
+`get_all_cell_text_from_lyx_string`.  The child files are read as they are, so
+a truncated one (say, partly saved) is parsed as far as it goes.  The cells are merged into one list in
+document order, with the cells of each child in place of its include inset.
+
+"""
+
+import os
+import re
+import concurrent.futures
+
+from .config_file_processing import config_dict
+from .parse_and_write_lyx_files import (get_all_cell_text_from_lyx_string,
+                                        copy_parsed_cell)
+
+# Matches the line beginning an include inset, with the newline before it.
+include_begin_regex = re.compile(r"\n\\begin_inset CommandInset include\n")
+
+# Matches the filename line of an include inset.
+include_filename_regex = re.compile(r'^filename "([^"\n]*)"[ \t]*$', re.MULTILINE)
+
+
+def find_child_documents(lyx_string, dirname):
+    """Return a list of tuples `(line_number, filename)` for the .lyx files
+    included by the Lyx-format string `lyx_string`, with `line_number` the line
+    of the include inset.  Relative filenames are made absolute using the
+    directory `dirname`."""
+    children = []
+    search_pos = 0
+    line_num = 0
+    while True:
+        match = include_begin_regex.search(lyx_string, search_pos)
+        if not match:
+            break
+        line_num += lyx_string.count("\n", search_pos, match.start() + 1)
+        search_pos = match.start() + 1
+        inset_end = lyx_string.find("\n\\end_inset", search_pos)
+        if inset_end == -1:
+            inset_end = len(lyx_string)
+        filename_match = include_filename_regex.search(lyx_string, search_pos, inset_end)
+        if filename_match and filename_match.group(1).endswith(".lyx"):
+            filename = os.path.join(dirname, filename_match.group(1))
+            children.append((line_num, os.path.realpath(filename)))
+    return children
+
+
+def get_all_cell_text_with_child_documents(lyx_string, dirname, magic_cookie_string,
+                                           max_workers=None, **kwargs):
+    """Return the list of the cells of the Lyx-format master document string
+    `lyx_string` merged with the cells of all its child documents, where
+    `dirname` is the directory of the master document.  The keyword arguments
+    `code_language`, `init` and `standard` are passed on to the parsing
+    functions (the list never has the text between the cells).  When there is
+    more than one child document they are parsed in a process pool of
+    `max_workers` processes (by default the number of CPUs)."""
+    master_cells = get_all_cell_text_from_lyx_string(lyx_string, magic_cookie_string,
+                                                     **kwargs)
+    master_includes = find_child_documents(lyx_string, dirname)
+    if not master_includes:
+        return master_cells
+
+    # Find all the descendants, reading each file once.
+    includes_by_file = {None: master_includes} # The master is `None`.
+    child_strings = {}
+    unread_filenames = [filename for line_num, filename in master_includes]
+    while unread_filenames:
+        filename = unread_filenames.pop()
+        if filename in includes_by_file:
+            continue
+        try:
+            with open(filename) as child_file:
+                child_string = child_file.read()
+        except OSError as e:
+            print("Warning: could not read the child document {}:\n   {}"
+                  .format(filename, e))
+            includes_by_file[filename] = []
+            continue
+        child_strings[filename] = child_string
+        includes = find_child_documents(child_string, os.path.dirname(filename))
+        includes_by_file[filename] = includes
+        unread_filenames.extend(filename for line_num, filename in includes)
+
+    cells_by_file = parse_child_documents(child_strings, magic_cookie_string,
+                                          max_workers, **kwargs)
+    cells_by_file[None] = master_cells
+    return merge_child_document_cells(None, cells_by_file, includes_by_file)
+
+
+def parse_child_documents(child_strings, magic_cookie_string, max_workers=None,
+                          **kwargs):
+    """Parse the Lyx-format strings in the dict `child_strings`, which maps
+    the filenames to their contents, returning a dict mapping each filename to
+    its cell list.  More than one document is parsed in a process pool; they
+    are parsed one after another if the pool can't be started."""
+    filenames = list(child_strings)
+    if len(filenames) > 1:
+        try:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers,
+                            initializer=config_dict.update,
+                            initargs=(dict(config_dict),)) as executor:
+                futures = [executor.submit(get_all_cell_text_from_lyx_string,
+                                   child_strings[filename], magic_cookie_string, **kwargs)
+                           for filename in filenames]
+                return {filename: future.result()
+                        for filename, future in zip(filenames, futures)}
+        except (OSError, concurrent.futures.BrokenExecutor) as e:
+            print("Warning: could not parse the child documents in parallel,"
+                  " parsing them one at a time:\n   {}".format(e))
+    return {filename: get_all_cell_text_from_lyx_string(child_strings[filename],
+                                                        magic_cookie_string, **kwargs)
+            for filename in filenames}
+
+
+def merge_child_document_cells(filename, cells_by_file, includes_by_file,
+                               ancestors=(), used=None):
+    """Return the cells of the document `filename` with the cells of each of
+    its children put in place of the include inset, recursively.  A document
+    which includes one of its own ancestors has that include skipped.  The
+    cells of a document included more than once are copied."""
+    if used is None:
+        used = set() # The documents whose cells are already in the list.
+    cells = cells_by_file.get(filename, [])
+    if filename in used:
+        cells = [copy_parsed_cell(cell) for cell in cells]
+    used.add(filename)
+    ancestors = ancestors + (filename,)
+
+    merged_cells = []
+    cell_iter = iter(cells)
+    next_cell = next(cell_iter, None)
+    for line_num, child_filename in includes_by_file.get(filename, []):
+        while next_cell is not None and next_cell.starting_line_number < line_num:
+            merged_cells.append(next_cell)
+            next_cell = next(cell_iter, None)
+        if child_filename in ancestors:
+            print("Warning: skipping the include of {} inside itself."
+                  .format(child_filename))
+            continue
+        merged_cells += merge_child_document_cells(child_filename, cells_by_file,
+                                                   includes_by_file, ancestors, used)
+    if next_cell is not None:
+        merged_cells.append(next_cell)
+        merged_cells.extend(cell_iter)
+    return merged_cells
@@ -0,0 +1,142 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `CoalescingCommandQueue`, which holds the user
+commands (key actions) waiting to be run while another command runs.
+
+Keys pressed while a slow command runs, such as several presses of F4 while a
+cell is being evaluated, pile up.  Running every one of them would redo the same
+work, so when a command is queued it is merged with the command queued just
+before it where that gives the same result:
+
+* Repeated goto commands become one entry with a count, so a burst of presses of
+  "goto next cell" moves the cursor the same number of cells in one command.
+
+* Repeated commands whose second run would only redo the first, like
+  "evaluate current cell" twice with no cursor movement in between, collapse
+  to one.
+
+* Commands whose effect is replaced by a later one are dropped, for example
+  "open all cells" followed by "close all cells".
+
+Only the most recently queued entry is merged with, since any other command
+in between (a goto, say) could change what a command applies to.
+
+"""
+
+import collections
+
+# Commands which can be repeated with a count rather than by queueing them again.
+counted_commands = {
+        "goto next any cell",
+        "goto prev any cell",
+        "goto next code cell",
+        "goto prev code cell",
+        "goto next init cell",
+        "goto prev init cell",
+        "goto next standard cell",
+        "goto prev standard cell",
+        }
+
+# Commands where running twice in a row is the same as running once.
+idempotent_commands = {
+        "evaluate current cell",
+        "evaluate all code cells",
+        "evaluate all init cells",
+        "evaluate all standard cells",
+        "open all cells",
+        "close all cells",
+        "open all output cells",
+        "close all output cells",
+        "write all code cells to files",
+        "reinitialize current interpreter",
+        "reinitialize all interpreters for buffer",
+        "reinitialize all interpreters for all buffers",
+        "prompt echo on",
+        "prompt echo off",
+        }
+
+# Map each command to the set of commands it supersedes when queued right
+# after them.  (Each idempotent command also supersedes itself.)
+superseded_commands = {
+        "open all cells": {"close all cells", "open all output cells",
+                           "close all output cells"},
+        "close all cells": {"open all cells", "open all output cells",
+                            "close all output cells"},
+        "open all output cells": {"close all output cells"},
+        "close all output cells": {"open all output cells"},
+        "evaluate all code cells": {"evaluate all init cells",
+                                    "evaluate all standard cells"},
+        "evaluate all code cells after reinit": {"evaluate all code cells",
+                                    "evaluate all init cells",
+                                    "evaluate all standard cells",
+                                    "reinitialize all interpreters for buffer",
+                                    "reinitialize current interpreter"},
+        "reinitialize all interpreters for all buffers": {
+                                    "reinitialize all interpreters for buffer",
+                                    "reinitialize current interpreter"},
+        "prompt echo on": {"prompt echo off", "toggle prompt echo"},
+        "prompt echo off": {"prompt echo on", "toggle prompt echo"},
+        }
+
+
+class QueuedCommand:
+    """A command in the queue, with the number of times to run it."""
+
+    def __init__(self, key_action, count=1):
+        self.key_action = key_action
+        self.count = count
+
+    def __repr__(self):
+        return "QueuedCommand({!r}, {})".format(self.key_action, self.count)
+
+
+class CoalescingCommandQueue:
+    """A first-in first-out queue of commands which merges each new command
+    with the last one queued where possible.  Counts of the commands merged
+    away are kept in `num_merged`, keyed by the command."""
+
+    def __init__(self):
+        self.commands = collections.deque()
+        self.num_merged = collections.Counter()
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __bool__(self):
+        return bool(self.commands)
+
+    def push(self, key_action):
+        """Queue the command `key_action`, merging it with the commands before
+        it if possible."""
+        commands = self.commands
+        if commands and commands[-1].key_action == key_action:
+            if key_action in counted_commands:
+                commands[-1].count += 1
+                self.num_merged[key_action] += 1
+                return
+            if key_action in idempotent_commands:
+                self.num_merged[key_action] += 1
+                return
+
+        # Drop the queued commands which this one makes pointless.
+        superseded = superseded_commands.get(key_action, ())
+        while commands and commands[-1].key_action in superseded:
+            self.num_merged[commands.pop().key_action] += 1
+        commands.append(QueuedCommand(key_action))
+
+    def pop(self):
+        """Remove and return the oldest `QueuedCommand`."""
+        return self.commands.popleft()
+
+    def clear(self):
+        """Drop all the queued commands, returning them in a list."""
+        dropped = list(self.commands)
+        self.commands.clear()
+        return dropped
@@ -44,6 +44,22 @@ def to_bool(cfg_value):
                      " a form such as 0/1, true/false, yes/no."""
                      .format(cfg_value))
 
+# Default values for settings which were added to the config file later, so
+# that config files written by older installs still work.  The values are in
+# the same string form as in the config file.
+later_setting_defaults = {
+    "lfun_timing_report_file": "",
+    "use_asyncio_loop": "false",
+    "lyx_server_write_timeout_secs": "30",
+    "export_to_session_directory": "true",
+    "include_child_documents": "false",
+    "single_pass_evaluate_all": "true",
+    "stream_output_to_lyx": "false",
+    "stream_output_interval_secs": "2",
+    "stream_output_every_lines": "0",
+    "stream_output_min_interval_ms": "500",
+    }
+
 def initialize_config_data(lyx_user_dir):
     """Initialize the data dict `config_dict` from the config file at
     the path `config_file_path`.  Flattened into a single dict with
@@ -67,6 +83,9 @@ def initialize_config_data(lyx_user_dir):
         subdict = dict(config_parser[section])
         config_dict.update(subdict)
 
+    for key, value in later_setting_defaults.items():
+        config_dict.setdefault(key, value)
+
     for key, value in config_dict.items():
         config_dict[key] = value.strip("'")
         config_dict[key] = value.strip('"')
@@ -79,6 +98,11 @@ def initialize_config_data(lyx_user_dir):
         "has_editable_insets_noeditor_mod",
         "has_editable_insets",
         "gui_window_always_on_top",
+        "use_asyncio_loop",
+        "export_to_session_directory",
+        "include_child_documents",
+        "single_pass_evaluate_all",
+        "stream_output_to_lyx",
         ]
 
     for setting in bool_settings:
@@ -87,6 +111,10 @@ def initialize_config_data(lyx_user_dir):
     int_settings = [
         "max_lines_in_output_cell",
         "num_backup_buffer_copies",
+        "lyx_server_write_timeout_secs",
+        "stream_output_interval_secs",
+        "stream_output_every_lines",
+        "stream_output_min_interval_ms",
         ]
 
     for setting in int_settings:
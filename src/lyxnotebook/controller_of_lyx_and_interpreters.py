@@ -28,11 +28,15 @@ back, and then pushes the results to Lyx.
 import sys
 import os
 import time
+import atexit
+import threading
 
 from . import gui
 from .config_file_processing import config_dict
-from .lyx_server_API_wrapper import InteractWithLyxCells
+from .lyx_server_API_wrapper import InteractWithLyxCells, LyxServerError
 from . import keymap # The current mapping of keys to Lyx Notebook functions.
+from .command_queue import CoalescingCommandQueue
+from .output_streaming import OutputStreamer
 from .parse_and_write_lyx_files import write_lyx_file_from_cell_list
 from .interpreter_processes import InterpreterProcess, InterpreterProcessCollection
 
@@ -50,6 +54,19 @@ class ControllerOfLyxAndInterpreters:
         self.no_echo = config_dict["no_echo"]
         self.buffer_replace_on_batch_eval = config_dict["buffer_replace_on_batch_eval"]
 
+        # Commands for keys pressed while another command was running.
+        self.command_queue = CoalescingCommandQueue()
+        self.keymap = dict(keymap.all_commands_and_keymap)
+
+        # Set when the user asks to cancel the running command (asyncio loop only).
+        self.cancel_requested = threading.Event()
+        self.running_interpreter_process = None # Interpreter evaluating a cell, if any.
+
+        # Whether a multi-cell evaluation is checking for halt requests between
+        # cells.  In the asyncio loop a key pressed meanwhile sets the event.
+        self.checking_for_halt = False
+        self.halt_key_pressed = threading.Event()
+
         # Set up interactions with Lyx.
         self.clientname = clientname
         self.lyx_process = InteractWithLyxCells(clientname)
@@ -59,20 +76,20 @@ class ControllerOfLyxAndInterpreters:
             self.lyx_process.server_get_filename()) # buffer name is file name
         self.all_interps.print_start_message()
 
+        # Write the LFUN timing report on exit if a report file is set.
+        lfun_timing_report_file = config_dict["lfun_timing_report_file"]
+        if lfun_timing_report_file:
+            atexit.register(self.lyx_process.lfun_timing_stats.write_report_file,
+                            os.path.abspath(os.path.expanduser(lfun_timing_report_file)))
+
         # Display a startup notification message in Lyx.
         message = "LyX Notebook is now running..."
         self.lyx_process.show_message(message)
         #self.display_popup_message(message=message, text=startMsg, seconds=3)
 
-    def server_notify_loop(self):
-        """This is the main command/event loop, getting commands from Lyx and executing
-        them."""
-        # Get a dict mapping keys to commands/actions.
-        sleep_time = 0.25 # Time to sleep between polling, in seconds.
-        self.keymap = dict(keymap.all_commands_and_keymap)
-        window = None
-
-        # Create the menu list of choices.
+    def get_menu_choices(self):
+        """Return the list of choices for the GUI menu, each a command prefixed by
+        its (abbreviated) key in a five-character column."""
         menu_choices = []
         for key, command in keymap.all_commands_and_keymap:
             if key is not None:
@@ -81,17 +98,30 @@ class ControllerOfLyxAndInterpreters:
             else:
                 key = " "*5
             menu_choices.append(key + " " + command)
+        return menu_choices
+
+    def server_notify_loop(self):
+        """This is the main command/event loop, getting commands from Lyx and executing
+        them.  If the `use_asyncio_loop` setting is true then the asyncio version of
+        the loop in `asyncio_command_loop` is run instead."""
+        if config_dict["use_asyncio_loop"]:
+            from .asyncio_command_loop import AsyncioCommandLoop
+            AsyncioCommandLoop(self).run()
+            return
+
+        gui_poll_time = 0.25 # Time between polling the GUI when it is open, in seconds.
+        window = None
+
+        # Create the menu list of choices.
+        menu_choices = self.get_menu_choices()
 
         while True:
             # Wait for a bound key in Lyx to be pressed, and get it when it is.
-            parsed_list = self.lyx_process.get_server_event(info=False, error=False)
-            key_pressed = parsed_list[1].rstrip("\n") if parsed_list else None
+            event = self.lyx_process.get_server_event(info=False, error=False)
+            key_pressed = event.data if event else None
 
             if key_pressed and key_pressed in self.keymap:
 
-                # Eat any buffered events (notify or otherwise): avoid annoying user.
-                self.lyx_process.get_server_event(info=False, error=False, notify=False)
-
                 # Look up the action for the key.
                 key_action = self.keymap[key_pressed]
 
@@ -105,8 +135,10 @@ class ControllerOfLyxAndInterpreters:
                         window = None
                         continue
 
-                self.lyx_process.show_message("Processing user command: " + key_action)
-                self.respond_to_key_action(key_action)
+                # Queue the command along with any other keys already pressed,
+                # merging repeats, and run the queue.
+                self.command_queue.push(key_action)
+                self.run_queued_commands()
 
             if window:
                 choice_str = gui.read_menu_event(window, menu_choices,
@@ -120,13 +152,70 @@ class ControllerOfLyxAndInterpreters:
                     # Strip off the beginning part which shows the shortcut.
                     key_action = choice_str[5:].strip()
 
-                    self.respond_to_key_action(key_action)
+                    self.command_queue.push(key_action)
+                    self.run_queued_commands()
+
+            # Sleep until Lyx sends something (or, with the GUI open, until it
+            # is time to poll the GUI again).
+            try:
+                self.lyx_process.wait_for_server_readable(
+                                     timeout=gui_poll_time if window else None)
+            except KeyboardInterrupt:
+                print("\nLyX Notebook exiting after keyboard interrupt.  Bye.")
+                sys.exit(0)
+
+    def queue_pending_key_actions(self):
+        """Put the commands for the keys pressed so far, but not yet handled, on
+        the command queue.  These are the NOTIFY events ignored while waiting
+        for LFUN replies and those still unread from the Lyx server."""
+        ignored_events = self.lyx_process.ignored_notify_events
+        self.lyx_process.get_server_event(info=False, error=False, notify=False)
+        while ignored_events:
+            key_action = self.keymap.get(ignored_events.popleft().data)
+            if key_action and key_action != "toggle gui":
+                self.command_queue.push(key_action)
+        self.lyx_process.ignored_server_notify_event = False
 
-            time.sleep(sleep_time)
+    def run_queued_commands(self):
+        """Run the commands on the command queue until it is empty, queueing
+        the keys pressed during each command before running the next one."""
+        self.queue_pending_key_actions()
+        while self.command_queue:
+            command = self.command_queue.pop()
+            message = "Processing user command: " + command.key_action
+            if command.count > 1:
+                message += " (x{})".format(command.count)
+            self.lyx_process.show_message(message)
+            self.respond_to_key_action(command.key_action, count=command.count)
+            self.queue_pending_key_actions()
 
-    def respond_to_key_action(self, key_action):
+    def respond_to_key_action(self, key_action, count=1):
         """Perform the appropriate action for a key bound to Lyx Notebook pressed in
-        the running Lyx."""
+        the running Lyx.  Replies to simple queries like the buffer filename
+        are cached by `lyx_process` for the duration of the action.  The LFUNs
+        sent are timed and recorded under the key action.  The goto commands
+        move `count` cells, for repeated key presses merged by the command
+        queue; other commands ignore it."""
+        self.lyx_process.begin_reply_cache()
+        self.lyx_process.current_key_action = key_action
+        start_time = time.perf_counter()
+        try:
+            self.dispatch_key_action(key_action, count)
+        except LyxServerError as err:
+            # The LFUNs and their replies may be out of step now, so give up.
+            print("\nError in communicating with the LyX server:\n   {}".format(err))
+            print("Exiting the LyX Notebook program.")
+            sys.exit(1)
+        finally:
+            self.checking_for_halt = False
+            self.lyx_process.end_reply_cache()
+            self.lyx_process.current_key_action = "(no key action)"
+            self.lyx_process.lfun_timing_stats.record_key_action(key_action,
+                                                 time.perf_counter() - start_time)
+
+    def dispatch_key_action(self, key_action, count=1):
+        """Run the code for the command `key_action`.  Called from
+        `respond_to_key_action`."""
         # ====================================================================
         # Handle the general key actions, including commands set from submenu.
         # ====================================================================
@@ -136,37 +225,29 @@ class ControllerOfLyxAndInterpreters:
         #
 
         if key_action == "goto next any cell":
-            self.lyx_process.open_all_cells() # gotoNextCell() needs open cells for now
-            self.lyx_process.goto_next_cell()
+            self.goto_cell(True, count)
             # self.lyx_process.goto_next_cell2() # alternate implementation, experimental
 
         elif key_action == "goto prev any cell":
-            self.lyx_process.open_all_cells() # gotoPrevCell() needs open cells for now
-            self.lyx_process.goto_prev_cell()
+            self.goto_cell(False, count)
 
         elif key_action == "goto next code cell":
-            self.lyx_process.open_all_cells() # gotoNextCell() needs open cells for now
-            self.lyx_process.goto_next_cell(output=False)
+            self.goto_cell(True, count, output=False)
 
         elif key_action == "goto prev code cell":
-            self.lyx_process.open_all_cells() # gotoPrevCell() needs open cells for now
-            self.lyx_process.goto_prev_cell(output=False)
+            self.goto_cell(False, count, output=False)
 
         elif key_action == "goto next init cell":
-            self.lyx_process.open_all_cells() # gotoNextCell() needs open cells for now
-            self.lyx_process.goto_next_cell(standard=False, output=False)
+            self.goto_cell(True, count, standard=False, output=False)
 
         elif key_action == "goto prev init cell":
-            self.lyx_process.open_all_cells() # gotoPrevCell() needs open cells for now
-            self.lyx_process.goto_prev_cell(standard=False, output=False)
+            self.goto_cell(False, count, standard=False, output=False)
 
         elif key_action == "goto next standard cell":
-            self.lyx_process.open_all_cells() # gotoNextCell() needs open cells for now
-            self.lyx_process.goto_next_cell(init=False, output=False)
+            self.goto_cell(True, count, init=False, output=False)
 
         elif key_action == "goto prev standard cell":
-            self.lyx_process.open_all_cells() # gotoPrevCell() needs open cells for now
-            self.lyx_process.goto_prev_cell(init=False, output=False)
+            self.goto_cell(False, count, init=False, output=False)
 
         #
         # Ordinary cell-evaluate commands, done explicitly in Lyx.
@@ -303,9 +384,20 @@ class ControllerOfLyxAndInterpreters:
             self.lyx_process.insert_most_recent_graphic_as_inset()
             self.lyx_process.show_message("inserted the most recent graphic file")
 
+        elif key_action == "print lfun timing report":
+            print(self.lyx_process.lfun_timing_stats.report_string())
+            self.lyx_process.show_message("LFUN timing report was printed to the terminal")
+
+        elif key_action == "reset lfun timing report":
+            self.lyx_process.lfun_timing_stats.reset()
+            self.lyx_process.show_message("LFUN timing data was reset")
+
         elif key_action == "kill lyx notebook process":
             sys.exit(0)
 
+        elif key_action == "cancel running command":
+            pass # Only meaningful in the asyncio loop, which handles it itself.
+
         elif key_action == "prompt echo on":
             self.no_echo = False
 
@@ -340,6 +432,27 @@ class ControllerOfLyxAndInterpreters:
         else:
             pass # ignore command from server-notify if it is not recognized
 
+    def goto_cell(self, forward, count=1, **kwargs):
+        """Move the cursor `count` cells forward or back.  The keyword arguments
+        select the cell types, as for `goto_next_cell` and `goto_prev_cell`."""
+        self.lyx_process.open_all_cells() # gotoNextCell() needs open cells for now
+        if forward:
+            goto = self.lyx_process.goto_next_cell
+        else:
+            goto = self.lyx_process.goto_prev_cell
+        for i in range(count):
+            goto(**kwargs)
+
+    def request_cancel(self):
+        """Ask the running command to stop as soon as it can.  Called from the
+        asyncio loop while the command runs in another thread.  The interpreter
+        evaluating a cell, if any, is interrupted, and multi-cell evaluations
+        stop before the next cell."""
+        self.cancel_requested.set()
+        interpreter_process = self.running_interpreter_process
+        if interpreter_process:
+            interpreter_process.external_interp.interrupt()
+
     def reset_interpreters_for_buffer(self, buffer_name=""):
         """Reset all the interpreters for the buffer, starting completely new processes
         for them.  If buffer_name is empty the current buffer is used."""
@@ -355,27 +468,124 @@ class ControllerOfLyxAndInterpreters:
     def evaluate_all_code_cells(self, init=True, standard=True):
         """Evaluate all cells.  Quits evaluation between cells if any Lyx Notebook
         command key is pressed (any key bound to server-notify).  The flags can
-        be used to only evaluate certain types of cells."""
-
-        # First set up code to check between cell evals whether user wants to halt.
+        be used to only evaluate certain types of cells.  Uses
+        `evaluate_all_code_cells_single_pass` unless the config setting
+        `single_pass_evaluate_all` is false."""
+        if config_dict["single_pass_evaluate_all"]:
+            self.evaluate_all_code_cells_single_pass(init=init, standard=standard)
+        else:
+            self.evaluate_all_code_cells_stepwise(init=init, standard=standard)
 
+    def start_checking_for_halt(self):
+        """Set up to check between cell evaluations, with
+        `check_for_ignored_server_notify`, whether the user wants to halt."""
         # Initialize the relevant flag in the lyxProcess class.
         self.lyx_process.ignored_server_notify_event = False
         # Eat any server events from Lyx (after the NOTIFY command to do the eval).
         self.lyx_process.get_server_event(info=False, error=False, notify=False)
+        self.lyx_process.ignored_server_notify_event = False
+        self.lyx_process.ignored_notify_events.clear()
+        self.halt_key_pressed.clear()
+        self.checking_for_halt = True
+
+    def check_for_ignored_server_notify(self):
+        """Return True if a server-notify was ignored and user wants to quit."""
+        if self.cancel_requested.is_set(): # Cancelled from the asyncio loop.
+            return True
+        msg = "Halt multi-cell evaluation at the current point?"
+        if self.lyx_process.server_events_read_elsewhere:
+            # The asyncio loop reads the key presses, and sets the event instead.
+            if not self.halt_key_pressed.is_set():
+                return False
+            self.halt_key_pressed.clear()
+            return gui.yesno_popup(msg)
+        # Eat all events between cell evals, and check if NOTIFY was ignored.
+        self.lyx_process.get_server_event(info=False, error=False, notify=False)
+        if self.lyx_process.ignored_server_notify_event:
+            # The key press was to halt, so don't also run its command.
+            self.lyx_process.ignored_notify_events.clear()
+            reply = gui.yesno_popup(msg)
+            if reply:
+                return True
+            self.lyx_process.ignored_server_notify_event = False
+        return False
+
+    def evaluate_all_code_cells_single_pass(self, init=True, standard=True):
+        """Evaluate all cells, like `evaluate_all_code_cells_stepwise`, but
+        with the buffer exported and parsed only once.  Each code cell is
+        evaluated from the parsed list, and then all the outputs are written
+        back to Lyx by `write_back_cell_outputs` in one pass through the buffer.
+        Evaluation still halts between cells when a Lyx Notebook key is
+        pressed; the outputs of the cells evaluated so far are written back.
+        Empty cells are skipped, as `evaluate_lyx_cell` skips them."""
+        self.start_checking_for_halt()
+
+        # Take the snapshot of the buffer and print a nice message.
+        code_cells = self.lyx_process.get_all_cell_text(init=init, standard=standard)
+        num_init_cells = sum(1 for cell in code_cells if cell.basic_type == "Init")
+        num_standard_cells = len(code_cells) - num_init_cells
+        print("There are", num_init_cells+num_standard_cells, "code cells:",
+              num_standard_cells, "Standard cells and", num_init_cells, "Init cells.")
+        if init and standard: print("Evaluating all the code cells.")
+        elif init: print("Evaluating all the Init cells only.")
+        elif standard: print("Evaluating all the Standard cells only.")
 
-        # Define a local function to check and query the user if a NOTIFY was ignored.
-        def check_for_ignored_server_notify():
-            """Return True if a server-notify was ignored and user wants to quit."""
-            # Eat all events between cell evals, and check if NOTIFY was ignored.
-            self.lyx_process.get_server_event(info=False, error=False, notify=False)
-            if self.lyx_process.ignored_server_notify_event:
-                msg = "Halt multi-cell evaluation at the current point?"
-                reply = gui.yesno_popup(msg)
-                if reply:
-                    return True
-                self.lyx_process.ignored_server_notify_event = False
-            return False
+        # Evaluate the Init cells and then the Standard cells.
+        halted = False
+        for basic_type in ["Init", "Standard"]:
+            cell_number = 0
+            for cell in code_cells:
+                if cell.basic_type != basic_type:
+                    continue
+                cell_number += 1
+                if self.check_for_ignored_server_notify():
+                    print("Halting multi-cell evaluation before", basic_type, "cell",
+                          cell_number, "(a key bound to\nserver-notify was pressed).")
+                    halted = True
+                    break
+                if cell.is_empty:
+                    continue
+                self.evaluate_code_in_cell_class(self.wrap_long_lines(cell))
+            if halted:
+                break
+
+        self.write_back_cell_outputs(code_cells, init=init, standard=standard)
+        if not halted:
+            print("Finished multi-cell evaluation.")
+
+    def write_back_cell_outputs(self, code_cells, init=True, standard=True):
+        """Write the `evaluation_output` of each cell in `code_cells` to its
+        output cell in Lyx (creating the output cell if there isn't one).  The
+        `code_cells` list must be all the code cells of the buffer of the types
+        selected by the flags, in document order, as parsed from the snapshot
+        which also tells what follows each one.  The cursor goes from each code
+        cell to the next; empty cells, cells with no `evaluation_output`, and
+        cells whose output cell already holds it are skipped."""
+        changed = {i for i, cell in enumerate(code_cells)
+                   if cell.evaluation_output is not None and not cell.is_empty
+                       and not cell.output_matches(cell.evaluation_output)}
+        if not changed:
+            return
+        self.lyx_process.goto_buffer_begin()
+        self.lyx_process.open_all_cells(output=False, init=init, standard=standard)
+        for i, cell in enumerate(code_cells[:max(changed)+1]):
+            self.lyx_process.goto_next_cell(output=False, init=init, standard=standard)
+            if i not in changed:
+                continue
+            self.lyx_process.replace_current_output_cell_text(cell.evaluation_output,
+                              assert_inside_cell=True, inset_specifier=cell.language,
+                              code_cell=cell)
+
+    def evaluate_all_code_cells_stepwise(self, init=True, standard=True):
+        """Evaluate all cells by moving the cursor to each code cell in Lyx and
+        evaluating it as the current cell, which gets the cell text from Lyx
+        and writes its output before moving on.  Quits evaluation between cells
+        if any Lyx Notebook command key is pressed (any key bound to
+        server-notify).  The flags can be used to only evaluate certain types
+        of cells."""
+
+        # First set up code to check between cell evals whether user wants to halt.
+        self.start_checking_for_halt()
 
         # Now get cell count data and print a nice message.
         num_init_cells, num_standard_cells, num_output_cells = \
@@ -392,7 +602,7 @@ class ControllerOfLyxAndInterpreters:
                 self.lyx_process.goto_buffer_begin()
                 self.lyx_process.open_all_cells(output=False, standard=False)
             for i in range(num_init_cells):
-                user_wants_to_halt = check_for_ignored_server_notify()
+                user_wants_to_halt = self.check_for_ignored_server_notify()
                 if user_wants_to_halt:
                     print("Halting multi-cell evaluation before Init cell", i+1,
                           "(a key bound to\nserver-notify was pressed).")
@@ -404,7 +614,7 @@ class ControllerOfLyxAndInterpreters:
                 self.lyx_process.goto_buffer_begin()
                 self.lyx_process.open_all_cells(output=False, init=False)
             for i in range(num_standard_cells):
-                user_wants_to_halt = check_for_ignored_server_notify()
+                user_wants_to_halt = self.check_for_ignored_server_notify()
                 if user_wants_to_halt:
                     print("Halting multi-cell evaluation before Standard cell", i+1,
                           "(a key bound to\nserver-notify was pressed).")
@@ -471,6 +681,8 @@ class ControllerOfLyxAndInterpreters:
             for cell in cell_list:
                 basic_type, inset_spec = cell.get_cell_type()
                 if basic_type == "Init":
+                    if self.cancel_requested.is_set():
+                        return cell_list
                     num += 1
                     if messages:
                         self.lyx_process.show_message(msg % (basic_type, num, inset_spec))
@@ -482,6 +694,8 @@ class ControllerOfLyxAndInterpreters:
             for cell in cell_list:
                 basic_type, inset_spec = cell.get_cell_type()
                 if basic_type == "Standard":
+                    if self.cancel_requested.is_set():
+                        return cell_list
                     num += 1
                     if messages:
                         self.lyx_process.show_message(msg % (basic_type, num, inset_spec))
@@ -495,7 +709,8 @@ class ControllerOfLyxAndInterpreters:
         not inside a code cell or in an empty cell.
 
         Setting `rewrite_code_cells` false can be a little more efficient, but in case
-        of bugs it gives better diagnostic information."""
+        of bugs it gives better diagnostic information.  Even when it is true the
+        code is only rewritten if processing it changed the text."""
 
         # Get the code text from the current cell.
         code_cell_text = self.lyx_process.get_current_cell_text()
@@ -512,10 +727,24 @@ class ControllerOfLyxAndInterpreters:
         # with listings).  Currently does nothing.  Can do the same with output
         # text below, but not currently done.  Could also highlight if that
         # would display in inset and be removable for later evals.
+        extracted_code_lines = list(code_cell_text.text_code_lines)
         code_cell_text = self.wrap_long_lines(code_cell_text)
 
+        # Stream the output into the output cell during a long evaluation, if
+        # set.  Only done when the snapshot shows an output cell (or nothing)
+        # after the code cell, so each write is a single round trip.
+        output_streamer = None
+        if (config_dict["stream_output_to_lyx"]
+                and code_cell_text.following_inset in ("output", "none")):
+            output_streamer = OutputStreamer(
+                    lambda lines: self.write_partial_output(code_cell_text, lines),
+                    config_dict["stream_output_interval_secs"],
+                    every_lines=config_dict["stream_output_every_lines"],
+                    min_interval_secs=config_dict["stream_output_min_interval_ms"] / 1000)
+
         # Do the actual code evaluation and get the output.
-        output = self.evaluate_code_in_cell_class(code_cell_text)
+        output = self.evaluate_code_in_cell_class(code_cell_text,
+                                                  output_streamer=output_streamer)
 
         #
         # Replace the old output with the new output (and maybe replace input).
@@ -528,7 +757,10 @@ class ControllerOfLyxAndInterpreters:
         # printed.  So perhaps better not to display them in LyX: they won't print.
         cursor_after_code_inset = False
         if rewrite_code_cell:
-            self.lyx_process.replace_current_cell_text(code_cell_text, assert_inside_cell=True)
+            # Writing unchanged text back would only cost LFUNs and an undo entry.
+            if code_cell_text.text_code_lines != extracted_code_lines:
+                self.lyx_process.replace_current_cell_text(code_cell_text,
+                                                           assert_inside_cell=True)
         else:
             # Some blue selection-highlighting feedback even when text not replaced.
             # (The highlight doesn't appear when both are in the same command-sequence.)
@@ -544,16 +776,43 @@ class ControllerOfLyxAndInterpreters:
         # if len(output) > 0 and output[-1] == "\n":
         #     output[-1] = "\f\n"
 
+        # Leave the output cell alone if it already holds the output; this
+        # saves the LFUNs to write it and an entry on the Lyx undo stack.
+        if code_cell_text.output_matches(output):
+            return
+
         basic_type, inset_specifier = code_cell_text.get_cell_type()
         self.lyx_process.replace_current_output_cell_text(output,
                       assert_inside_cell=True, inset_specifier=inset_specifier,
-                      cursor_after_code_inset=cursor_after_code_inset)
-
-    def evaluate_code_in_cell_class(self, code_cell_text):
+                      cursor_after_code_inset=cursor_after_code_inset,
+                      code_cell=code_cell_text)
+
+    def write_partial_output(self, code_cell, line_list):
+        """Write `line_list`, the output so far of the `Cell` instance
+        `code_cell` which is being evaluated with the cursor inside it, to its
+        output cell and put the cursor back into the code cell.  The cell is
+        updated to show it is now followed by an output cell holding other text
+        than it was parsed with."""
+        max_lines = config_dict["max_lines_in_output_cell"]
+        if len(line_list) > max_lines:
+            line_list = line_list[:max_lines]
+        basic_type, inset_specifier = code_cell.get_cell_type()
+        self.lyx_process.replace_current_output_cell_text(line_list,
+                      assert_inside_cell=True, inset_specifier=inset_specifier,
+                      goto_begin_after=True, code_cell=code_cell)
+        # From the beginning of the output cell, one char-left leaves it and the
+        # next enters the code cell at its end.  No need to wait for the reply.
+        self.lyx_process.submit_lfun("command-sequence", "char-left;char-left")
+        code_cell.following_inset = "output"
+        code_cell.output_inset_text = None
+
+    def evaluate_code_in_cell_class(self, code_cell_text, output_streamer=None):
         """Evaluate the lines of code in the `Cell` instance `code_cell_text`.
         The output is returned as a list of lines, and is also set as an
         attribute of the `code_cell_text` instance as the data field
-        evaluation_output.  Returns `None` for a non-code cell."""
+        evaluation_output.  Returns `None` for a non-code cell.  If an
+        `OutputStreamer` instance `output_streamer` is passed in, it is updated
+        with the output so far as the evaluation goes on."""
 
         basic_type, inset_specifier_lang = code_cell_text.get_cell_type()
         if basic_type == "Output": # if not a code cell
@@ -579,12 +838,27 @@ class ControllerOfLyxAndInterpreters:
         # Loop through each line of code, evaluating it and saving the results.
         output = []
         ignore_empty_lines = interpreter_spec["ignore_empty_lines"]
-        for code_line in modified_code_cell_text:
-            #print("debug processing line:", [code_line])
-            interp_result = self.process_physical_code_line(
-                interpreter_process, code_line, ignore_empty_lines=ignore_empty_lines)
-            #print("debug result of line:", [interp_result])
-            output = output + interp_result # get the result, per line
+        partial_output_callback = None
+        if output_streamer:
+            def partial_output_callback(partial_lines):
+                output_streamer.update(output + partial_lines)
+        self.running_interpreter_process = interpreter_process
+        try:
+            for code_line in modified_code_cell_text:
+                if self.cancel_requested.is_set():
+                    interpreter_process.indent_calc.reset()
+                    output.append("<<< Evaluation cancelled by LyX Notebook. >>>\n")
+                    break
+                #print("debug processing line:", [code_line])
+                interp_result = self.process_physical_code_line(
+                    interpreter_process, code_line, ignore_empty_lines=ignore_empty_lines,
+                    partial_output_callback=partial_output_callback)
+                #print("debug result of line:", [interp_result])
+                output = output + interp_result # get the result, per line
+                if output_streamer:
+                    output_streamer.update(output)
+        finally:
+            self.running_interpreter_process = None
 
         if len(output) > config_dict["max_lines_in_output_cell"]:
             output = output[:config_dict["max_lines_in_output_cell"]]
@@ -620,11 +894,13 @@ class ControllerOfLyxAndInterpreters:
         return interp_result[0:-1]
 
     def process_physical_code_line(self, interpreter_process, code_line,
-                                ignore_empty_lines=True):
+                                ignore_empty_lines=True, partial_output_callback=None):
         """Process the physical line of code code_line in the interpreter with
         index interpIndex.  Return a (possibly empty) list of all the result lines.
         The option ignore_empty_lines ignores completely empty (all whitespace) lines,
-        but not lines with comments."""
+        but not lines with comments.  If `partial_output_callback` is a function
+        it is called with the list of result lines so far while the interpreter
+        is still running the line."""
 
         # TODO, maybe convert any tabs to spaces in input lines
 
@@ -648,13 +924,20 @@ class ControllerOfLyxAndInterpreters:
         first_results = []
         if interp_spec["indent_down_to_zero_newline"] and indent_calc.indent_level_down_to_zero():
             first_results = self.process_physical_code_line(interpreter_process, "\n",
-                                                        ignore_empty_lines=False)
+                                                        ignore_empty_lines=False,
+                                                        partial_output_callback=partial_output_callback)
 
         # Send the line of code to the interpreter.
         interpreter_process.external_interp.write(code_line)
 
         # Get the result of interpreting the line.
-        interp_result = interpreter_process.external_interp.read()
+        if partial_output_callback:
+            interp_result = interpreter_process.external_interp.read(
+                    partial_output_callback=lambda read_string: partial_output_callback(
+                        first_results + self.partial_result_lines(interpreter_process,
+                                                                  read_string)))
+        else:
+            interp_result = interpreter_process.external_interp.read()
         interp_result = interp_result.splitlines(True) # keepends=True
 
         # If the final prompt was a main prompt, not continuation, reset indent counts.
@@ -679,6 +962,18 @@ class ControllerOfLyxAndInterpreters:
             return first_results + interp_result[1:]
         return first_results + interp_result
 
+    def partial_result_lines(self, interpreter_process, read_string):
+        """Return the lines of `read_string`, the output read so far for a
+        physical line still being run, in the form the lines of the complete
+        result are returned by `process_physical_code_line`."""
+        partial_result = read_string.splitlines(True) # keepends=True
+        if not partial_result:
+            return []
+        partial_result[0] = interpreter_process.most_recent_prompt + partial_result[0]
+        if self.no_echo:
+            return partial_result[1:]
+        return partial_result
+
     def wrap_long_lines(self, line_list):
         """A stub which later can be used to do line-wrapping on long lines,
         or modified (and renamed) to do any sort of processing or formatting."""
@@ -109,9 +109,12 @@ class ExternalInterpreterExpect:
             self.child.send(string)
 
 
-    def read(self):
+    def read(self, partial_output_callback=None):
         """Reads from the stdout of the child process, up until a new prompt appears.
-        If no child process exists it returns an empty string."""
+        If no child process exists it returns an empty string.  If
+        `partial_output_callback` is a function it is called, while waiting for
+        the prompt, with all the output read so far each time more has arrived
+        (checking every `partial_output_poll_secs` seconds)."""
         child = self.child
         if self.before_first_read_or_write or not child or not child.isalive():
             print("\nLyxNotebook error: Attempted read from a child interpreter process"
@@ -121,8 +124,11 @@ class ExternalInterpreterExpect:
 
         try:
             # Note that `index` below gives the index of the matched prompt.  Not used yet.
-            index = child.expect_exact([self.main_prompt, self.cont_prompt],
-                                       timeout=self.read_output_timeout_secs)
+            if partial_output_callback is None:
+                index = child.expect_exact([self.main_prompt, self.cont_prompt],
+                                           timeout=self.read_output_timeout_secs)
+            else:
+                index = self.expect_prompt_with_partial_output(partial_output_callback)
         except pexpect.TIMEOUT as e:
             print("\nLyxNotebook error: Timeout on reading from the interpreter started"
                   "\nwith the command '{}'.".format(self.run_command), file=sys.stderr)
@@ -142,6 +148,36 @@ class ExternalInterpreterExpect:
         return read_string
 
 
+    partial_output_poll_secs = 0.25
+
+    def expect_prompt_with_partial_output(self, partial_output_callback):
+        """Wait for a prompt like `read` does, with the same overall timeout, but
+        in short waits.  After each wait which read more output, call
+        `partial_output_callback` with all the output read so far.  Returns
+        the index of the prompt found, and raises `pexpect.TIMEOUT` on a
+        timeout."""
+        child = self.child
+        deadline = time.monotonic() + self.read_output_timeout_secs
+        partial_output = ""
+        while True:
+            timeout = min(self.partial_output_poll_secs, deadline - time.monotonic())
+            try:
+                return child.expect_exact([self.main_prompt, self.cont_prompt],
+                                          timeout=max(timeout, 0))
+            except pexpect.TIMEOUT:
+                if time.monotonic() >= deadline:
+                    raise
+            if child.before != partial_output: # On a timeout it has all read so far.
+                partial_output = child.before
+                partial_output_callback(partial_output)
+
+    def interrupt(self):
+        """Send an interrupt (control-C) to the interpreter, to stop a running
+        evaluation.  Can be called from a thread other than the one reading."""
+        child = self.child
+        if child and child.isalive():
+            child.sendintr()
+
     def kill(self, soft=True, hard=False):
         """Do a soft or a hard kill, or both to try soft before hard."""
         child = self.child
@@ -317,12 +353,15 @@ class ExternalInterpreter:
             except OSError:
                 self.report_read_error()
 
-    def read(self, max_bytes=100000, remove_backslash_r=True):
+    def read(self, max_bytes=100000, remove_backslash_r=True,
+             partial_output_callback=None):
         """Reads from the stdout of the child process, up until a new prompt appears.
         The process is read until a prompt on a new line is detected.
         The directly read strings have newlines of \\r\\n, but by default the \\r
         values are removed before returning the final string value (since it can
-        cause problems in later processing)."""
+        cause problems in later processing).  The `partial_output_callback`
+        argument is accepted for compatibility with `ExternalInterpreterExpect`,
+        but this class doesn't report partial output."""
         if self.before_first_read_or_write:
             # time.sleep(self.startup_sleep_secs)
             self.before_first_read_or_write = False
@@ -397,6 +436,11 @@ class ExternalInterpreter:
         print("DEBUG returning read string: |", read_string, "|", sep="")
         return read_string
 
+    def interrupt(self):
+        """Send an interrupt (control-C) to the interpreter, to stop a running
+        evaluation."""
+        os.write(self.fd, b"\x03")
+
     def kill(self, soft=True, hard=False):
         """Do a soft or a hard kill, or both to try soft before hard."""
         # controlD = "\x04"
@@ -13,6 +13,7 @@ Simple GUI elements used by the program.
 """
 
 import pathlib
+import functools
 import PySimpleGUI as sg
 from .config_file_processing import config_dict
 
@@ -26,6 +27,24 @@ popup_location = 100, 100 # Display is nicer with fixed popup location.
 
 default_title = "LyX Notebook"
 
+# Tk, under PySimpleGUI, must only be used from the thread which owns the GUI,
+# but the asyncio command loop runs commands in a worker thread.  When set,
+# `gui_thread_caller(function)` calls `function` in the thread which owns the
+# GUI and returns its result.  The popups below go through it.
+gui_thread_caller = None
+
+def in_gui_thread(popup_function):
+    """Decorator to run the popup in the thread which owns the GUI (see
+    `gui_thread_caller`)."""
+    @functools.wraps(popup_function)
+    def popup_in_gui_thread(*args, **kwargs):
+        if gui_thread_caller is None:
+            return popup_function(*args, **kwargs)
+        return gui_thread_caller(lambda: popup_function(*args, **kwargs))
+    return popup_in_gui_thread
+
+
+@in_gui_thread
 def yesno_popup(message, title=default_title):
     """A simple blocking popup asking for confirmation."""
     yesno = sg.popup_yes_no(message,
@@ -41,6 +60,7 @@ def yesno_popup(message, title=default_title):
                             location=popup_location)
     return yesno == "Yes"
 
+@in_gui_thread
 def text_info_popup(text, title=default_title):
     """A simple blocking popup displaying text for the user to read and confirm."""
     sg.popup(text,
@@ -59,6 +79,7 @@ def text_info_popup(text, title=default_title):
         keep_on_top=False,
         location=popup_location)
 
+@in_gui_thread
 def text_warning_popup(text, title=default_title):
     """A simple blocking popup displaying warning text for the user to read and confirm.
     As of not it is the same as `text_info_popup` except it is always on top."""
@@ -78,6 +99,7 @@ def text_warning_popup(text, title=default_title):
         keep_on_top=True,
         location=popup_location)
 
+@in_gui_thread
 def get_path_popup(message, default_path, *, title=default_title, directory=False):
     """Query to get a pathname.  If `directory` is true then it browses for directories
     instead of files."""
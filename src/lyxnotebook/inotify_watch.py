@@ -0,0 +1,112 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `InotifyWatch`, which waits for files to be
+completely written into a directory using the Linux inotify interface (called
+through `ctypes`, so nothing needs to be installed).
+
+It is used to read the .lyx files which Lyx exports for Lyx Notebook as soon as
+they are finished, rather than sleeping and then polling for the end of the
+file.  A file is finished when the writer closes it (`IN_CLOSE_WRITE`) or when
+it is renamed into the directory (`IN_MOVED_TO`), which is what the
+`mv $$FName` export command does on the same filesystem.
+
+When inotify is not available (not Linux, or no `inotify_init1` in the C
+library) creating an `InotifyWatch` raises `OSError`, and callers fall back to
+the polling method.
+
+"""
+
+import os
+import sys
+import time
+import select
+import struct
+import ctypes
+import ctypes.util
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = os.O_CLOEXEC
+
+event_header = struct.Struct("iIII") # The wd, mask, cookie and len fields.
+
+_libc = None
+
+def get_libc():
+    """Return the C library with the inotify functions, or raise `OSError`."""
+    global _libc
+    if _libc is None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux.")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                           use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("The C library has no inotify functions.")
+        _libc = libc
+    return _libc
+
+
+class InotifyWatch:
+    """Watch the directory `dirname` for files which are finished being written
+    (closed after writing, or moved in)."""
+
+    def __init__(self, dirname):
+        libc = get_libc()
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, "inotify_init1: " + os.strerror(errno))
+        watch_descriptor = libc.inotify_add_watch(self.fd, os.fsencode(dirname),
+                                                  IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch_descriptor < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch: " + os.strerror(errno))
+        self.dirname = dirname
+
+    def read_finished_filenames(self):
+        """Read the pending events without blocking, returning the list of the
+        names of the files finished since the last call."""
+        filenames = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, name_len = event_header.unpack_from(data, offset)
+                offset += event_header.size
+                name = data[offset:offset+name_len].rstrip(b"\0")
+                offset += name_len
+                if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                    filenames.append(os.fsdecode(name))
+        return filenames
+
+    def discard_pending(self):
+        """Throw away any events which have already arrived."""
+        self.read_finished_filenames()
+
+    def wait_for_file(self, filename, timeout):
+        """Wait for the file `filename` (a basename in the watched directory)
+        to be finished.  Returns `True` when it is and `False` after `timeout`
+        seconds."""
+        deadline = time.monotonic() + timeout
+        while True:
+            if filename in self.read_finished_filenames():
+                return True
+            time_left = deadline - time.monotonic()
+            if time_left <= 0:
+                return False
+            select.select([self.fd], [], [], time_left)
+
+    def close(self):
+        os.close(self.fd)
@@ -69,10 +69,12 @@ all_commands_and_keymap = [
     ("Shift+F8", "reinitialize all interpreters for buffer"),
     (None, "reinitialize all interpreters for all buffers"),
     (None, "write all code cells to files"),
+    (None, "print lfun timing report"),
+    (None, "reset lfun timing report"),
     # Note F9 and F10 are unavailable in KDE: window walk forward/backward.
-    # Shift+F10 is currently free
     ("Shift+F9", "insert most recent graphic file"),
     ("Shift+F12", "kill lyx notebook process"),
+    ("Shift+F10", "cancel running command"),
     (None, "prompt echo on"),
     (None, "prompt echo off"),
     ("Shift+F1", "toggle prompt echo"),
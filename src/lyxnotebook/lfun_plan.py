@@ -0,0 +1,88 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `LfunPlan`, which collects a series of LFUNs to
+be sent to the Lyx server together, and compiles them into as few server
+commands as Lyx allows.
+
+The steps of a plan are of two kinds:
+
+* Commands, whose replies are not needed.  Consecutive commands are fused into
+  a single `command-sequence`, which Lyx runs in order (going on to the next
+  command when one fails).  A command with a ";" in it cannot be put in a
+  sequence, so it is sent on its own.
+
+* Queries, whose replies are needed, like `server-get-layout`.  Each one is
+  sent as a separate LFUN so that it gets its own reply.
+
+All the server commands of a plan are written to the server at once by
+`InteractWithLyxCells.submit_lfun_plan` (or `run_lfun_plan`, which also waits
+for the replies), so running a plan takes a single round trip to Lyx however
+many steps it has.  Only the decisions which depend on a reply need a new plan,
+and so another round trip.
+
+"""
+
+
+class LfunPlan:
+    """A plan of LFUNs to send to the Lyx server together."""
+
+    def __init__(self):
+        # The steps, as tuples `(kind, lfun_name, argument, warn)` where `kind`
+        # is "command" or "query" and `warn` is true to warn about error replies.
+        self.steps = []
+        self.num_queries = 0
+
+    def command(self, lfun_name, argument=""):
+        """Add an LFUN whose reply is not needed."""
+        self.steps.append(("command", lfun_name, argument, True))
+
+    def commands(self, *lfun_strings):
+        """Add the LFUNs in `lfun_strings`, each an LFUN name optionally
+        followed by a space and its argument, as commands."""
+        for lfun_string in lfun_strings:
+            lfun_name, _, argument = lfun_string.partition(" ")
+            self.command(lfun_name, argument)
+
+    def query(self, lfun_name, argument="", warn=True):
+        """Add an LFUN whose reply is needed.  Returns the index of its reply
+        in the list of replies returned when the plan is run.  Set `warn` false
+        when an `ERROR` reply is expected (as for a probe)."""
+        self.steps.append(("query", lfun_name, argument, warn))
+        self.num_queries += 1
+        return self.num_queries - 1
+
+    def __len__(self):
+        return len(self.steps)
+
+    def compile(self):
+        """Return a list of the server commands for the plan, as tuples
+        `(lfun_name, argument, warn, is_query)`, with the consecutive commands
+        which can be put in a sequence fused into one `command-sequence`."""
+        compiled = []
+        sequence = [] # The commands of the sequence being collected.
+
+        def end_sequence():
+            if len(sequence) == 1:
+                compiled.append(sequence[0] + (True, False))
+            elif sequence:
+                compiled.append(("command-sequence", ";".join(
+                    (lfun_name + " " + argument).rstrip() for lfun_name, argument in sequence),
+                    True, False))
+            sequence.clear()
+
+        for kind, lfun_name, argument, warn in self.steps:
+            if kind == "command" and ";" not in argument and lfun_name not in (
+                                        "command-sequence", "command-alternatives"):
+                sequence.append((lfun_name, argument))
+                continue
+            end_sequence()
+            compiled.append((lfun_name, argument, warn, kind == "query"))
+        end_sequence()
+        return compiled
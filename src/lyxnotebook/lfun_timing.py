@@ -0,0 +1,160 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `LfunTimingStats`, which collects timing data
+for the LFUNs sent to the Lyx server and produces reports from it.
+
+Every LFUN reply read from the server is recorded as a sample, grouped under
+the user-level key action (like "evaluate all code cells") that was running
+when the LFUN was sent and under the `InteractWithLyxCells` helper method
+(like `inside_math_inset`) which sent it.  The round-trip time of a sample runs
+from writing the LFUN to reading its reply; for LFUNs which are pipelined
+without waiting it also includes the time spent sending the later LFUNs.  The
+total running time of each key action is recorded too, so the time spent in
+LFUNs can be compared to the time spent elsewhere (such as in interpreters).
+
+"""
+
+import csv
+import json
+
+# The percentiles of the round-trip times shown in reports.
+report_percentiles = [50, 90, 99]
+
+
+def percentile(sorted_values, percent):
+    """Return the nearest-rank percentile of the nonempty list `sorted_values`."""
+    rank = max(1, -(-len(sorted_values) * percent // 100)) # Ceiling division.
+    return sorted_values[rank - 1]
+
+
+class LfunSamples:
+    """The samples recorded for one LFUN name sent from one helper method while
+    running one key action."""
+
+    def __init__(self):
+        self.times = []   # Round-trip times, in seconds.
+        self.bytes_out = 0 # Bytes written to the server, in total.
+        self.bytes_in = 0  # Bytes of replies read from the server, in total.
+
+
+class LfunTimingStats:
+    """Collects the round-trip times and byte counts of the LFUNs sent to the
+    Lyx server, keyed by `(key_action, helper, lfun_name)` tuples.  An instance
+    is held by each `InteractWithLyxCells` instance."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Discard all the data collected so far."""
+        self.lfun_samples = {} # Map (key_action, helper, lfun_name) to `LfunSamples`.
+        self.key_action_times = {} # Map key_action to list of run times, in seconds.
+
+    def record_lfun(self, key_action, helper, lfun_name, seconds, bytes_out, bytes_in):
+        """Record one LFUN round trip."""
+        key = (key_action, helper, lfun_name)
+        samples = self.lfun_samples.get(key)
+        if samples is None:
+            samples = self.lfun_samples[key] = LfunSamples()
+        samples.times.append(seconds)
+        samples.bytes_out += bytes_out
+        samples.bytes_in += bytes_in
+
+    def record_key_action(self, key_action, seconds):
+        """Record the total running time of one run of a key action."""
+        self.key_action_times.setdefault(key_action, []).append(seconds)
+
+    def report_rows(self):
+        """Return the report data as a list of dicts, one for each key action,
+        helper and LFUN name, ordered by key action and then by decreasing
+        total time."""
+        rows = []
+        for (key_action, helper, lfun_name), samples in self.lfun_samples.items():
+            times = sorted(samples.times)
+            row = {"key_action": key_action,
+                   "helper": helper,
+                   "lfun": lfun_name,
+                   "count": len(times),
+                   "total_secs": sum(times)}
+            for percent in report_percentiles:
+                row["p{}_secs".format(percent)] = percentile(times, percent)
+            row["max_secs"] = times[-1]
+            row["bytes_out"] = samples.bytes_out
+            row["bytes_in"] = samples.bytes_in
+            rows.append(row)
+        rows.sort(key=lambda row: -row["total_secs"])
+        rows.sort(key=lambda row: row["key_action"])
+        return rows
+
+    def report_key_actions(self):
+        """Return a dict mapping each key action to a dict with its run count,
+        its total running time and the part of that time spent in LFUN round
+        trips."""
+        summary = {}
+        for key_action, times in self.key_action_times.items():
+            summary[key_action] = {"count": len(times), "total_secs": sum(times),
+                                   "lfun_secs": 0.0, "lfun_count": 0}
+        for row in self.report_rows():
+            action_summary = summary.setdefault(row["key_action"],
+                                     {"count": 0, "total_secs": 0.0,
+                                      "lfun_secs": 0.0, "lfun_count": 0})
+            action_summary["lfun_secs"] += row["total_secs"]
+            action_summary["lfun_count"] += row["count"]
+        return summary
+
+    def report_string(self, max_rows_per_key_action=15):
+        """Return the report as a table in a string, for printing.  Only the
+        LFUNs which took the most total time are shown for each key action."""
+        if not self.lfun_samples:
+            return "No LFUN timing data has been collected."
+        header = "{:<32} {:<26} {:>6} {:>10}".format("  helper", "lfun", "count",
+                                                      "total ms")
+        for percent in report_percentiles:
+            header += " {:>8}".format("p{} ms".format(percent))
+        header += " {:>9} {:>9}".format("bytes out", "bytes in")
+
+        lines = []
+        rows = self.report_rows()
+        for key_action, action_summary in sorted(self.report_key_actions().items()):
+            lines.append("")
+            lines.append("{}: {} runs, {:.1f} ms total, {} LFUNs taking {:.1f} ms"
+                         .format(key_action, action_summary["count"],
+                                 1000*action_summary["total_secs"],
+                                 action_summary["lfun_count"],
+                                 1000*action_summary["lfun_secs"]))
+            lines.append(header)
+            action_rows = [row for row in rows if row["key_action"] == key_action]
+            for row in action_rows[:max_rows_per_key_action]:
+                line = "  {:<30} {:<26} {:>6} {:>10.1f}".format(row["helper"][:30],
+                                   row["lfun"][:26], row["count"],
+                                   1000*row["total_secs"])
+                for percent in report_percentiles:
+                    line += " {:>8.2f}".format(1000*row["p{}_secs".format(percent)])
+                line += " {:>9} {:>9}".format(row["bytes_out"], row["bytes_in"])
+                lines.append(line)
+            if len(action_rows) > max_rows_per_key_action:
+                lines.append("  ... {} more rows".format(
+                                      len(action_rows) - max_rows_per_key_action))
+        return "\n".join(lines)
+
+    def write_report_file(self, filename):
+        """Write the report to the file `filename`, as CSV if the filename ends
+        with ".csv" and as JSON otherwise."""
+        rows = self.report_rows()
+        if filename.endswith(".csv"):
+            with open(filename, "w", newline="") as report_file:
+                fieldnames = list(rows[0].keys()) if rows else ["key_action"]
+                writer = csv.DictWriter(report_file, fieldnames=fieldnames)
+                writer.writeheader()
+                writer.writerows(rows)
+        else:
+            with open(filename, "w") as report_file:
+                json.dump({"key_actions": self.report_key_actions(), "lfuns": rows},
+                          report_file, indent=2)
@@ -54,20 +54,227 @@ Some earlier notes:
 import sys
 import os
 import time
+import atexit
+import shutil
+import tempfile
+import select
+import selectors
+import threading
+import collections
 import datetime
 import getpass
-import random
-import string # just for generating random filenames
 from .config_file_processing import config_dict
 from . import gui
-from .parse_and_write_lyx_files import (Cell, TerminatedFile,
-                                        get_all_cell_text_from_lyx_file)
+from .lfun_timing import LfunTimingStats
+from .inotify_watch import InotifyWatch
+from .temp_file_pool import TempFilePool
+from .lfun_plan import LfunPlan
+from .child_documents import get_all_cell_text_with_child_documents
+from .parse_and_write_lyx_files import (Cell, TerminatedFile, CellParseCache, CellIndex,
+                                        get_all_lines_from_lyx_file,
+                                        get_all_cell_text_from_lyx_string,
+                                        generate_cells_from_lyx_file,
+                                        count_cells_in_lyx_string)
                                         #replace_all_cell_text_in_lyx_file)
 
 # This file is repeatedly written temporarily to current dir, then deleted.
 # TODO: Do in a proper Python temp dir unless needed for debugging.
 tmp_saved_lyx_file_name = "tmp_save_file_lyx_notebook_xxxxx.lyxnotebook"
 
+# The longest to wait for Lyx to finish an export, in seconds, before falling
+# back to reading the file as it is being written.
+export_wait_timeout = 10.0
+
+# Directories to try, in order, for the session export directory.  The first
+# two are normally tmpfs (memory) filesystems.
+session_directory_parents = ["/dev/shm", os.environ.get("XDG_RUNTIME_DIR", ""),
+                             tempfile.gettempdir()]
+
+class LyxServerError(Exception):
+    """Base class of the errors in talking to the Lyx server."""
+
+class LyxServerClosedError(LyxServerError):
+    """Raised when Lyx has closed the server input pipe, usually on exiting."""
+
+class LyxServerWriteTimeout(LyxServerError):
+    """Raised when Lyx does not accept a command on the server input pipe within
+    the `lyx_server_write_timeout_secs` time set in the config file."""
+
+class LyxServerEvent(collections.namedtuple("LyxServerEvent",
+                                  ["event_type", "client_name", "function", "data"])):
+    """A single event read from the Lyx server output pipe.  The `event_type` is
+    "INFO", "ERROR" or "NOTIFY" (or anything else Lyx might send).  For NOTIFY
+    events only `data` is set, and it holds the name of the key pressed."""
+    __slots__ = ()
+
+    @classmethod
+    def from_line(cls, line):
+        """Parse a line from the server (without the newline) into an event."""
+        if line.startswith("NOTIFY:"):
+            return cls("NOTIFY", "", "", line[len("NOTIFY:"):])
+        fields = line.split(":", 3)
+        fields += [""] * (4 - len(fields))
+        return cls(*fields)
+
+
+class LyxServerEventReader:
+    """Reads the bytes that Lyx writes to the server output pipe and frames them
+    into `LyxServerEvent` records, which are appended to the deque `events` in
+    the order they arrive.
+
+    Reads are large and non-blocking, and continue until the pipe is drained.
+    Bytes after the last newline are kept in a `bytearray` until the rest of
+    their line arrives.  Decoding is done per complete line, so long replies
+    and multibyte characters which are split across reads come out intact (a
+    newline byte never occurs inside a UTF-8 multibyte character)."""
+
+    read_size = 65536
+
+    def __init__(self, pipe_fd):
+        """The `pipe_fd` should be opened with `O_NONBLOCK`."""
+        self.pipe_fd = pipe_fd
+        self.partial_line = bytearray() # Bytes read but not yet newline-terminated.
+        self.events = collections.deque()
+        self.at_eof = False # Set when a read finds no writer on the pipe.
+
+    def read_available(self):
+        """Read everything currently available on the pipe, without blocking,
+        and queue any complete events.  Returns the number of bytes read."""
+        num_bytes = 0
+        while True:
+            try:
+                data = os.read(self.pipe_fd, self.read_size)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not data: # EOF, nothing has the pipe open for writing.
+                self.at_eof = True
+                break
+            self.at_eof = False
+            num_bytes += len(data)
+            self.partial_line += data
+            if len(data) < self.read_size:
+                break # Drained; don't pay for another read to find that out.
+        if num_bytes:
+            self.frame_events()
+        return num_bytes
+
+    def frame_events(self):
+        """Move all the complete lines in `partial_line` to the event queue."""
+        end = self.partial_line.rfind(b"\n")
+        if end == -1:
+            return
+        complete = self.partial_line[:end].decode("utf-8", errors="replace")
+        del self.partial_line[:end+1]
+        for line in complete.split("\n"):
+            if line:
+                self.events.append(LyxServerEvent.from_line(line))
+
+
+class LfunFuture:
+    """The pending reply to an LFUN which was sent to the Lyx server by
+    `InteractWithLyxCells.submit_lfuns`.  The reply is filled in when it is read
+    from the server's output pipe.  The round trip is then recorded in the
+    `lfun_timing_stats` of the `InteractWithLyxCells` instance, under the key
+    action which was running and the `helper` method which sent the LFUN."""
+
+    def __init__(self, lyx_process, lfun_name, warn_error=True, warn_not_info=True,
+                 helper="", bytes_out=0):
+        self.lyx_process = lyx_process
+        self.lfun_name = lfun_name
+        self.warn_error = warn_error
+        self.warn_not_info = warn_not_info
+        self.reply = None # The `LyxServerEvent` for the reply, once it arrives.
+        self.key_action = lyx_process.current_key_action
+        self.helper = helper
+        self.bytes_out = bytes_out
+        self.submit_time = time.perf_counter()
+
+    def done(self):
+        """Has the reply arrived yet?"""
+        return self.reply is not None
+
+    def set_reply(self, event):
+        """Set the reply event, printing any warnings about it."""
+        self.reply = event
+        self.lyx_process.lfun_timing_stats.record_lfun(self.key_action, self.helper,
+                self.lfun_name, time.perf_counter() - self.submit_time,
+                self.bytes_out, len(":".join(event).encode("utf-8")) + 1)
+        if event.function != self.lfun_name:
+            print("Warning: Reply from LyX Server for LFUN '{}' was matched to the"
+                  " LFUN '{}'.".format(event.function, self.lfun_name))
+        if self.warn_error and event.event_type == "ERROR":
+            print("Warning: Ignoring an ERROR message in processLfun(),",
+                  "the reply event is:\n", event)
+        elif self.warn_not_info and event.event_type != "INFO":
+            print("Warning: Got a non-INFO unknown reply from LyX Server" +
+                  " in processLfun.  Ignoring it.")
+
+    def result(self):
+        """Wait for the reply if necessary, and return its data field."""
+        if not self.done():
+            self.lyx_process.wait_for_lfun_reply(self)
+        return self.reply.data
+
+
+class CellCodeFileWriter:
+    """Writes the code of the cells of one language to a file, used by
+    `InteractWithLyxCells.write_all_cell_code_to_file`.  Cells are passed to
+    `write_cell` in document order, but the Init cells are written before the
+    Standard cells.  If `comment_line_begin` is non-empty then extra
+    information is written to the file in comments."""
+
+    def __init__(self, filename, inset_specifier, comment_line_begin,
+                 buffer_filename):
+        self.filename = filename
+        self.inset_specifier = inset_specifier
+        self.comment_line_begin = comment_line_begin
+        self.buffer_filename = buffer_filename
+        self.banner_line = comment_line_begin + "="*70
+        self.code_out_file = None # Opened when the first cell arrives.
+        self.standard_cells_file = tempfile.SpooledTemporaryFile(max_size=2**20,
+                                                                 mode="w+")
+        self.cell_counts = {"Init": 0, "Standard": 0}
+
+    def write_header(self):
+        """Open the file and write an informative header comment to it."""
+        self.code_out_file = open(self.filename, "w")
+        if self.comment_line_begin: # Don't write if comment_line_begin string is empty.
+            now = datetime.datetime.now()
+            self.code_out_file.write("\n" + self.banner_line + "\n")
+            msg = self.comment_line_begin + " File of all " + self.inset_specifier \
+                + " cells from LyX Notebook source file:\n" \
+                  + self.comment_line_begin + "    " + self.buffer_filename + "\n" \
+                  + self.comment_line_begin + " " + now.strftime("%Y-%m-%d %H:%M")
+            self.code_out_file.write(msg)
+            self.code_out_file.write("\n" + self.banner_line + "\n\n")
+
+    def write_cell(self, cell):
+        """Write the Init or Standard cell `cell`."""
+        basic_type = cell.basic_type
+        if basic_type not in self.cell_counts:
+            return
+        if not self.code_out_file:
+            self.write_header()
+        out_file = self.code_out_file if basic_type == "Init" else self.standard_cells_file
+        self.cell_counts[basic_type] += 1
+        if self.comment_line_begin: # Don't write if empty comment_line_begin string.
+            out_file.write("\n" + self.banner_line + "\n")
+            msg = self.comment_line_begin + " " + basic_type + \
+                " cell number " + str(self.cell_counts[basic_type]) + "."
+            out_file.write(msg)
+            out_file.write("\n" + self.banner_line + "\n\n")
+        for line in cell:
+            out_file.write(line)
+
+    def close(self):
+        """Append the Standard cells and close the file."""
+        if self.code_out_file:
+            self.standard_cells_file.seek(0)
+            shutil.copyfileobj(self.standard_cells_file, self.code_out_file)
+            self.code_out_file.close()
+        self.standard_cells_file.close()
+
+
 class InteractWithLyxCells:
     """The main class for handling interactions with a running Lyx process
     via the Lyx server.  Also handles writing and reading data from files in
@@ -87,17 +294,31 @@ class InteractWithLyxCells:
         self.lyx_temporary_directory = os.path.abspath(
                                        os.path.expanduser(self.lyx_temporary_directory))
 
-        self.lyx_server_read_event_buffer = []  # buffer for the events read from the pipe
+        self.pending_lfun_futures = collections.deque() # LFUNs sent but not yet replied to
+        self.reply_cache = None # Dict of cached query replies, or `None` when not caching.
+        self.cell_parse_cache = CellParseCache() # Reuse cells parsed from earlier exports.
+
+        # The NOTIFY events (key presses) ignored while waiting for replies, kept
+        # so the controller can queue their commands once the running one ends.
+        self.ignored_server_notify_event = False
+        self.ignored_notify_events = collections.deque(maxlen=100)
+
+        # Timing data for the LFUNs, grouped by the key action running when they
+        # are sent (set by the controller while it runs a key action).
+        self.lfun_timing_stats = LfunTimingStats()
+        self.current_key_action = "(no key action)"
+
+        # Text put into cells is written to files from this pool, which are in
+        # a private directory for the session on a tmpfs filesystem if possible.
+        self.cell_text_file_pool = TempFilePool(session_directory_parents,
+                                                prefix="lyxnotebook_cells_")
 
-        # a temp file is written in the Lyx temp dir
-        # to avoid conflicts it uses clientname and has eight random characters added
-        # (this could be improved a bit, check exists, but good enough for now)
-        # TODO: Use proper Python temp dir libraries.
-        rnd_alphanum8 = \
-            ''.join(random.choice(string.ascii_uppercase + string.digits)
-                    for x in range(8))
-        self.temp_cell_write_file = self.lyx_temporary_directory + \
-            "/zLyxNotebookCellTmp_" + client_name + user_name + rnd_alphanum8 + ".txt"
+        # Buffers are exported to a private directory for this session, where
+        # inotify tells when an export is finished (see `get_all_cell_text`).
+        self.export_session_dir = None
+        self.export_watch = None
+        if config_dict["export_to_session_directory"]:
+            self.create_export_session_dir()
 
         self.lyx_server_pipe_in_filename = self.lyx_server_pipe + ".in"
         self.lyx_server_pipe_out_filename = self.lyx_server_pipe + ".out"
@@ -114,9 +335,27 @@ class InteractWithLyxCells:
 
         # these single file opens seem to work here, rather than repeated in processLfun
         self.lyx_server_pipe_in = os.open(self.lyx_server_pipe_in_filename, os.O_WRONLY)
+        # Writes are non-blocking, waiting with a poll when the pipe is full.
+        os.set_blocking(self.lyx_server_pipe_in, False)
+        self.server_write_poll = select.poll()
+        self.server_write_poll.register(self.lyx_server_pipe_in, select.POLLOUT)
         self.lyx_server_pipe_out = \
             os.open(self.lyx_server_pipe_out_filename, os.O_RDONLY | os.O_NONBLOCK)
 
+        # The reader frames the bytes from the output pipe into a queue of events.
+        self.event_reader = LyxServerEventReader(self.lyx_server_pipe_out)
+
+        # In the asyncio loop mode the output pipe is read by the event loop, in a
+        # different thread than the one sending LFUNs.  Then this flag is set, and
+        # the sending thread waits on the condition for its replies to be set.
+        self.server_events_read_elsewhere = False
+        self.lfun_reply_condition = threading.Condition()
+
+        # Waiting for server events is done with a selector on the output pipe, so
+        # waits wake up as soon as Lyx writes a reply or a notify event.
+        self.server_event_selector = selectors.DefaultSelector()
+        self.server_event_selector.register(self.lyx_server_pipe_out, selectors.EVENT_READ)
+
         # empty out and ignore any existing replies or notify-events (for Lyx
         # Notebook commands) which are in the lyxServerPipeOut
         while True:
@@ -150,6 +389,63 @@ class InteractWithLyxCells:
         return (os.path.exists(self.lyx_server_pipe_in_filename)
                 and os.path.exists(self.lyx_server_pipe_out_filename))
 
+    #
+    # Caching of query replies within a single user command.
+    #
+
+    # Replies to these argument-free queries are cached while a user command runs.
+    cacheable_lfuns = {"server-get-filename", "server-get-layout"}
+
+    # LFUNs which can change the current buffer, and so its filename.
+    buffer_switching_lfuns = {"buffer-switch", "buffer-next", "buffer-previous",
+                              "buffer-new", "buffer-new-template", "buffer-close",
+                              "buffer-close-all", "buffer-reload", "buffer-write-as",
+                              "buffer-child-open", "file-open", "window-new",
+                              "tab-group-next", "tab-group-previous", "command-execute"}
+
+    # LFUNs which neither move the cursor nor change insets, and so leave the
+    # layout at the cursor unchanged.  All other LFUNs invalidate the layout.
+    layout_preserving_lfuns = {"server-get-filename", "server-get-layout",
+                               "server-get-xy", "message", "buffer-export-custom",
+                               "buffer-write", "buffer-auto-save"}
+
+    def begin_reply_cache(self):
+        """Start caching the replies to the queries in `cacheable_lfuns`.  Called
+        at the start of each user command, since the replies cannot be trusted
+        to stay valid between commands (the user may edit or move around)."""
+        self.reply_cache = {}
+
+    def end_reply_cache(self):
+        """Stop caching replies and discard any cached ones."""
+        self.reply_cache = None
+
+    def get_cached_reply(self, lfun_name, argument):
+        """Return the cached `LfunFuture` for the query, or `None` if there
+        is no usable cached reply."""
+        if self.reply_cache is None or argument:
+            return None
+        future = self.reply_cache.get(lfun_name)
+        if future is not None and future.done() and future.reply.event_type != "INFO":
+            return None # Don't reuse error replies.
+        return future
+
+    def invalidate_cached_replies(self, lfun_name, argument):
+        """Drop the cached replies which running the LFUN could change.  For a
+        command-sequence each of the commands in the sequence is considered."""
+        if not self.reply_cache:
+            return
+        if lfun_name == "command-sequence":
+            lfun_names = [cmd.split(maxsplit=1)[0] for cmd in argument.split(";")
+                          if cmd.strip()]
+        else:
+            lfun_names = [lfun_name]
+        for name in lfun_names:
+            if name in self.buffer_switching_lfuns:
+                self.reply_cache.clear()
+                return
+            if name not in self.layout_preserving_lfuns:
+                self.reply_cache.pop("server-get-layout", None)
+
     def process_lfun_seq(self, *lfun_list, warn_error=True, warn_not_info=True):
         """Run all the separate commands on `lfun_list` as a command-sequence.
         No output is returned."""
@@ -158,45 +454,214 @@ class InteractWithLyxCells:
                           warn_error=warn_error, warn_not_info=warn_not_info)
 
     def process_lfun(self, lfun_name, argument="", warn_error=True, warn_not_info=True):
-        """Process the Lyx LFUN in the currently running Lyx via the server."""
+        """Process the Lyx LFUN in the currently running Lyx via the server.  Waits
+        for the reply and returns its data field."""
         # TODO: modify to return whole parsed reply list... only a few funs all in
         # this file use the return value, and they can just bracket the third component.
         # Then we get more info on ERROR returns, etc.
-
+        return self.submit_lfun(lfun_name, argument, warn_error=warn_error,
+                                warn_not_info=warn_not_info).result()
+
+    def submit_lfun(self, lfun_name, argument="", warn_error=True, warn_not_info=True):
+        """Send the LFUN to Lyx without waiting for the reply.  Returns an
+        `LfunFuture` for the reply; see `submit_lfuns`."""
+        return self.submit_lfuns((lfun_name, argument), warn_error=warn_error,
+                                 warn_not_info=warn_not_info)[0]
+
+    def submit_lfuns(self, *lfuns, warn_error=True, warn_not_info=True):
+        """Send all the LFUNs in `lfuns` to Lyx in a single write, without waiting
+        for any replies.  Each element is either an LFUN name or an
+        `(lfun_name, argument)` tuple.  Returns a list of `LfunFuture` instances,
+        one per LFUN, in the same order.
+
+        Lyx runs the commands and sends the replies in the order they were
+        written, so the replies are matched to the futures in order.  Callers
+        only need to call `result()` on the futures whose reply they use: any
+        later blocking call fills in the earlier futures as it reads past their
+        replies."""
         # WARNING, Unix pipes *cannot* be treated like ordinary files in Python.
         # We need to treat them like low-level OS objects and use os.open, os.read
         # and os.write on them.  We must also specify non-blocking reads.
 
-        # First convert the command to server's protocol, then send it.
-        server_protocol_string = "LYXCMD:{}:{}:{}".format(self.client_name,
-                                                   lfun_name, argument + "\n")
-        server_protocol_string = server_protocol_string.encode("utf-8") # for Python3
-        while True:
+        # First convert the commands to server's protocol, then send them.
+        futures = []
+        sent_futures = []
+        server_protocol_strings = []
+        helper = self.get_lfun_helper_name()
+        for lfun in lfuns:
+            lfun_name, argument = (lfun, "") if isinstance(lfun, str) else lfun
+            future = self.get_cached_reply(lfun_name, argument)
+            if future is None:
+                self.invalidate_cached_replies(lfun_name, argument)
+                server_protocol_string = "LYXCMD:{}:{}:{}\n".format(
+                                               self.client_name, lfun_name, argument)
+                server_protocol_strings.append(server_protocol_string)
+                future = LfunFuture(self, lfun_name, warn_error=warn_error,
+                                    warn_not_info=warn_not_info, helper=helper,
+                                    bytes_out=len(server_protocol_string.encode("utf-8")))
+                sent_futures.append(future)
+                if self.reply_cache is not None and lfun_name in self.cacheable_lfuns:
+                    self.reply_cache[lfun_name] = future
+            futures.append(future)
+        if server_protocol_strings:
+            # Queue the futures first, in case another thread reads the replies.
+            self.pending_lfun_futures.extend(sent_futures)
+            self.write_to_server("".join(server_protocol_strings).encode("utf-8"))
+        return futures
+
+    def submit_lfun_plan(self, plan):
+        """Send all the LFUNs of the `LfunPlan` instance `plan` to Lyx, without
+        waiting for any replies.  Returns a list of `LfunFuture` instances for
+        the queries of the plan, in order."""
+        query_futures = []
+        compiled = plan.compile()
+        start = 0
+        while start < len(compiled):
+            # Each run of LFUNs with the same warning flags goes in a single write.
+            warn = compiled[start][2]
+            end = start + 1
+            while end < len(compiled) and compiled[end][2] == warn:
+                end += 1
+            futures = self.submit_lfuns(*[c[:2] for c in compiled[start:end]],
+                                        warn_error=warn, warn_not_info=warn)
+            query_futures.extend(future for future, c in zip(futures, compiled[start:end])
+                                 if c[3])
+            start = end
+        return query_futures
+
+    def run_lfun_plan(self, plan):
+        """Send all the LFUNs of the `LfunPlan` instance `plan` to Lyx and wait
+        for Lyx to run them, in a single round trip.  Returns a list of the reply
+        data of the queries of the plan, in order."""
+        query_futures = self.submit_lfun_plan(plan)
+        self.finish_pending_lfuns()
+        return [future.result() for future in query_futures]
+
+    # The methods skipped over when looking for the helper which sent an LFUN:
+    # the sending methods themselves and thin wrappers around single LFUNs.
+    lfun_sending_methods = {"submit_lfuns", "submit_lfun", "process_lfun",
+                            "process_lfun_seq", "submit_lfun_plan", "run_lfun_plan",
+                            "server_get_filename", "server_get_layout",
+                            "server_get_xy", "server_set_xy", "char_left", "char_right",
+                            "toggle_all_cells"}
+
+    def get_lfun_helper_name(self):
+        """Return the name of the method or function which called the LFUN-sending
+        methods, for grouping the LFUN timing data."""
+        frame = sys._getframe(1)
+        while frame is not None and frame.f_code.co_name in self.lfun_sending_methods:
+            frame = frame.f_back
+        return frame.f_code.co_name if frame is not None else "?"
+
+    def write_to_server(self, server_protocol_bytes):
+        """Write the encoded protocol bytes to the Lyx server input pipe.
+
+        The pipe is non-blocking.  When it is full (Lyx is busy) this waits
+        with a poll until Lyx has read from it, and then writes as much more as
+        fits, so long command strings go through in pieces at the speed Lyx
+        reads them.  While waiting, anything Lyx writes to the output pipe is
+        read and queued, so Lyx is never blocked writing replies while we are
+        blocked writing commands.  Raises `LyxServerWriteTimeout` if Lyx
+        accepts nothing for `lyx_server_write_timeout_secs` seconds, and
+        `LyxServerClosedError` if Lyx has closed the pipe."""
+        view = memoryview(server_protocol_bytes)
+        timeout_secs = config_dict["lyx_server_write_timeout_secs"]
+        deadline = time.monotonic() + timeout_secs
+        while view:
             try:
-                os.write(self.lyx_server_pipe_in, server_protocol_string)
+                num_written = os.write(self.lyx_server_pipe_in, view)
+            except (BlockingIOError, InterruptedError):
+                num_written = 0
+            except BrokenPipeError:
+                raise LyxServerClosedError("LyX closed the server input pipe {}."
+                                     .format(self.lyx_server_pipe_in_filename))
+            except OSError as err:
+                raise LyxServerError("Error writing to the LyX server input pipe:"
+                                     " {}".format(os.strerror(err.errno))) from err
+            if num_written:
+                view = view[num_written:]
+                deadline = time.monotonic() + timeout_secs # Progress, so restart.
+                continue
+            self.wait_for_server_writable(deadline - time.monotonic())
+            if time.monotonic() >= deadline:
+                raise LyxServerWriteTimeout("LyX did not read from the server input"
+                        " pipe for {} seconds.".format(timeout_secs))
+
+    def wait_for_server_writable(self, timeout):
+        """Wait up to `timeout` seconds for the Lyx server input pipe to have
+        room for writing, reading and queueing any events Lyx sends meanwhile."""
+        read_output = not (self.server_events_read_elsewhere
+                           or self.event_reader.at_eof)
+        if read_output:
+            self.server_write_poll.register(self.lyx_server_pipe_out, select.POLLIN)
+        try:
+            ready = self.server_write_poll.poll(max(0, 1000*timeout)) # Time in ms.
+        finally:
+            if read_output:
+                self.server_write_poll.unregister(self.lyx_server_pipe_out)
+        for fd, poll_events in ready:
+            if fd == self.lyx_server_pipe_out:
+                self.event_reader.read_available()
+            elif poll_events & select.POLLERR:
+                raise LyxServerClosedError("LyX closed the server input pipe {}."
+                                     .format(self.lyx_server_pipe_in_filename))
+
+    def wait_for_lfun_reply(self, lfun_future):
+        """Read from the Lyx server until the reply for `lfun_future` has
+        arrived.  Replies to earlier LFUNs are filled in along the way, and
+        NOTIFY events read in the meantime are ignored (setting the
+        `ignored_server_notify_event` flag).  When the pipe is read by another
+        thread this just waits for that thread to set the reply."""
+        if self.server_events_read_elsewhere:
+            with self.lfun_reply_condition:
+                self.lfun_reply_condition.wait_for(lfun_future.done)
+            return
+        while not lfun_future.done():
+            # With all flags false this reads everything available, handing each
+            # INFO or ERROR reply to its pending future.
+            self.get_server_event(info=False, error=False, notify=False)
+            if lfun_future.done():
                 break
-            except: # TODO what specific exceptions?
-                #time.sleep(0.01)
-                time.sleep(0.001)
-
-        # Now read the reply from the output pipe, and handle ERROR cases.
-        while True: # Later we may want to continue on errors below, so loop.
-            parsed_list = self.wait_for_server_event(notify=False) # note NOTIFY ignored
-            if warn_error and parsed_list[0] == "ERROR":
-                print("Warning: Ignoring an ERROR message in processLfun(),",
-                      "the parsed message list is:\n", parsed_list)
-            elif warn_not_info and parsed_list[0] != "INFO":
-                print("Warning: Got a non-INFO unknown reply from LyX Server" +
-                      " in processLfun.  Ignoring it.")
-            break
-        return parsed_list[3].rstrip("\n")
+            try:
+                self.wait_for_server_readable()
+            except KeyboardInterrupt:
+                print("\nLyX Notebook exiting after keyboard interrupt.  Bye.")
+                sys.exit(0)
+
+    def finish_pending_lfuns(self):
+        """Wait for the replies to all LFUNs which have been submitted."""
+        if self.pending_lfun_futures:
+            self.wait_for_lfun_reply(self.pending_lfun_futures[-1])
+
+    def set_next_lfun_reply(self, event):
+        """Set `event` as the reply of the oldest pending LFUN, waking up any
+        thread waiting for it."""
+        with self.lfun_reply_condition:
+            self.pending_lfun_futures.popleft().set_reply(event)
+            self.lfun_reply_condition.notify_all()
+
+    def dispatch_available_server_events(self):
+        """Read everything available from the server, hand the LFUN replies to
+        their futures, and return a list of the NOTIFY events read.  This is
+        used instead of `get_server_event` when the output pipe is read by an
+        event loop (see `server_events_read_elsewhere`)."""
+        self.event_reader.read_available()
+        events = self.event_reader.events
+        notify_events = []
+        while events:
+            event = events.popleft()
+            if event.event_type in ("INFO", "ERROR") and self.pending_lfun_futures:
+                self.set_next_lfun_reply(event)
+            elif event.event_type == "NOTIFY":
+                notify_events.append(event)
+        return notify_events
 
     def get_server_event(self, info=True, error=True, notify=True):
         """Reads a single event from the Lyx Server.  If no event is there to
         be read it returns `None`.  If any flag is `False` then that type of event
-        is completely ignored.  Returns a parsed list with the strings of the
-        Lyx server events (but not the colon separator, and keeping the final
-        newline on the last element in the list).
+        is completely ignored.  Returns a `LyxServerEvent` record holding the
+        fields of the Lyx server event (but not the colon separators or the
+        final newline).
 
         This routine is repeated in a polling loop to wait for an event in the
         routine `self.wait_for_server_event()`.  It can also be used outside a
@@ -209,72 +674,89 @@ class InteractWithLyxCells:
         used to determine if the user hit a key bound to server-notify while
         some other actions were taking place, like a multi-cell evaluation.
         The higher-level routine can then stop the evaluations by checking
-        between cell evaluations.
-
-        If multiple events are read at once (assumed to be delimited by
-        newlines) then they are buffered and returned one at a time."""
+        between cell evaluations.  The ignored events themselves are saved in
+        the deque `self.ignored_notify_events`, for the higher-level routine to
+        queue their commands or to clear.
+
+        Events are framed and queued by the `LyxServerEventReader` instance
+        `self.event_reader`, and are returned one at a time in the order Lyx
+        sent them.  When the output pipe is read by another thread (see
+        `server_events_read_elsewhere`) nothing is read and `None` is returned."""
+        if self.server_events_read_elsewhere:
+            return None
+        events = self.event_reader.events
         while True:
-            # if no events in buffer, do a read (returning None if nothing to read)
-            if len(self.lyx_server_read_event_buffer) == 0: # could be if
+            # if no events in queue, do a read (returning None if nothing to read)
+            if not events:
                 if not self.lyx_named_pipes_exist():
                     print("LyX server named pipes no longer exist; LyX must have closed.")
                     print("Exiting the LyX Notebook program.")
                     time.sleep(3) # for xterm displays
                     sys.exit(0)
-                try:
-                    raw_reply = os.read(self.lyx_server_pipe_out, 1000)
-                except:
+                self.event_reader.read_available()
+                if not events:
                     return None
-                # convert returned byte array to unicode string
-                raw_reply = raw_reply.decode("utf-8") # for Python3 compatibility
 
-                # check for multiple commands, assume they split on lines...
-                all_events = raw_reply.splitlines()
-                for event in all_events:
-                    # parse the event
-                    parsed_list = event.split(":", 3)
-                    self.lyx_server_read_event_buffer.append(parsed_list)
+            # now we know queue is not empty, so pop the oldest event off and analyze it
+            event = events.popleft()
 
-            # now we know buffer is not empty, so pop an event off and analyze it
-            parsed_list = self.lyx_server_read_event_buffer.pop()
+            # Replies to submitted LFUNs go to their futures, oldest first.
+            if event.event_type in ("INFO", "ERROR") and self.pending_lfun_futures:
+                self.set_next_lfun_reply(event)
+                continue
 
             # check the type of event and compare with flags...
-            if parsed_list[0] == "NOTIFY":
+            if event.event_type == "NOTIFY":
                 if not notify:
                     self.ignored_server_notify_event = True
+                    self.ignored_notify_events.append(event)
                     #print("debug =============================== IGNORED NOTIFY")
                     continue
                 break
-            elif parsed_list[0] == "ERROR":
+            elif event.event_type == "ERROR":
                 if not error:
                     continue
                 break
-            elif parsed_list[0] == "INFO":
+            elif event.event_type == "INFO":
                 if not info:
                     continue
                 break
             else: # ignore unknown, but print warning
                 print("Warning: getServerEvent() read an unknown message type" +
-                      " from LyX Server:", parsed_list)
-
-        return parsed_list
+                      " from LyX Server:", event)
+
+        return event
+
+    def wait_for_server_readable(self, timeout=None):
+        """Block until there is something to read from the Lyx server, either an
+        already-queued event or new bytes on the output pipe.  The `timeout`
+        is in seconds, with `None` meaning wait indefinitely.  Returns `True` if
+        something is ready to be read and `False` on a timeout."""
+        if self.event_reader.events:
+            return True
+        if self.event_reader.at_eof:
+            # With no writer the pipe always selects as readable, so fall back
+            # to a polling sleep until Lyx (re)opens it or the pipes disappear.
+            time.sleep(0.25 if timeout is None else min(timeout, 0.25))
+            return False
+        return bool(self.server_event_selector.select(timeout))
 
     def wait_for_server_event(self, info=True, error=True, notify=True):
         """Go into a loop, waiting for an event from the Lyx process.  If the
         flag for any type of event is `False` then that type of event is ignored."""
         while True:
-            parsed_list = self.get_server_event(info=info, error=error, notify=notify)
-            if parsed_list is None:
+            event = self.get_server_event(info=info, error=error, notify=notify)
+            if event is None:
                 try:
-                    #time.sleep(0.5) # polling, half-second response
-                    time.sleep(0.25) # polling, quarter second response
-                    # don't count the retries, may be polling for hours or even days
+                    # Sleeps until the pipe is readable; no retry count, since
+                    # this may be waiting for hours or even days.
+                    self.wait_for_server_readable()
                 except KeyboardInterrupt:
                     print("\nLyX Notebook exiting after keyboard interrupt.  Bye.")
                     sys.exit(0)
             else:
                 break
-        return parsed_list
+        return event
 
     def wait_for_server_notify(self):
         """This routine waits for a `NOTIFY` event, ignoring all others.  When it
@@ -284,11 +766,10 @@ class InteractWithLyxCells:
         and perform the action).  Thus all command-keys in Lyx for this application
         are bound to the LFUN "server-notify" (usually in a .bind file in the
         local .lyx directory)."""
-        parsed_list = self.wait_for_server_event(info=False, error=False)
+        event = self.wait_for_server_event(info=False, error=False)
         # The second and last component of NOTIFY has the key:
         #   NOTIFY:<key_pressed>
-        key_pressed = parsed_list[1].rstrip("\n")
-        return key_pressed
+        return event.data
 
     #
     #
@@ -307,7 +788,11 @@ class InteractWithLyxCells:
     def server_get_xy(self):
         """Get the x,y position.  Note that the top left of INSETS are always (0,0), so
         this isn't an absolute position."""
-        pos = self.process_lfun("server-get-xy")
+        return self.parse_xy_reply(self.process_lfun("server-get-xy"))
+
+    @staticmethod
+    def parse_xy_reply(pos):
+        """Convert the reply string from a server-get-xy LFUN to an `(x, y)` tuple."""
         pos = pos.split(" ")
         x = int(pos[0].strip())
         y = int(pos[1].strip())
@@ -321,7 +806,7 @@ class InteractWithLyxCells:
         """Print the message in the status bar in Lyx."""
         #self.process_lfun("message", string)
         # BUG in Lyx 2.0.3.?  Message alone doesn't show, but does as command-sequence!
-        self.process_lfun("command-sequence", argument="message "+string)
+        self.submit_lfun("command-sequence", argument="message "+string) # Don't wait.
 
     def char_left(self):
         self.process_lfun("char-left") # Don't bother returning value.
@@ -385,11 +870,11 @@ class InteractWithLyxCells:
         if not assert_inside_cell and not self.inside_cell():
             return False
         if True: # Another way, not really faster.  Doesn't leave cell.
-            pos = self.server_get_xy()
-            self.goto_cell_end()
-            pos2 = self.server_get_xy()
+            # Pipelined: get the position, goto the end, and get the position again
+            # in one round trip; returning to the original position needs no reply.
+            pos, pos2 = self.get_xy_and_cell_end_xy()
             retval = pos == pos2
-            self.server_set_xy(*pos) # Return to original position.
+            self.submit_lfun("server-set-xy", "{} {}".format(*pos)) # Return to original.
         else:
             retval = False
             self.char_right()
@@ -398,11 +883,24 @@ class InteractWithLyxCells:
             self.char_left() # undo the test
         return retval
 
+    def get_xy_and_cell_end_xy(self):
+        """Return the current x,y position and the x,y position of the end of the
+        current cell, leaving the cursor at the end of the cell.  Assumes we
+        are inside a cell.  Only one server round trip is needed."""
+        pos_reply, set_reply, end_pos_reply = self.submit_lfuns("server-get-xy",
+                                        ("server-set-xy", "10000000 10000000"),
+                                        "server-get-xy")
+        return (self.parse_xy_reply(pos_reply.result()),
+                self.parse_xy_reply(end_pos_reply.result()))
+
     def inside_empty_cell(self, assert_inside_cell=False):
         """Test if we are inside an empty cell.  Assumes we are inside a cell."""
-        if self.server_get_xy() != (0, 0):
+        if not assert_inside_cell and not self.inside_cell():
             return False
-        return self.at_cell_end(assert_inside_cell)
+        # Same as being at both the beginning and the end, with only one round trip.
+        pos, pos2 = self.get_xy_and_cell_end_xy()
+        self.submit_lfun("server-set-xy", "{} {}".format(*pos)) # Return to original.
+        return pos == (0, 0) and pos2 == (0, 0)
         #return (self.at_cell_begin(assert_inside_cell)
         #        and self.at_cell_end(assert_inside_cell))
 
@@ -445,32 +943,28 @@ class InteractWithLyxCells:
         return self.process_lfun("newline-insert")
 
     def open_all_cells(self, init=True, standard=True, output=True):
-        """Open all cells of the type associated with this class.  Only implemented
-        for all cells or a single type of cell being selected by flags (but could
-        be extended)."""
-        if init and standard and output:
-            cell_type = "Flex:LyxNotebookCell"
-        elif init:
-            cell_type = "Flex:LyxNotebookCell:Init"
-        elif standard:
-            cell_type = "Flex:LyxNotebookCell:Standard"
-        elif output:
-            cell_type = "Flex:LyxNotebookCell:Output"
-        self.process_lfun("inset-forall", cell_type+" inset-toggle open")
+        """Open all cells of the types selected by the flags."""
+        self.toggle_all_cells("open", init=init, standard=standard, output=output)
 
     def close_all_cells_but_current(self, init=True, standard=True, output=True):
-        """Open all cells of the type associated with this class.  Only implemented
-        for all cells or a single type of cell."""
-        # could be consolidated with openAllCells() with an optional argument
+        """Close all cells of the types selected by the flags, except for the
+        cell holding the cursor (which Lyx never closes)."""
+        self.toggle_all_cells("close", init=init, standard=standard, output=output)
+
+    def toggle_all_cells(self, action, init=True, standard=True, output=True):
+        """Run `inset-toggle` with the argument `action` on all the cells of the
+        types selected by the flags, with an `inset-forall` for each type (or
+        one for all the cells) sent together."""
         if init and standard and output:
-            cell_type = "Flex:LyxNotebookCell"
-        elif init:
-            cell_type = "Flex:LyxNotebookCell:Init"
-        elif standard:
-            cell_type = "Flex:LyxNotebookCell:Standard"
-        elif output:
-            cell_type = "Flex:LyxNotebookCell:Output"
-        self.process_lfun("inset-forall", cell_type+" inset-toggle close")
+            inset_names = ["Flex:LyxNotebookCell"]
+        else:
+            inset_names = ["Flex:LyxNotebookCell:" + basic_type for basic_type, selected
+                           in [("Init", init), ("Standard", standard), ("Output", output)]
+                           if selected]
+        plan = LfunPlan()
+        plan.commands(*["inset-forall {} inset-toggle {}".format(inset_name, action)
+                        for inset_name in inset_names])
+        self.run_lfun_plan(plan)
 
     def insert_magic_cookie_inside_current(self, on_current_line=False,
                                            assert_inside_cell=False):
@@ -508,25 +1002,31 @@ class InteractWithLyxCells:
             self.goto_cell_begin(assert_inside_cell=True)
         self.process_lfun("command-sequence", argument=self.del_cookie_forward_command)
 
-    def insert_magic_cookie_inside_forall(self, cell_type="Flex:LyxNotebookCell"):
-        """Inserts the cookie inside all the selected insets, as beginning chars."""
+    def insert_magic_cookie_inside_forall(self, cell_type="Flex:LyxNotebookCell",
+                                          wait=True):
+        """Inserts the cookie inside all the selected insets, as beginning chars.
+        If `wait` is false the reply is not waited for, and its future is returned."""
         # Note that the "char-right" enters the inset.  The line-begin is important
         # in some cases (a cell starting with 'import', for example), not sure why.
-        return self.process_lfun("inset-forall",
+        future = self.submit_lfun("inset-forall",
                  cell_type+" command-sequence char-right;line-begin;self-insert "+self.magic_cookie)
+        return future.result() if wait else future
 
-    def delete_magic_cookie_inside_forall(self, cell_type="Flex:LyxNotebookCell"):
-        """Deletes the magic cookie from all insets, assumed inside at beginning."""
+    def delete_magic_cookie_inside_forall(self, cell_type="Flex:LyxNotebookCell",
+                                          wait=True):
+        """Deletes the magic cookie from all insets, assumed inside at beginning.
+        If `wait` is false the reply is not waited for, and its future is returned."""
         #delString = ""
         #for i in range(0,len(self.magic_cookie)): delString += "char-delete-forward;"
         # TODO would it be possible to just globally delete the cookie from the
         # whole file?  Could do that before any operations and then afterwards to
         # avoid errors due to cookies left after errors.  LyX 2.0 now has
         # advanced search; look into that and any useful lfuns.
-        return self.process_lfun("inset-forall", argument=
+        future = self.submit_lfun("inset-forall", argument=
                 # Safer to not assume what a "word" is with arbitrary cookie settings...
                 #cell_type+" command-sequence char-right;word-delete-forward")
                 cell_type+" command-sequence char-right;"+self.del_cookie_forward_command)
+        return future.result() if wait else future
 
     def search_next_cookie(self):
         """Search for (goto) the next cookie in the buffer."""
@@ -566,8 +1066,10 @@ class InteractWithLyxCells:
         if len(cell_type_list) == 3:
             cell_type_list = ["Flex:LyxNotebookCell"]
 
+        # The cookie inserts and deletes are sent without waiting for their replies;
+        # the search replies and the final goto_cell_begin queries wait for them.
         for cell_type in cell_type_list:
-            self.insert_magic_cookie_inside_forall(cell_type=cell_type)
+            self.insert_magic_cookie_inside_forall(cell_type=cell_type, wait=False)
 
         if reverse: # reverse search
             if not self.inside_cell(): self.search_prev_cookie()
@@ -579,10 +1081,10 @@ class InteractWithLyxCells:
             #self.char_right() # in case at the beginning of inset, won't hurt elsewhere
             #self.search_next_cookie()
             # combine the two lines above into one server call for a bit more efficiency
-            self.process_lfun("command-sequence",
+            self.submit_lfun("command-sequence",
                              "char-right;word-find-forward "+self.magic_cookie)
         for cell_type in cell_type_list:
-            self.delete_magic_cookie_inside_forall(cell_type=cell_type)
+            self.delete_magic_cookie_inside_forall(cell_type=cell_type, wait=False)
 
         self.goto_cell_begin() # this also checks for inside_cell(), last may be outside
 
@@ -609,18 +1111,18 @@ class InteractWithLyxCells:
         which is used in multiple-cell evaluations from inside Lyx.  Basically we
         need to know how many cells of each type to loop over using the cell-goto
         commands, and this function gets the data."""
-        cell_list = self.get_all_cell_text()
+        # Only the cell headers are needed, so the cells are counted without parsing.
+        cell_counts = count_cells_in_lyx_string(self.get_exported_lyx_string())
         num_init_cells = 0
         num_standard_cells = 0
         num_output_cells = 0
-        for cell in cell_list:
-            basic_type, language = cell.get_cell_type()
+        for (basic_type, language), count in cell_counts.items():
             if basic_type == "Init":
-                num_init_cells += 1
+                num_init_cells += count
             elif basic_type == "Standard":
-                num_standard_cells += 1
+                num_standard_cells += count
             elif basic_type == "Output":
-                num_output_cells += 1
+                num_output_cells += count
         return num_init_cells, num_standard_cells, num_output_cells
 
     #
@@ -630,13 +1132,84 @@ class InteractWithLyxCells:
     #
 
     def get_all_cell_text(self, *, code_language=None, init=True, standard=True,
-                          also_noncell=False, nodelete_tmpfile=False):
+                          also_noncell=False, nodelete_tmpfile=False,
+                          cell_index=None, allow_cookie=False):
         """Returns a list of `Cell` data structures containing the text for each
         cell in the current buffer.  Always updates the file before reading it.
         It can read either from a locally exported .tex Latex file (with
         use_latex_export=True) or from a Lyx-format file saved temporarily to
         the current directory.  The Lyx-format version is currently preferred,
-        and the older Latex version may now need minor fixes."""
+        and the older Latex version may now need minor fixes.  The `cell_index`
+        and `allow_cookie` arguments are passed to the parser; see
+        `get_all_cell_text_from_lyx_string`."""
+
+        lyx_string = self.get_exported_lyx_string(nodelete_tmpfile=nodelete_tmpfile)
+        return get_all_cell_text_from_lyx_string(lyx_string, self.magic_cookie,
+                             code_language=code_language, init=init,
+                             standard=standard, also_noncell=also_noncell,
+                             parse_cache=self.cell_parse_cache,
+                             cell_index=cell_index, allow_cookie=allow_cookie)
+
+    def generate_all_cell_text(self, **kwargs):
+        """A generator version of `get_all_cell_text`, which yields the cells as
+        they are parsed from the exported file, reading the file a line at a
+        time.  The memory used doesn't grow with the size of the document, and
+        the caller can work on each cell right away.  The keyword arguments are
+        those of `generate_cells_from_lyx_lines`, except for `parse_cache`.  The
+        parse cache is not used here, since it keeps every cell parsed."""
+        full_tmp_name, finished = self.export_buffer_to_tmp_file()
+        try:
+            yield from generate_cells_from_lyx_file(full_tmp_name, self.magic_cookie,
+                                                    **kwargs)
+        finally:
+            if os.path.exists(full_tmp_name):
+                os.remove(full_tmp_name)
+
+    def get_all_cell_text_with_child_documents(self, **kwargs):
+        """Return the list of the cells of the current buffer merged with the
+        cells of its child documents (the .lyx files it includes), in document
+        order.  The keyword arguments `code_language`, `init` and `standard`
+        are as in `get_all_cell_text`.  See the `child_documents` module."""
+        buffer_dir = self.get_updated_lyx_directory_data()[0]
+        lyx_string = self.get_exported_lyx_string()
+        return get_all_cell_text_with_child_documents(lyx_string, buffer_dir,
+                                                      self.magic_cookie, **kwargs)
+
+    def get_exported_lyx_string(self, nodelete_tmpfile=False):
+        """Have Lyx export the current buffer as a .lyx file, and return the
+        contents of the file as a string.  The file is deleted after reading
+        unless `nodelete_tmpfile` is true."""
+        full_tmp_name, finished = self.export_buffer_to_tmp_file()
+        lyx_string = None
+        if finished:
+            with open(full_tmp_name) as lyx_file:
+                lyx_string = lyx_file.read()
+        if lyx_string is None or not lyx_string.rstrip().endswith(r"\end_document"):
+            lyx_string = "".join(get_all_lines_from_lyx_file(full_tmp_name))
+
+        if not nodelete_tmpfile and os.path.exists(full_tmp_name):
+            os.remove(full_tmp_name)
+        return lyx_string
+
+    def export_buffer_to_tmp_file(self):
+        """Have Lyx export the current buffer as a .lyx file to a temporary file.
+        Returns a tuple `(filename, finished)` where `finished` is true if the
+        file is known to be completely written.  Otherwise it should be read
+        with a `TerminatedFile`, which waits for the writing to finish."""
+        if self.export_watch:
+            # Export to the session directory, returning as soon as the watch
+            # reports the file finished, with no delays.
+            full_tmp_name = os.path.join(self.export_session_dir,
+                                         tmp_saved_lyx_file_name)
+            self.export_watch.discard_pending()
+            self.process_lfun("buffer-export-custom",
+                             "lyx mv $$FName " + full_tmp_name, warn_error=True)
+            if self.export_watch.wait_for_file(tmp_saved_lyx_file_name,
+                                               export_wait_timeout):
+                return full_tmp_name, True
+            print("Warning: no finished export seen in export_buffer_to_tmp_file,"
+                  " reading the file as it is written.")
+            return full_tmp_name, False
 
         # Note getUpdatedLyxDirectoryData changes current dir to buffer's dir.
         (bufferDirName,
@@ -649,15 +1222,28 @@ class InteractWithLyxCells:
         self.process_lfun("buffer-export-custom",
                          "lyx mv $$FName " + full_tmp_name, warn_error=True)
         time.sleep(0.05) # let write get a slight head start before any reading
-
-        all_cells = get_all_cell_text_from_lyx_file(full_tmp_name, self.magic_cookie,
-                                                    code_language=code_language,
-                                                    init=init, standard=standard,
-                                                    also_noncell=also_noncell)
-
-        if not nodelete_tmpfile and os.path.exists(tmp_saved_lyx_file_name):
-            os.remove(tmp_saved_lyx_file_name)
-        return all_cells
+        return full_tmp_name, False
+
+    def create_export_session_dir(self):
+        """Create a private directory for this session's exports of the buffer,
+        on a tmpfs filesystem if one is available, and set up an inotify watch
+        on it.  Without inotify the old method of exporting to the buffer's
+        directory and polling is used.  The directory is removed on exit."""
+        for parent_dir in session_directory_parents:
+            if parent_dir and os.access(parent_dir, os.W_OK):
+                break
+        session_dir = None
+        try:
+            session_dir = tempfile.mkdtemp(prefix="lyxnotebook_", dir=parent_dir)
+            self.export_watch = InotifyWatch(session_dir)
+        except OSError as err:
+            print("Warning: exports are read by polling, since no inotify watch"
+                  " could be\nset up for a session directory:", err)
+            if session_dir:
+                os.rmdir(session_dir)
+            return
+        self.export_session_dir = session_dir
+        atexit.register(shutil.rmtree, session_dir, ignore_errors=True)
 
     #
     # Get cell and modify cell info from the Lyx source file.
@@ -723,8 +1309,9 @@ class InteractWithLyxCells:
 
             # Get all the cells from the Lyx output, because we need to
             # know the language associated with the current cell.  We will compare
-            # text.
-            all_cells = self.get_all_cell_text(also_noncell=False)
+            # text, looking it up in the index of the cells.
+            cell_index = CellIndex()
+            all_cells = self.get_all_cell_text(also_noncell=False, cell_index=cell_index)
             # set above also_noncell to use below debug code; delete later.
             """
             with open("zzzzz_lyxnotebook_tmp_debug.lyxnotebook", "w") as f:
@@ -764,18 +1351,13 @@ class InteractWithLyxCells:
             self.process_lfun_seq("inset-end-edit", "char-right")
 
             # Find the cell in all_cells that matches the text from inset-edit call.
-            cell_match_indices = []
-            for count, cell in enumerate(all_cells):
-                basic_type, language = cell.get_cell_type()
-                if basic_type not in ["Standard", "Init"]:
-                    continue
-                lines_match = True
-                for target_line, line in zip(cell_text, cell):
-                    if target_line != line:
-                        lines_match = False
-                        break
-                if lines_match:
-                    cell_match_indices.append(count)
+            cell_match_indices = cell_index.find_ordinals(cell_text)
+            if not cell_match_indices:
+                # Fall back to matching the cell text as a prefix, line by line.
+                for count, cell in enumerate(all_cells):
+                    if all(target_line == line
+                           for target_line, line in zip(cell_text, cell)):
+                        cell_match_indices.append(count)
 
             # No matches found.
             if not cell_match_indices:
@@ -784,15 +1366,19 @@ class InteractWithLyxCells:
                        "extracted from the inset via the inset-edit LFUN.")
                 return None
 
-            # Multiple matches found.
+            # Multiple matches found: find which one the cursor is in.
             if len(cell_match_indices) > 1:
-                msg = ("Warning: Cells numbered {} contain identical code\n"
-                      "Don't know which interpreter to run or which cell\n"
-                      "to update the output of..."
-                      .format(cell_match_indices))
-                print(msg)
-                gui.text_warning_popup(msg)
-                return None
+                cursor_ordinal = self.get_current_cell_ordinal_with_cookie()
+                if cursor_ordinal not in cell_match_indices:
+                    msg = ("Warning: Cells numbered {} contain identical code\n"
+                          "and the cell at the cursor could not be found.\n"
+                          "Don't know which interpreter to run or which cell\n"
+                          "to update the output of..."
+                          .format(cell_match_indices))
+                    print(msg)
+                    gui.text_warning_popup(msg)
+                    return None
+                cell_match_indices = [cursor_ordinal]
 
             # Single match.
             matched_index = cell_match_indices[0]
@@ -802,31 +1388,65 @@ class InteractWithLyxCells:
             self.insert_magic_cookie_inside_current(assert_inside_cell=True,
                                                     on_current_line=False)
 
-            all_cells = self.get_all_cell_text()
+            cell_index = CellIndex()
+            all_cells = self.get_all_cell_text(cell_index=cell_index)
 
             self.delete_magic_cookie_inside_current(assert_cursor_at_cookie_end=True)
 
-            found_cookie = False
-            for cell in all_cells:
-                if cell.has_cookie_inside:
-                    if found_cookie:
-                        err_msg = ("\n\nWARNING: multiple cells have cookies inside them."
-                              "\nNot performing the operation.  Globally delete the"
-                              "\ncookie string " + self.magic_cookie + " from the"
-                              " document and try again.\n")
-                        print(err_msg, file=sys.stderr)
-                        gui.text_warning_popup(err_msg)
-                        return None
-                    found_cookie = True
-                    return_cell = cell
+            if len(cell_index.cookie_ordinals) > 1:
+                err_msg = ("\n\nWARNING: multiple cells have cookies inside them."
+                      "\nNot performing the operation.  Globally delete the"
+                      "\ncookie string " + self.magic_cookie + " from the"
+                      " document and try again.\n")
+                print(err_msg, file=sys.stderr)
+                gui.text_warning_popup(err_msg)
+                return None
             # return Cell() # Was causing bugs in ordinary Listings cells, now return None.
-            if found_cookie:
-                return return_cell
+            if cell_index.cookie_ordinals:
+                return all_cells[cell_index.cookie_ordinals[0]]
             return None
 
+    def get_current_cell_ordinal_with_cookie(self):
+        """Return the ordinal of the cell the cursor is in (its position among
+        the code cells, as in a `CellIndex`), or `None` if no single cell is
+        found.  This is found by putting the magic cookie in the cell for an
+        export, and is only used when the cell's text doesn't identify it."""
+        self.insert_magic_cookie_inside_current(assert_inside_cell=True,
+                                                on_current_line=False)
+        cell_index = CellIndex()
+        self.get_all_cell_text(cell_index=cell_index, allow_cookie=True)
+        self.delete_magic_cookie_inside_current(assert_cursor_at_cookie_end=True)
+        if len(cell_index.cookie_ordinals) != 1:
+            return None
+        return cell_index.cookie_ordinals[0]
+
+    # The LFUNs run with the cursor inside a code cell to go into the inset just
+    # after it, in a big command-sequence which does the following:
+    # -- use inset-select-all and two escapes to leave the inset (first escape
+    #    turns off any selections to ensure that the second always exits the inset)
+    # -- word-backward to goto before the inset, then try to open it in case it
+    #    is closed (newly inserted cells are closed, inconvenient and causes probs
+    #    problems at EOF) then word-forward to go back to after the inset
+    # -- inset-toggle open to open any output cell which might be there (if
+    #    there is one and it is closed we can't move inside it in next step)
+    # -- go right one char (to prepare to test if an inset immediately follows,
+    #    since we will be inside cell if there is one).
+    #
+    # (For some reason in 2.0.3 the inset-select-all doesn't gives the nice blue
+    # selection-highlighting feedback when called this way, so it is added
+    # in the evaluateCell routine if text in code cells isn't replaced.)
+    goto_following_inset_lfuns = ("inset-select-all", # Select all.
+                                  "escape", # This turns off selection.
+                                  "escape", # This leaves the inset to the right.
+                                  "word-backward", # Goto before inset.
+                                  "inset-toggle open", # Open the inset.
+                                  "word-forward", # Goto after inset.
+                                  "inset-toggle open", # Open output inset if there.
+                                  "char-right") # Enter the output inset if there.
+
     def replace_current_output_cell_text(self, line_list, create_if_necessary=True,
                goto_begin_after=False, assert_inside_cell=False, inset_specifier="Python",
-               cursor_after_code_inset=False):
+               cursor_after_code_inset=False, code_cell=None):
         """Replace the text of the output cell corresponding to the current `Standard`
         or `Init` cell.  The cell should immediately follow.  If it doesn't and
         `create_if_necessary` is true then an output cell will be created/inserted.  The
@@ -834,100 +1454,143 @@ class InteractWithLyxCells:
         value from one of the other interpreter specs.
 
         The cursor is assumed to be inside the code inset.  If `cursor_after_code_inset`
-        is true the cursor is assumed to be just after the code inset."""
+        is true the cursor is assumed to be just after the code inset.
+
+        If `code_cell` is the `Cell` of the code cell as parsed from an export of
+        the document, its `following_inset` attribute tells what follows the code
+        inset, and the output is written without probing (see
+        `replace_output_cell_text_from_snapshot`)."""
         if not assert_inside_cell and not self.inside_cell():
             return # Not even in a cell.
 
-        # First we run a big command-sequence to do the following:
-        # -- use inset-select-all and two escapes to leave the inset (first escape
-        #    turns off any selections to ensure that the second always exits the inset)
-        # -- word-backward to goto before the inset, then try to open it in case it
-        #    is closed (newly inserted cells are closed, inconvenient and causes probs
-        #    problems at EOF) then word-forward to go back to after the inset
-        # -- inset-toggle open to open any output cell which might be there (if
-        #    there is one and it is closed we can't move inside it in next step)
-        # -- go right one char (to prepare to test if an inset immediately follows,
-        #    since we will be inside cell if there is one).
-        #
-        # (For some reason in 2.0.3 the inset-select-all doesn't gives the nice blue
-        # selection-highlighting feedback when called this way, so it is added
-        # in the evaluateCell routine if text in code cells isn't replaced.)
+        following_inset = code_cell.following_inset if code_cell is not None else None
+        if following_inset in ("output", "math", "none") and not cursor_after_code_inset:
+            self.replace_output_cell_text_from_snapshot(line_list, code_cell,
+                               create_if_necessary=create_if_necessary,
+                               goto_begin_after=goto_begin_after,
+                               inset_specifier=inset_specifier)
+            return
+
+        # The LFUNs are sent in `LfunPlan` batches, each taking a single round trip
+        # to Lyx, and only the decisions which depend on a reply wait for one:
+        # whether a math inset or a cell follows the code cell, and whether that
+        # cell is empty.  That is three round trips in all.
+        plan = LfunPlan()
         if cursor_after_code_inset:
             # TODO, this option isn't working right for some reason.
             # It isn't entering the output cell (if there).
-            self.process_lfun("inset-toggle-open") # Run alone because can be ERROR?
-            self.process_lfun("char-right")
+            plan.commands("inset-toggle-open", "char-right")
         else: # Cursor is inside the inset.
-            self.process_lfun_seq("inset-select-all", # Select all.
-                                  "escape", # This turns off selection.
-                                  "escape", # This leaves the inset to the right.
-                                  "word-backward", # Goto before inset.
-                                  "inset-toggle open", # Open the inset.
-                                  "word-forward", # Goto after inset.
-                                  "inset-toggle open", # Open output inset if there.
-                                  "char-right") # Enter the output inset if there.
-
-        # Check if there is a math inset just after the code inset.
-        if self.inside_math_inset():
-            self.process_lfun_seq("inset-select-all")
-            # Delete all text in existing inset, so we know it is empty.
+            plan.commands(*self.goto_following_inset_lfuns)
+
+        # In the same round trip, check if there is a math inset just after the
+        # code inset (a math-space succeeds only inside one), and get the layout
+        # to see if we are inside a cell.
+        math_space = plan.query("math-space", warn=False)
+        layout = plan.query("server-get-layout")
+        replies = self.run_lfun_plan(plan)
+
+        if replies[math_space].strip() != "Command disabled": # Inside a math inset.
+            # Delete the math space, then select all the text in the existing
+            # inset to be replaced.  (Just deleting backward doesn't always leave
+            # the cursor at the very beginning, which messes up inset-select-all.)
             line_list = [li.strip("\n") for li in line_list] # Only a single line allowed.
             line_string = "".join(line_list)
-            self.process_lfun("math-insert", argument=line_string)
+            plan = LfunPlan()
+            plan.commands("char-left", "char-delete-forward", "inset-select-all")
+            plan.command("math-insert", line_string)
+            self.run_lfun_plan(plan)
             return
 
         # At this point, if there is an inset immediately afterward we are
-        # inside it.  Now test if we are inside a Lyx Notebook cell, assumed to
-        # be the output cell if so.
-        empty_cell = False
-        if not self.inside_cell(): # No output cell immediately follows.
-            if create_if_necessary: # Create a new output cell.
-                self.char_left() # Undo char-right in test above (end just outside cell).
-                # The line below handles the special case of end of buffer insert.
-                if self.inside_cell():
-                    self.char_right()
-                # Now insert the output cell.
-                # Note that flex-insert adds the "Flex:" prefix on the cell name.
-                # Note this puts you inside the new Flex cell (so inset-toggle-open may
-                #    be unnecessary).
-                self.process_lfun_seq("flex-insert LyxNotebookCell:Output:"+inset_specifier,
-                                      "inset-toggle open")
-                empty_cell = True
-            else:
+        # inside it.  If we are inside a Lyx Notebook cell it is assumed to
+        # be the output cell.
+        plan = LfunPlan()
+        if replies[layout] != "Plain Layout": # No output cell immediately follows.
+            # Undo the char-right above (to end just outside the code cell).  At the
+            # end of the buffer that goes back inside the code cell.
+            plan.command("char-left")
+            layout = plan.query("server-get-layout")
+            inside_code_cell = self.run_lfun_plan(plan)[layout] == "Plain Layout"
+            plan = LfunPlan()
+            if not create_if_necessary:
                 # If we don't create a new cell, go back inside the previous cell.
-                self.char_left()
-                if not self.inside_cell():
-                    self.char_left() # Handles end of buffer, too.
-
                 # Note we currently stay inside the inset but at the end.
+                if not inside_code_cell:
+                    plan.command("char-left") # Handles end of buffer, too.
+                    self.submit_lfun_plan(plan) # No need to wait.
                 return
+            # Create a new output cell, in the same round trip as writing its text.
+            if inside_code_cell: # The special case of end of buffer insert.
+                plan.command("char-right")
+            # Note that flex-insert adds the "Flex:" prefix on the cell name.
+            # Note this puts you inside the new Flex cell (so inset-toggle-open may
+            #    be unnecessary).
+            plan.commands("flex-insert LyxNotebookCell:Output:"+inset_specifier,
+                          "inset-toggle open")
+            empty_cell = True
+        else:
+            # We are inside the output cell.  Go to its end and get the position
+            # there, which is (0,0) only when the cell is empty.
+            #
+            # Note this test and `empty_cell` flag was added in Mar. 2017 to fix
+            # bug that was introduced by a change in how Lyx handles the
+            # "select-all" command in an empty cell (don't know version).  It now
+            # selects the whole cell, which then gets replaced.  So if empty we are
+            # inside and don't need to select anything since there is nothing to
+            # replace.
+            plan.command("server-set-xy", "10000000 10000000")
+            end_xy = plan.query("server-get-xy")
+            empty_cell = self.parse_xy_reply(self.run_lfun_plan(plan)[end_xy]) == (0, 0)
+            plan = LfunPlan()
+
+        self.replace_current_cell_text(line_list, goto_begin_after=goto_begin_after,
+                                       assert_inside_cell=True, empty_cell=empty_cell,
+                                       plan=plan)
+
+    def replace_output_cell_text_from_snapshot(self, line_list, code_cell,
+               create_if_necessary=True, goto_begin_after=False, inset_specifier="Python"):
+        """Do the work of `replace_current_output_cell_text` for the current code
+        cell, whose `Cell` as parsed from a snapshot of the document is
+        `code_cell`.  Its `following_inset` must be "output", "math" or "none".
+        Since the snapshot tells what follows the code inset, and whether an
+        Output inset there is empty, no probes are needed and all the LFUNs go
+        in a single round trip to Lyx.  The snapshot must be up to date as far
+        as the code cell and what follows it."""
+        following_inset = code_cell.following_inset
+        plan = LfunPlan()
+        if following_inset == "math":
+            plan.commands(*self.goto_following_inset_lfuns, "inset-select-all")
+            line_list = [li.strip("\n") for li in line_list] # Only a single line allowed.
+            plan.command("math-insert", "".join(line_list))
+            self.run_lfun_plan(plan)
+            return
 
-        # After this point, we know we are inside the output cell.
-        #self.server_set_xy(1, 0) # Move cursor to optimize later inside_empty_cell call.
-        self.goto_cell_end() # Move cursor to optimize later inside_empty_cell call.
-
-        # Note this test and `empty_cell` flag was added in Mar. 2017 to fix
-        # bug that was introduced by a change in how Lyx handles the
-        # "select-all" command in an empty cell (don't know version).  It now
-        # selects the whole cell, which then gets replaced.  So if empty we are
-        # inside and don't need to select anything since there is nothing to
-        # replace.
-        if not empty_cell and self.inside_empty_cell():
+        if following_inset == "none":
+            if not create_if_necessary:
+                return # The cursor stays inside the code cell.
+            # Stop just after the code inset, and insert the output cell there.
+            plan.commands(*self.goto_following_inset_lfuns[:-1],
+                          "flex-insert LyxNotebookCell:Output:"+inset_specifier,
+                          "inset-toggle open")
             empty_cell = True
+        else: # Go into the output cell.
+            plan.commands(*self.goto_following_inset_lfuns)
+            empty_cell = code_cell.output_is_empty
 
-        self.replace_current_cell_text(line_list, assert_inside_cell=True,
-                                                  empty_cell=empty_cell)
-        if goto_begin_after:
-            self.goto_cell_begin(assert_inside_cell=True)
+        self.replace_current_cell_text(line_list, goto_begin_after=goto_begin_after,
+                                       assert_inside_cell=True, empty_cell=empty_cell,
+                                       plan=plan)
 
     def replace_current_cell_text(self, line_list,
                                goto_begin_after=False, assert_inside_cell=False,
-                               empty_cell=False):
+                               empty_cell=False, plan=None):
         r"""Replace the current cell's text with the lines in `line_list`
         Currently `line_list` can be a `Cell` instance, but it can also just be a list
         since no special `Cell` extra data is used.  The lines in `line_list` must be
         newline terminated, but should not include any `\begin` and `\end` Latex
-        markup lines for the cell type."""
+        markup lines for the cell type.  If `plan` is an `LfunPlan` its LFUNs are
+        run first, in the same round trip to Lyx as the replacement."""
         # Write the text to a file and then read it in all at once, replacing
         # selected text.  This gives better undo behavior than a self-insert
         # for each line.
@@ -938,7 +1601,8 @@ class InteractWithLyxCells:
         if len(line_list) == 0:
             line_list = [""] # Cells always have at least one line.
 
-        with open(self.temp_cell_write_file, "w") as f:
+        temp_cell_write_file = self.cell_text_file_pool.acquire()
+        with open(temp_cell_write_file, "w") as f: # Truncates any old file.
             # Process all but the last line (we know it has at least one).
             if len(line_list) > 1:
                 for line in line_list[0:-1]:
@@ -954,16 +1618,20 @@ class InteractWithLyxCells:
             f.write(stripped_last_line)
 
         # Read file into lyx, deleting space if it was inserted in special case above.
-        self.replace_current_cell_text_from_plaintext_file(self.temp_cell_write_file,
-                                                 assert_inside_cell=assert_inside_cell,
-                                                 empty_cell=empty_cell)
+        if plan is None:
+            plan = LfunPlan()
+        if not empty_cell: # Select everything in the inset, to be replaced.
+            plan.command("inset-select-all")
+        plan.command("file-insert-plaintext", temp_cell_write_file)
         if delete_space:
-            self.process_lfun("char-delete-backward")
-
-        # Clean up by deleting the temporary file.
-        os.remove(self.temp_cell_write_file)
+            plan.command("char-delete-backward")
         if goto_begin_after:
-            self.goto_cell_begin(assert_inside_cell=True)
+            plan.command("server-set-xy", "0 0")
+        try:
+            self.run_lfun_plan(plan)
+        finally:
+            # Lyx has read the file once the LFUN replies, so it can be reused.
+            self.cell_text_file_pool.release(temp_cell_write_file)
 
     def replace_current_cell_text_from_plaintext_file(self, filename,
                                      assert_inside_cell=False, empty_cell=False):
@@ -991,51 +1659,34 @@ class InteractWithLyxCells:
         this module does not have access to interpreterSpec data.  Currently
         will silently overwrite filename.  If comment-line char is set to a
         non-empty value then extra information to be written to the file in
-        comments."""
+        comments.  When the `include_child_documents` config setting is true
+        the cells of the child documents of the buffer are written too."""
         (currentBufferFileDirectory,
          currentBufferFilename,
          auto_save_filename,
          full_path) = self.get_updated_lyx_directory_data()
 
-        # Get all the cells and open the file with name filename.
-        all_cells = self.get_all_cell_text()
-
-        # Loop through all the inset types, writing the cells for that type.
+        # The cells are written as they are parsed.  Init cells go straight to
+        # their file, while Standard cells are held in a spooled temporary file
+        # (in memory until it gets large) and appended at the end.  A code file
+        # is only created when its first cell arrives.
+        writers = {} # Map an inset_specifier to a list of its `CellCodeFileWriter`s.
         for filename, inset_specifier, commentLineBegin in data_tuple_list:
-
-            # don't write if no cells of the particular type
-            cells = [c for c in all_cells if c.get_cell_type()[1] == inset_specifier]
-            if len(cells) == 0:
-                continue
-
-            # Write an informative header comment to the file.
-            with open(filename, "w") as code_out_file:
-                banner_line = commentLineBegin + "="*70
-                now = datetime.datetime.now()
-                if commentLineBegin: # Don't write if commentLineBegin string is empty.
-                    code_out_file.write("\n" + banner_line + "\n")
-                    msg = commentLineBegin + " File of all " + inset_specifier \
-                        + " cells from LyX Notebook source file:\n" \
-                          + commentLineBegin + "    " + currentBufferFilename + "\n" \
-                          + commentLineBegin + " " + now.strftime("%Y-%m-%d %H:%M")
-                    code_out_file.write(msg)
-                    code_out_file.write("\n" + banner_line + "\n\n")
-
-                # Write the cells of the inset_specifier type to the file.
-                for basic_cell_type in ["Init", "Standard"]:
-                    count = 0
-                    for cell in all_cells:
-                        cell_type = cell.get_cell_type()
-                        if cell_type[0] == basic_cell_type and cell_type[1] == inset_specifier:
-                            count += 1
-                            if commentLineBegin: # Don't write if empty commentLineBegin string.
-                                code_out_file.write("\n" + banner_line + "\n")
-                                msg = commentLineBegin + " " + basic_cell_type + \
-                                    " cell number " + str(count) + "."
-                                code_out_file.write(msg)
-                                code_out_file.write("\n" + banner_line + "\n\n")
-                            for line in cell:
-                                code_out_file.write(line)
+            writers.setdefault(inset_specifier, []).append(CellCodeFileWriter(
+                     filename, inset_specifier, commentLineBegin, currentBufferFilename))
+        if config_dict["include_child_documents"]:
+            all_cells = self.get_all_cell_text_with_child_documents()
+        else:
+            all_cells = self.generate_all_cell_text()
+        try:
+            for cell in all_cells:
+                basic_type, inset_specifier = cell.get_cell_type()
+                for writer in writers.get(inset_specifier, []):
+                    writer.write_cell(cell)
+        finally:
+            for writer_list in writers.values():
+                for writer in writer_list:
+                    writer.close()
 
     #
     # Create graphics insets.
@@ -0,0 +1,66 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `OutputStreamer`, which decides when to write
+the partial output of a code cell to its output cell while the cell is still
+being evaluated, so that the output of a long-running cell shows up in Lyx as
+it is produced rather than all at once at the end.
+
+The evaluation calls `update` with all the output so far each time more is
+read from the interpreter (which can be every fraction of a second).  The
+output is written when `interval_secs` seconds have passed since the last
+write, or when `every_lines` new lines have arrived, but never sooner than
+`min_interval_secs` seconds after the last write, so a cell printing
+thousands of lines doesn't flood Lyx with LFUNs.  The complete output is still
+written in the usual way when the evaluation finishes.
+
+Typical use::
+
+    streamer = OutputStreamer(write_partial_output, interval_secs=2)
+    ... # During the evaluation:
+    streamer.update(output_lines)
+
+"""
+
+import time
+
+
+class OutputStreamer:
+    """Write the partial output of a cell being evaluated, by calling
+    `write_output` with the list of output lines, at a limited rate.  A zero
+    `interval_secs` or `every_lines` turns off that trigger for a write."""
+
+    def __init__(self, write_output, interval_secs, every_lines=0,
+                 min_interval_secs=0, clock=time.monotonic):
+        self.write_output = write_output
+        self.interval_secs = interval_secs
+        self.every_lines = every_lines
+        self.min_interval_secs = min_interval_secs
+        self.clock = clock
+        self.last_write_time = clock() # Start timing from the start of the evaluation.
+        self.lines_written = []
+        self.num_writes = 0
+
+    def update(self, output_lines):
+        """Write the list of lines `output_lines`, all the output of the cell so
+        far, if a write is due.  Returns whether it was written."""
+        since_last_write = self.clock() - self.last_write_time
+        if since_last_write < self.min_interval_secs:
+            return False
+        num_new_lines = len(output_lines) - len(self.lines_written)
+        if not ((self.interval_secs and since_last_write >= self.interval_secs)
+                or (self.every_lines and num_new_lines >= self.every_lines)):
+            return False
+        if output_lines == self.lines_written or not "".join(output_lines).strip():
+            return False # Nothing new, or nothing to show yet.
+        self.write_output(list(output_lines))
+        self.lines_written = list(output_lines)
+        self.num_writes += 1
+        self.last_write_time = self.clock() # A slow write counts toward the rate limit.
+        return True
@@ -11,7 +11,12 @@ This module contains functions which parse and rewrite Lyx .lyx files.
 
 """
 
+import re
 import copy
+import time
+import itertools
+import hashlib
+import collections
 from .config_file_processing import config_dict
 from . import gui
 
@@ -34,26 +39,178 @@ class Cell:
     Cells are currently only created when parsing a Lyx string or file to
     extract the cell contents.
 
-    The lines of Lyx-format text still have newlines on them."""
-
-    def __init__(self, basic_type, language):
-        """Initialize the data stored for the cell."""
-        super().__init__()
+    The lines of Lyx-format text still have newlines on them.
+
+    A parsed cell doesn't keep separate lists of its lines.  It keeps the
+    list of Lyx-format lines of the whole inset, as read from the document,
+    and the offsets of where the code lines and the ending lines start in it.
+    The `lyx_starting_lines`, `lyx_code_lines` and `lyx_ending_lines` lists
+    are sliced from it, and `text_code_lines` and `code_hash` are computed
+    from the code lines, only when they are first used.  Assigning to any of
+    them replaces the computed value.  The inset line list is never modified,
+    so copies of a cell can share it.
+
+    When the cell is immediately followed by an Output inset in the document
+    the Lyx-format text of that inset is kept as `output_inset_text`, and
+    `output_hash` is computed from it when used.  This lets the output of an
+    evaluation be compared with what the Output inset already holds.
+
+    What immediately follows the cell inset is kept as `following_inset`,
+    one of the strings "output" (an Output inset), "math" (a math inset),
+    "none" (no inset: text or the end of the paragraph) and "other" (some
+    other inset), or `None` for a cell which wasn't parsed.  With it the
+    output can be written back without probing the document in Lyx."""
+
+    __slots__ = ("basic_type", "language", "has_cookie_inside", "evaluation_output",
+                 "following_inset",
+                 "starting_line_number", "ending_line_number",
+                 "_inset_lines", "_code_start", "_ending_start",
+                 "_lyx_starting_lines", "_lyx_code_lines", "_lyx_ending_lines",
+                 "_text_code_lines", "_code_hash",
+                 "_output_inset_text", "_output_hash")
+
+    def __init__(self, basic_type, language, inset_lines=None, code_start=0,
+                 ending_start=0):
+        """Initialize the data stored for the cell.  When parsing, `inset_lines`
+        is the list of Lyx-format lines of the inset, with the code lines
+        starting at index `code_start` and the ending lines at `ending_start`."""
         self.basic_type = basic_type
         self.language = language
 
-        self.text_code_lines = [] # The lines of code in the cell, as ordinary text.
         self.has_cookie_inside = False # Is there a cookie inside this cell?
         self.evaluation_output = None # List of lines resulting from code evaluation.
-
-        self.lyx_starting_lines = [] # The Lyx-format starting lines.
+        self.following_inset = None # What follows the cell inset, when parsed.
         self.starting_line_number = -1 # The line number where the cell begins.
-
-        self.lyx_code_lines = []     # The Lyx-format code lines.
-
-        self.lyx_ending_lines = []   # The Lyx-format ending lines.
         self.ending_line_number = -1   # The line number where the cell ends
 
+        self._inset_lines = inset_lines
+        self._code_start = code_start
+        self._ending_start = ending_start
+        self._lyx_starting_lines = None
+        self._lyx_code_lines = None
+        self._lyx_ending_lines = None
+        self._text_code_lines = None
+        self._code_hash = None
+        self._output_inset_text = None
+        self._output_hash = None
+
+    @property
+    def lyx_starting_lines(self):
+        """The Lyx-format starting lines."""
+        if self._lyx_starting_lines is None:
+            self._lyx_starting_lines = self._inset_slice(0, self._code_start)
+        return self._lyx_starting_lines
+
+    @lyx_starting_lines.setter
+    def lyx_starting_lines(self, lines):
+        self._lyx_starting_lines = lines
+
+    @property
+    def lyx_code_lines(self):
+        """The Lyx-format code lines."""
+        if self._lyx_code_lines is None:
+            self._lyx_code_lines = self._inset_slice(self._code_start,
+                                                     self._ending_start)
+        return self._lyx_code_lines
+
+    @lyx_code_lines.setter
+    def lyx_code_lines(self, lines):
+        # Keep the text lines as they were (made from the old lines if need be),
+        # since they are independent of the Lyx-format lines once set.
+        self._text_code_lines = self.text_code_lines
+        self._lyx_code_lines = lines
+
+    @property
+    def lyx_ending_lines(self):
+        """The Lyx-format ending lines."""
+        if self._lyx_ending_lines is None:
+            self._lyx_ending_lines = self._inset_slice(self._ending_start, None)
+        return self._lyx_ending_lines
+
+    @lyx_ending_lines.setter
+    def lyx_ending_lines(self, lines):
+        self._lyx_ending_lines = lines
+
+    @property
+    def text_code_lines(self):
+        """The lines of code in the cell, as ordinary text."""
+        if self._text_code_lines is None:
+            self._text_code_lines = list(generate_text_lines_from_lyx_code_lines(
+                                                self._inset_code_lines()))
+        return self._text_code_lines
+
+    @text_code_lines.setter
+    def text_code_lines(self, lines):
+        self._text_code_lines = lines
+        self._code_hash = None
+
+    @property
+    def is_empty(self):
+        """Whether the cell has no code in it at all, like an empty cell inset in
+        Lyx (which parses to a single empty line)."""
+        lines = self.text_code_lines
+        return not lines or lines == ["\n"]
+
+    @property
+    def code_hash(self):
+        """Hash of `text_code_lines` (see `code_text_hash`), or `None` for a cell
+        which wasn't parsed."""
+        if self._code_hash is None and self._inset_lines is not None:
+            self._code_hash = code_text_hash(self.text_code_lines)
+        return self._code_hash
+
+    @code_hash.setter
+    def code_hash(self, value):
+        self._code_hash = value
+
+    @property
+    def output_inset_text(self):
+        """The Lyx-format text of the Output inset immediately following the
+        cell (its lines as returned by `read_cell_inset_lines`, joined with
+        newlines), or `None` if there isn't one."""
+        return self._output_inset_text
+
+    @output_inset_text.setter
+    def output_inset_text(self, text):
+        self._output_inset_text = text
+        self._output_hash = None
+
+    @property
+    def output_hash(self):
+        """Hash of the text of the Output inset following the cell (see
+        `inset_text_hash`), or `None` if there isn't one."""
+        if self._output_hash is None and self._output_inset_text is not None:
+            self._output_hash = inset_text_hash(generate_text_lines_from_lyx_code_lines(
+                                              self._output_inset_text.split("\n")))
+        return self._output_hash
+
+    @property
+    def output_is_empty(self):
+        """Whether the Output inset following the cell is empty (false if there
+        isn't one)."""
+        return self.output_hash is not None and self.output_hash == empty_inset_text_hash
+
+    def output_matches(self, line_list):
+        """Return whether the Output inset following the cell already holds
+        the text which writing the lines `line_list` into it would give, so
+        that the write can be skipped."""
+        return (self.output_inset_text is not None
+                and self.output_hash == inset_text_hash(line_list))
+
+    def _inset_slice(self, start, stop):
+        """Return a new list of the inset lines from `start` to `stop`."""
+        if self._inset_lines is None:
+            return []
+        return self._inset_lines[start:stop]
+
+    def _inset_code_lines(self):
+        """Return the Lyx-format code lines, without making a list of them if
+        there isn't one already."""
+        if self._lyx_code_lines is not None or self._inset_lines is None:
+            return self.lyx_code_lines
+        return itertools.islice(self._inset_lines, self._code_start,
+                                self._ending_start)
+
     def get_cell_type(self):
         """Note this depends on the naming convention in the .module files.
         Returns a tuple (<basictype>,<language>).  For example,
@@ -75,10 +232,11 @@ class Cell:
     def create_empty_cell(self):
         """Convert the cell into an empty cell of the same `basic_type` and
         `language`."""
+        self._inset_lines = None
         self.text_code_lines = []
+        self.code_hash = None
         self.has_cookie_inside = False
         self.evaluation_output = None
-        self.lyx_code_lines = []
 
         self.lyx_starting_lines = [
                   r"\begin_inset Flex LyxNotebookCell:{}:{}".format(
@@ -95,6 +253,7 @@ class Cell:
     def append(self, line):
         """Append a code line to the list."""
         self.text_code_lines.append(line)
+        self._code_hash = None
 
     def copy(self):
         """Return a shallow copy."""
@@ -121,6 +280,7 @@ class Cell:
         #if index < 0: # Handle negative indices.
         #    index += len(self)
         self.text_code_lines[index] = value
+        self._code_hash = None
 
     def __len__(self):
         return len(self.text_code_lines)
@@ -254,9 +414,25 @@ def get_all_lines_from_lyx_file(filename):
                                magic_cookie_string, also_noncell=also_noncell)
 
 
+# Matches the line beginning a cell inset, with the basic type and language as
+# groups.  Matching the newline before it is faster than using `^`.
+cell_begin_line_regex = re.compile(
+        r"\n\\begin_inset Flex LyxNotebookCell:(?:[^\n]*:)?([^:\n]*):([^:\n]*?)[ \t\r]*$",
+        re.MULTILINE)
+
+def count_cells_in_lyx_string(lyx_string):
+    """Count the cells in the Lyx-format string `lyx_string`, without parsing
+    them.  Returns a `collections.Counter` mapping `(basic_type, language)`
+    tuples to the number of cells of that type, including Output cells.  Only
+    the lines beginning cell insets are looked at, in one regex pass."""
+    return collections.Counter(match.groups() for match in
+                               cell_begin_line_regex.finditer("\n" + lyx_string))
+
+
 def get_all_cell_text_from_lyx_file(filename, magic_cookie_string, *,
                                     code_language=None, init=True, standard=True,
-                                    also_noncell=False):
+                                    also_noncell=False, parse_cache=None,
+                                    cell_index=None, allow_cookie=False):
     """Read all the cell text from the Lyx-format string `string`."  Return a
     list of `Cell` class instances, where each cell is a list of lines (and
     some additional data) corresponding to the lines of a code cell in the
@@ -265,157 +441,720 @@ def get_all_cell_text_from_lyx_file(filename, magic_cookie_string, *,
 
     if `also_noncell` is true then the list returned is the list of cells
     alternating with strings holding the text in the .lyx file that is
-    between the cells.
+    between the cells.  The file is read a line at a time by
+    `generate_cells_from_lyx_file`, which describes the other arguments.
     """
-    line_list = get_all_lines_from_lyx_file(filename)
-    string = "".join(line_list)
-    return get_all_cell_text_from_lyx_string(string, magic_cookie_string,
+    return list(generate_cells_from_lyx_file(filename, magic_cookie_string,
                         code_language=code_language, init=init, standard=standard,
-                        also_noncell=also_noncell)
+                        also_noncell=also_noncell, parse_cache=parse_cache,
+                        cell_index=cell_index, allow_cookie=allow_cookie))
+
+
+def code_text_hash(text_lines):
+    """Return the hash of the list of text lines of a cell used by `CellIndex`."""
+    return hashlib.blake2b("".join(text_lines).encode("utf-8"),
+                           digest_size=16).digest()
+
+
+def inset_text_hash(text_lines):
+    """Return the hash of the text which the lines `text_lines` make in an
+    inset.  The newline ending the last line is not part of the inset text
+    (`replace_current_cell_text` strips it when writing, and the lines parsed
+    from an inset all end in one), so it is left out of the hash.  Any "\\r"
+    characters are left out too, since interpreter output read with pexpect
+    has "\\r\\n" line endings."""
+    text = "".join(text_lines).replace("\r", "")
+    if text.endswith("\n"):
+        text = text[:-1]
+    return code_text_hash([text])
+
+empty_inset_text_hash = inset_text_hash([])
+
+
+class CellIndexEntry:
+    """The data which `CellIndex` keeps for one code cell."""
+    __slots__ = ("list_index", "starting_line_number", "ending_line_number",
+                 "code_hash", "language", "basic_type")
+
+    def __init__(self, list_index, cell):
+        self.list_index = list_index # The index of the cell in the parsed list.
+        self.starting_line_number = cell.starting_line_number
+        self.ending_line_number = cell.ending_line_number
+        self.code_hash = cell.code_hash
+        self.language = cell.language
+        self.basic_type = cell.basic_type
+
+
+class CellIndex:
+    """An index of the code cells of a document, filled in by
+    `get_all_cell_text_from_lyx_string` as it parses.  Cells are numbered by
+    their ordinal, their position among the code cells in the document
+    starting at zero.  The `entries` list maps an ordinal to a
+    `CellIndexEntry`, the dict `ordinals_by_hash` maps a code hash to the list
+    of ordinals of the cells with that code, and `cookie_ordinals` lists the
+    ordinals of the cells with the magic cookie inside.  Looking up the cell
+    holding some code is then a dict lookup instead of a comparison with every
+    cell."""
+
+    def __init__(self):
+        self.entries = []
+        self.ordinals_by_hash = {}
+        self.cookie_ordinals = []
+
+    def add_cell(self, cell, list_index):
+        """Add the next code cell, which is at `list_index` in the cell list."""
+        if cell.code_hash is None:
+            cell.code_hash = code_text_hash(cell.text_code_lines)
+        ordinal = len(self.entries)
+        self.entries.append(CellIndexEntry(list_index, cell))
+        self.ordinals_by_hash.setdefault(cell.code_hash, []).append(ordinal)
+        if cell.has_cookie_inside:
+            self.cookie_ordinals.append(ordinal)
+
+    def find_ordinals(self, text_lines):
+        """Return the list of ordinals of the cells whose code is `text_lines`."""
+        return self.ordinals_by_hash.get(code_text_hash(text_lines), [])
+
+    def list_index(self, ordinal):
+        """Return the index in the cell list of the cell with ordinal `ordinal`."""
+        return self.entries[ordinal].list_index
+
+
+class CellParseCache:
+    """A cache of the results of `get_all_cell_text_from_lyx_string`, for
+    documents which are exported and reparsed over and over with few changes
+    between the exports.
+
+    The whole document is keyed by a hash of its text (and the parse options),
+    so an unchanged document is not parsed at all.  Each cell is also keyed by
+    a hash of its own Lyx-format text, so when a document has changed only the
+    cells whose text changed are parsed again; the `Cell` instances for the
+    rest are copied from the cache.  Copies are always returned, since callers
+    modify the cells they get."""
+
+    # When more cells than this are cached, those not in the last document
+    # parsed are dropped.  Parses which don't cache a document (see
+    # `generate_cells_from_lyx_lines`) clear the cells at twice this size.
+    max_cached_cells = 10000
+
+    def __init__(self):
+        self.document_key = None    # The key of the last document parsed.
+        self.document_recipe = None # How to rebuild the cell list for that document.
+        self.cells_by_hash = {}     # Map a cell text hash to (cell, cookie counts).
+        self.num_cells_parsed = 0
+        self.num_cells_reused = 0
+
+    @staticmethod
+    def text_hash(text):
+        """Return the hash used as a cache key for the string `text`."""
+        return hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+
+    def get_document(self, document_key):
+        """Return a copy of the cell list cached for `document_key`, or `None`.
+        Also returns `None` if any of its cells are no longer cached."""
+        if document_key != self.document_key:
+            return None
+        cell_list = []
+        for piece in self.document_recipe:
+            if isinstance(piece, str):
+                cell_list.append(piece)
+                continue
+            (cell_hash, starting_line_number, ending_line_number, output_text,
+                                                          following_inset) = piece
+            cached = self.get_cell(cell_hash)
+            if cached is None:
+                return None
+            cell = cached[0]
+            cell.starting_line_number = starting_line_number
+            cell.ending_line_number = ending_line_number
+            cell.output_inset_text = output_text
+            cell.following_inset = following_inset
+            cell_list.append(cell)
+        return cell_list
+
+    def set_document(self, document_key, document_recipe):
+        """Cache the cell list parsed for `document_key`, as a recipe list.  The
+        recipe has the strings of the list as they are, and has a tuple
+        `(cell_hash, starting_line_number, ending_line_number, output_inset_text,
+        following_inset)` in place of each cell (which must be in the cell
+        cache).  If too many cells are cached, those not in the document are
+        dropped."""
+        self.document_key = document_key
+        self.document_recipe = document_recipe
+        if len(self.cells_by_hash) > self.max_cached_cells:
+            document_hashes = {piece[0] for piece in document_recipe
+                               if not isinstance(piece, str)}
+            self.cells_by_hash = {cell_hash: cached for cell_hash, cached
+                                  in self.cells_by_hash.items()
+                                  if cell_hash in document_hashes}
+
+    def get_cell(self, cell_hash):
+        """Return a copy of the cell cached for the hash and its cookie counts as
+        a tuple `(cell, cookie_lines_in_cell, cookie_lines_total)`, or `None`."""
+        cached = self.cells_by_hash.get(cell_hash)
+        if cached is None:
+            return None
+        self.num_cells_reused += 1
+        cell, cookie_lines_in_cell, cookie_lines_total = cached
+        return copy_parsed_cell(cell), cookie_lines_in_cell, cookie_lines_total
+
+    def set_cell(self, cell_hash, cell, cookie_lines_in_cell, cookie_lines_total):
+        """Cache a newly-parsed cell and its cookie counts.  The cell itself is
+        kept, so the caller should use a copy."""
+        self.num_cells_parsed += 1
+        if len(self.cells_by_hash) >= 2 * self.max_cached_cells:
+            self.cells_by_hash.clear()
+            self.document_key = None # Its recipe could refer to the cleared cells.
+        self.cells_by_hash[cell_hash] = (cell, cookie_lines_in_cell, cookie_lines_total)
+
+
+def copy_parsed_cell(cell):
+    """Return a copy of `cell` (or of a string, which is immutable) whose line
+    lists can be modified without changing the original.  Line lists which
+    haven't been made yet are left to be made from the shared inset lines."""
+    if isinstance(cell, str):
+        return cell
+    new_cell = Cell.__new__(Cell) # Much faster than `copy.copy`.
+    for slot in Cell.__slots__:
+        value = getattr(cell, slot)
+        if isinstance(value, list) and slot != "_inset_lines":
+            value = list(value)
+        setattr(new_cell, slot, value)
+    return new_cell
+
+
+def read_cell_inset_lines(begin_line, lyx_line_iter):
+    r"""Read the lines of a cell inset from the iterator `lyx_line_iter`, starting
+    just after the `\begin_inset` line `begin_line` and ending with the empty
+    line after its `\end_inset` line.  Returns the lines in a list, starting
+    with `begin_line`.  An `\end_inset` inside a Plain Layout belongs to an
+    inset nested in the cell text (like a quote inset) and is skipped over."""
+    cell_lines = [begin_line]
+    inside_plain_layout = False
+    for lyx_line in lyx_line_iter:
+        cell_lines.append(lyx_line)
+        rstripped_line = lyx_line.rstrip()
+        if inside_plain_layout:
+            if rstripped_line == r"\end_layout":
+                inside_plain_layout = False
+        elif rstripped_line == r"\begin_layout Plain Layout":
+            inside_plain_layout = True
+        elif rstripped_line == r"\end_inset":
+            cell_lines.append(next(lyx_line_iter, "")) # The empty line after it.
+            break
+    return cell_lines
+
+
+def generate_text_lines_from_lyx_code_lines(lyx_code_lines):
+    r"""Generate the lines of text of a cell from its Lyx-format code lines.
+    Individual lines of the inset are each spread across several lines as
+    substrings, between a `\begin_layout Plain Layout` line and an
+    `\end_layout` line (each followed by an empty line)."""
+    lyx_code_line_iter = iter(lyx_code_lines)
+    for lyx_line in lyx_code_line_iter:
+        if lyx_line.rstrip() != r"\begin_layout Plain Layout":
+            continue
+        next(lyx_code_line_iter, "") # The empty line after the begin_layout.
+        cell_line_list = []
+        for lyx_line in lyx_code_line_iter:
+            if lyx_line.rstrip() == r"\end_layout":
+                break
+            cell_line_list.append(lyx_line.rstrip("\n")) # drop trailing \n
+        next(lyx_code_line_iter, "") # The empty line after the end_layout.
+        yield lyx_format_code_line_to_text(cell_line_list)
+
+
+def parse_cell_inset_lines(basic_type, lang, cell_lines, magic_cookie_string):
+    r"""Create a `Cell` from the lines of a cell inset, as returned by
+    `read_cell_inset_lines`.  Returns a tuple
+    `(cell, cookie_lines_in_cell, cookie_lines_total)` where the last two
+    items count the lines with the magic cookie at the start of a line and
+    anywhere in a line.
+
+    Only the places where the code lines and ending lines start are found
+    here.  The text lines are made here only when the cookie might be in
+    them, since it has to be found and removed; otherwise the cell makes them
+    when they are used."""
+    num_lines = len(cell_lines)
+    code_start = 1
+    while (code_start < num_lines and
+               cell_lines[code_start].rstrip() != r"\begin_layout Plain Layout"
+               and cell_lines[code_start].rstrip() != r"\end_inset"):
+        code_start += 1
+    ending_start = num_lines - 2 if num_lines >= 2 else num_lines
+    if (ending_start < code_start
+            or cell_lines[ending_start].rstrip() != r"\end_inset"):
+        ending_start = max(code_start, num_lines) # A truncated inset.
+    new_cell = Cell(basic_type, lang, cell_lines, code_start, ending_start)
+    cookie_lines_in_cell = 0
+    cookie_lines_total = 0
+
+    # The cookie can only be in the text if it is in the joined Lyx-format code
+    # lines, unless it has characters which are escaped in the Lyx format.
+    if (magic_cookie_string in "".join(cell_lines[code_start:ending_start])
+            or "\\" in magic_cookie_string or '"' in magic_cookie_string):
+        text_code_lines = []
+        for text_line in generate_text_lines_from_lyx_code_lines(
+                                        cell_lines[code_start:ending_start]):
+            cookie_find_index = text_line.find(magic_cookie_string)
+            if cookie_find_index == 0: # Cell cookies must begin lines.
+                new_cell.has_cookie_inside = True
+                cookie_lines_in_cell += 1
+                text_line = text_line.replace(magic_cookie_string, "", 1) # Replace one occurence.
+            if cookie_find_index != -1:
+                cookie_lines_total += 1
+            text_code_lines.append(text_line)
+        new_cell.text_code_lines = text_code_lines
+
+    return new_cell, cookie_lines_in_cell, cookie_lines_total
+
 
 def get_all_cell_text_from_lyx_string(lyx_string, magic_cookie_string, *,
                                       code_language=None, init=True, standard=True,
-                                      also_noncell=False):
+                                      also_noncell=False, parse_cache=None,
+                                      cell_index=None, allow_cookie=False):
     """Read all the code cell text from the Lyx file format string `string`.  Return
     a list of `Cell` class instances, where each cell is a list of lines (and
     some additional data) corresponding to the lines of a code cell in the
     document (in the order that they appear in the document).  All cell types
-    are included by default except output cells.
+    are included by default except output cells.  The string is scanned by
+    `scan_lyx_string_for_cell_insets` and the arguments are described in
+    `generate_cells_from_lyx_lines`.
+
+    If a `CellParseCache` instance is passed as `parse_cache` then an
+    unchanged document, and the unchanged cells of a changed document, are
+    copied from the cache rather than parsed again."""
+    if parse_cache:
+        document_key = (parse_cache.text_hash(lyx_string), magic_cookie_string,
+                        code_language, init, standard, also_noncell)
+        cell_list = parse_cache.get_document(document_key)
+        if cell_list is not None:
+            if cell_index is not None:
+                for list_index, cell in enumerate(cell_list):
+                    if not isinstance(cell, str):
+                        cell_index.add_cell(cell, list_index)
+            return cell_list
+
+    if any(char in lyx_string for char in other_line_break_chars):
+        # The scanner only splits lines at "\n", like Lyx, but `splitlines` also
+        # splits at other characters; keep to what the line parser does.
+        cell_insets = scan_lyx_lines_for_cell_insets(lyx_string.splitlines(),
+                            magic_cookie_string, code_language=code_language,
+                            init=init, standard=standard, keep_text=also_noncell)
+    else:
+        cell_insets = scan_lyx_string_for_cell_insets(lyx_string,
+                            magic_cookie_string, code_language=code_language,
+                            init=init, standard=standard, keep_text=also_noncell)
+
+    document_recipe = [] if parse_cache else None
+    cell_list = list(generate_cells_from_cell_insets(cell_insets, magic_cookie_string,
+                            also_noncell=also_noncell, parse_cache=parse_cache,
+                            cell_index=cell_index, allow_cookie=allow_cookie,
+                            document_recipe=document_recipe))
+    if parse_cache:
+        parse_cache.set_document(document_key, document_recipe)
+    return cell_list
+
+
+def generate_cells_from_lyx_file(filename, magic_cookie_string, **kwargs):
+    """Generate the cells of the Lyx file `filename`, reading it a line at a time
+    (and waiting for a writer to finish it, as with `TerminatedFile`).  The
+    keyword arguments are those of `generate_cells_from_lyx_lines`."""
+    lyx_file = TerminatedFile(filename, r"\end_document",
+                              err_msg_location="generate_cells_from_lyx_file")
+    try:
+        lyx_lines = (line[:-1] if line.endswith("\n") else line
+                     for line in iter(lyx_file.readline, ""))
+        yield from generate_cells_from_lyx_lines(lyx_lines, magic_cookie_string,
+                                                 **kwargs)
+    finally:
+        lyx_file.close()
+
+
+def generate_cells_from_lyx_lines(lyx_lines, magic_cookie_string, *,
+                                  code_language=None, init=True, standard=True,
+                                  also_noncell=False, parse_cache=None,
+                                  cell_index=None, allow_cookie=False,
+                                  document_recipe=None):
+    """A generator which parses the Lyx-format lines of the iterable `lyx_lines`
+    (without their newlines) and yields a `Cell` instance for each code cell,
+    in the order they appear in the document.  Only a cell at a time is held
+    in memory, so callers can work on each cell as soon as it is parsed.
 
     The `code_language` option, if set, will extract only cells of the given
     language.  The string passed in should be the capitalized name that appears
-    at the end of the inset's name in the Lyx file, e.g., "Python".
-
-    If `also_noncell` is true then the returned list will contain `Cell`
-    instances alternating with strings holding the text in the .lyx file that
-    is between the cells.  This allows the file to be put back together with
-    modified cells."""
-    lyx_format_lines = list(reversed(lyx_string.splitlines())) # Reversed, pop off end.
-
-    cell_list = []                   # A list of the extracted cells as `Cell` instances.
-    inside_cell = False              # Inside a lyxnotebook cell of any type.
-    inside_cell_plain_layout = False # Inside a Plain Layout inside a cell.
-    inside_cell_text_part = False    # After the first Plain Layout inside a cell.
+    at the end of the inset's name in the Lyx file, e.g., "Python".  The
+    `init` and `standard` flags select the basic cell types.  Output cells are
+    treated as text.
+
+    If `also_noncell` is true then the cells alternate with strings holding
+    the text in the .lyx file that is between the cells.  This allows the file
+    to be put back together with modified cells.
+
+    If a `CellParseCache` instance is passed as `parse_cache` then the cells
+    whose text is unchanged since an earlier parse are copied from the cache;
+    the `document_recipe` list, if passed, is filled in for the cache (see
+    `CellParseCache.set_document`).  If an empty `CellIndex` instance is passed
+    as `cell_index` then the cells are added to it.
+
+    When the lines run out a warning is given if the magic cookie was found in
+    more places than it should be.  Setting `allow_cookie` allows one cookie
+    even when using the inset-edit method (which does not otherwise use
+    cookies)."""
+    cell_insets = scan_lyx_lines_for_cell_insets(lyx_lines, magic_cookie_string,
+                            code_language=code_language, init=init,
+                            standard=standard, keep_text=also_noncell)
+    yield from generate_cells_from_cell_insets(cell_insets, magic_cookie_string,
+                            also_noncell=also_noncell, parse_cache=parse_cache,
+                            cell_index=cell_index, allow_cookie=allow_cookie,
+                            document_recipe=document_recipe)
+
+#
+# Scanners, which find the cell insets of a document.
+#
+# A scanner generates a tuple `(text, cookie_lines, cell_inset)` for each cell
+# inset that is parsed, where `text` is the text before the inset since the
+# last one (or `None` if `keep_text` is false) and `cookie_lines` is the number
+# of lines in that text with the magic cookie.  The `cell_inset` is a tuple
+# `(basic_type, language, cell_lines, starting_line_number, output_text,
+# following_inset)`, with the `cell_lines` as returned by
+# `read_cell_inset_lines`, the `output_text` of the Output inset immediately
+# following the cell inset (its lines, read the same way, joined with newlines)
+# or `None` if there isn't one, and the `following_inset` as returned by
+# `get_following_inset_kind`.  The last tuple has the text after the last inset
+# and `None` for `cell_inset`.  The cell insets of the basic types and language
+# not selected, and all Output insets, are kept in the text.
+#
+
+def is_selected_cell_type(basic_type, lang, code_language, init, standard):
+    """Return whether cells of the type `(basic_type, lang)` are to be parsed,
+    given the `code_language`, `init` and `standard` options of the scanners."""
+    if code_language and lang != code_language:
+        return False
+    return not (basic_type == "Output" or basic_type == "Standard" and not standard
+                                       or basic_type == "Init" and not init)
+
+
+def scan_lyx_lines_for_cell_insets(lyx_lines, magic_cookie_string, *,
+                                   code_language=None, init=True, standard=True,
+                                   keep_text=True):
+    """The scanner which looks at every line of the iterable `lyx_lines`, for
+    use with a file read a line at a time."""
+    lyx_line_iter = PushbackLineIterator(lyx_lines)
     text_between_cells = []
-    cookie_lines_in_cells = 0
-    cookie_lines_total = 0
+    cookie_lines = 0
     line_num = -1
-    while True:
-        if not lyx_format_lines:
-            break
-        lyx_line = lyx_format_lines.pop()
+    for lyx_line in lyx_line_iter:
         line_num += 1
-        rstripped_line = lyx_line.rstrip()
 
         # To get code cells search for lines starting with something like
         #    \begin_inset Flex LyxNotebookCell:Standard:PythonTwo
-        # Those begin the inset, but individual lines of the inset are each
-        # spread across several lines as substrings, between a
-        # `\begin_layout Plain Layout` line and an `\end_layout` line.
 
-        if rstripped_line.startswith(r"\begin_inset Flex LyxNotebookCell:"):
-            basic_type, lang = get_cell_type_from_inset_begin_line(rstripped_line)
+        if lyx_line.startswith(r"\begin_inset Flex LyxNotebookCell:"):
+            basic_type, lang = get_cell_type_from_inset_begin_line(lyx_line.rstrip())
 
             # Treat cells as normal text if 1) Output cell, 2) language doesn't match,
             # 3) Basic type doesn't match.
-            if code_language and lang != code_language:
-                text_between_cells.append(lyx_line)
+            if not is_selected_cell_type(basic_type, lang, code_language, init,
+                                         standard):
+                if keep_text:
+                    text_between_cells.append(lyx_line)
                 continue
-            if (basic_type=="Output" or basic_type=="Standard" and not standard
-                                     or basic_type=="Init" and not init):
-                text_between_cells.append(lyx_line)
-                continue
-
-            # Create a new cell.
-            new_cell = Cell(basic_type, lang) # create a new cell
-            new_cell.starting_line_number = line_num
-            new_cell.lyx_starting_lines.append(lyx_line)
 
-            # Save previous text between cells and reset list to empty.
-            if also_noncell:
-                cell_list.append("\n".join(text_between_cells))
+            cell_lines = read_cell_inset_lines(lyx_line, lyx_line_iter)
+            read_lines = []
+            following_inset, output_lines = read_following_inset_lines(lyx_line_iter,
+                                                                       read_lines)
+            lyx_line_iter.pushback(read_lines) # Scan them again, as text.
+            output_text = "\n".join(output_lines) if output_lines else None
+            text = "\n".join(text_between_cells) if keep_text else None
+            yield text, cookie_lines, (basic_type, lang, cell_lines, line_num,
+                                       output_text, following_inset)
+            line_num += len(cell_lines) - 1
             text_between_cells = []
-
-            # Update states.
-            inside_cell = True
-            inside_cell_text_part = False
-            inside_cell_plain_layout = False
-
-        elif inside_cell:
-            if rstripped_line == r"\end_inset":
-                new_cell.lyx_ending_lines.append(lyx_line)
-                new_cell.ending_line_number = line_num + 1 # Count the blank line after.
-
-                # Read the empty line that follows an end_inset.
-                next_line = lyx_format_lines.pop()
-                assert next_line.rstrip() == ""
-                new_cell.lyx_ending_lines.append(next_line)
-
-                cell_list.append(new_cell) # Finished creating the cell.
-                #print("\nDEBUG original text was:\n", new_cell.lyx_string_format(), sep="")
-
-                inside_cell = False
-                inside_cell_text_part = False
-
-            elif rstripped_line == r"\begin_layout Plain Layout":
-                new_cell.lyx_code_lines.append(lyx_line)
-                inside_cell_plain_layout = True
-                inside_cell_text_part = True
-
-            elif inside_cell_plain_layout: # An actual line of cell text, on several lines.
-                new_cell.lyx_code_lines.append(lyx_line)
-                cell_line = lyx_line.rstrip("\n") # Could rstrip all whitespace.
-                cell_line_list = []
-                while True:
-                    if cell_line.rstrip() == r"\end_layout":
-                        inside_cell_plain_layout = False
-
-                        # Read the empty line that follows an end_inset.
-                        next_line = lyx_format_lines.pop()
-                        assert next_line.rstrip() == ""
-                        new_cell.lyx_code_lines.append(next_line)
-                        break
-
-                    next_line = lyx_format_lines.pop()
-                    new_cell.lyx_code_lines.append(next_line)
-                    cell_line = next_line.rstrip("\n") # drop trailing \n
-                    cell_line_list.append(cell_line) # drop trailing \n
-                    line_num += 1
-
-                lyx_line = lyx_format_code_line_to_text(cell_line_list)
-                cookie_find_index = lyx_line.find(magic_cookie_string)
-                if cookie_find_index == 0: # Cell cookies must begin lines.
-                    new_cell.has_cookie_inside = True
-                    cookie_lines_in_cells += 1
-                    lyx_line = lyx_line.replace(magic_cookie_string, "", 1) # Replace one occurence.
-                if cookie_find_index != -1:
-                    cookie_lines_total += 1
-
-                new_cell.text_code_lines.append(lyx_line) # Got a text line, append it.
-
-            else:
-                new_cell.lyx_starting_lines.append(lyx_line)
+            cookie_lines = 0
 
         else: # Got an ordinary Lyx file line.
-            text_between_cells.append(lyx_line)
+            if keep_text:
+                text_between_cells.append(lyx_line)
             if lyx_line.find(magic_cookie_string) != -1: # found cookie anywhere on line
-                cookie_lines_total += 1
+                cookie_lines += 1
+
+    yield "\n".join(text_between_cells) if keep_text else None, cookie_lines, None
+
+
+class PushbackLineIterator:
+    """An iterator over the lines of the iterable `lyx_lines` which lines that
+    were read ahead can be pushed back onto, to be generated again."""
+
+    def __init__(self, lyx_lines):
+        self.lyx_line_iter = iter(lyx_lines)
+        self.pushed_back_lines = [] # In reverse order, the next one last.
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.pushed_back_lines:
+            return self.pushed_back_lines.pop()
+        return next(self.lyx_line_iter)
+
+    def pushback(self, lines):
+        """Push back the list `lines`, to be generated next in the same order."""
+        self.pushed_back_lines.extend(reversed(lines))
+
+
+def read_following_inset_lines(lyx_line_iter, read_lines):
+    r"""Find what immediately follows a cell inset, reading from the iterator
+    `lyx_line_iter` just after the lines of the cell inset (as read by
+    `read_cell_inset_lines`).  Returns a tuple `(following_inset,
+    output_lines)` with the kind of what follows, as returned by
+    `get_following_inset_kind`, and the lines of the Output inset which
+    follows (or `None` if there isn't one).  All the lines taken from the
+    iterator are appended to the list `read_lines`."""
+    next_lines = list(itertools.islice(lyx_line_iter, 2))
+    read_lines.extend(next_lines)
+    following_inset = get_following_inset_kind(*next_lines, *[None] * (2-len(next_lines)))
+    if following_inset != "output":
+        return following_inset, None
+    return following_inset, read_cell_inset_lines(next_lines[1],
+                                 generate_and_keep_lines(lyx_line_iter, read_lines))
+
+
+def get_following_inset_kind(next_line, line_after):
+    r"""Return what immediately follows a cell inset, given the two lines after
+    the lines of the inset (as read by `read_cell_inset_lines`), either of which
+    is `None` at the end of the file.  Lyx writes an inset which follows as an
+    empty line and a `\begin_inset` line.  The result is "output" for an Output
+    inset, "math" for a math (Formula) inset, "other" for any other inset, and
+    "none" for ordinary text or the end of the paragraph.  Anything else, like
+    a Lyx command line changing the font, gives "other", so that the writeback
+    will probe the document rather than rely on it."""
+    if next_line is None:
+        return "none"
+    if next_line != "":
+        return "other" if next_line.startswith("\\") else "none" # Text follows.
+    if line_after is None or line_after.rstrip() == r"\end_layout":
+        return "none"
+    if line_after.startswith(output_begin_prefix):
+        return "output"
+    if line_after.startswith(r"\begin_inset Formula"):
+        return "math"
+    return "other"
+
+
+def generate_and_keep_lines(lyx_line_iter, kept_lines):
+    """Generate the lines of `lyx_line_iter`, appending each one to the list
+    `kept_lines`."""
+    for lyx_line in lyx_line_iter:
+        kept_lines.append(lyx_line)
+        yield lyx_line
+
+
+# The start of a line beginning a cell inset.  The regex matches the newline
+# before it, since a literal pattern is searched for much faster than with `^`.
+cell_begin_prefix = r"\begin_inset Flex LyxNotebookCell:"
+cell_begin_regex = re.compile(r"\n\\begin_inset Flex LyxNotebookCell:")
+
+# The start of a line beginning an Output inset, and the same after an empty line.
+output_begin_prefix = cell_begin_prefix + "Output:"
+output_begin_after_blank_line = "\n" + output_begin_prefix
+
+# The characters other than "\n" which `str.splitlines` splits lines at.
+other_line_break_chars = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+
+
+def scan_lyx_string_for_cell_insets(lyx_string, magic_cookie_string, *,
+                                    code_language=None, init=True, standard=True,
+                                    keep_text=True):
+    """The scanner for a whole document in the string `lyx_string`.  A regex
+    search jumps from one cell inset to the next, and only the lines of the
+    cell insets are looked at one by one.  The text between the insets is
+    handled in bulk: the range of it in `lyx_string` is found, its lines are
+    counted with `str.count`, and the magic cookie is searched for in the
+    whole range at once.  The string should only have "\n" line breaks."""
+    string_len = len(lyx_string)
+    text_start = 0 # The index in lyx_string where the current text range starts.
+    line_num = 0   # The line number at index `text_start`.
+    search_pos = 0
+    while True:
+        if search_pos == 0 and lyx_string.startswith(cell_begin_prefix):
+            begin_start = 0
+        else:
+            match = cell_begin_regex.search(lyx_string, max(search_pos - 1, 0))
+            if not match:
+                break
+            begin_start = match.start() + 1
+        begin_end = lyx_string.find("\n", begin_start)
+        if begin_end == -1:
+            begin_end = string_len
+        begin_line = lyx_string[begin_start:begin_end]
+        basic_type, lang = get_cell_type_from_inset_begin_line(begin_line.rstrip())
+        if not is_selected_cell_type(basic_type, lang, code_language, init, standard):
+            search_pos = begin_end # Leave it in the text.
+            continue
+
+        # The text is the lines from `text_start` up to the newline before the
+        # begin line (or empty).
+        text_end = max(begin_start - 1, text_start)
+        text = lyx_string[text_start:text_end] if keep_text else None
+        cookie_lines = count_cookie_lines(lyx_string, text_start, text_end,
+                                          magic_cookie_string)
+        line_num += lyx_string.count("\n", text_start, begin_start)
+        cell_lines, next_line_start = scan_cell_inset_lines(lyx_string,
+                                                   begin_line, begin_end + 1)
+        output_text = None
+        following_inset = get_following_inset_kind(*peek_two_lines(lyx_string,
+                                                                   next_line_start))
+        if lyx_string.startswith(output_begin_after_blank_line, next_line_start):
+            output_begin_start = next_line_start + 1
+            output_begin_end = lyx_string.find("\n", output_begin_start)
+            if output_begin_end == -1:
+                output_begin_end = string_len
+            output_text = "\n".join(scan_cell_inset_lines(lyx_string,
+                                lyx_string[output_begin_start:output_begin_end],
+                                output_begin_end + 1)[0])
+        yield text, cookie_lines, (basic_type, lang, cell_lines, line_num, output_text,
+                                   following_inset)
+        line_num += len(cell_lines) - 1
+        if next_line_start <= string_len:
+            line_num += 1 # Count the newline ending the inset's last line.
+        text_start = search_pos = min(next_line_start, string_len)
+
+    # Like `splitlines`, don't count a final newline as starting another line.
+    text_end = string_len - 1 if lyx_string.endswith("\n") else string_len
+    text_end = max(text_end, text_start)
+    text = lyx_string[text_start:text_end] if keep_text else None
+    yield text, count_cookie_lines(lyx_string, text_start, text_end,
+                                   magic_cookie_string), None
+
+
+def scan_cell_inset_lines(lyx_string, begin_line, line_start):
+    r"""Call `read_cell_inset_lines` on the lines of `lyx_string` starting at
+    the index `line_start`, which should be just after the `\begin_inset` line
+    `begin_line`.  Returns a tuple `(cell_lines, next_line_start)` where
+    `next_line_start` is the index just after the newline ending the inset
+    (more than `len(lyx_string)` if there isn't one)."""
+    cell_lines = read_cell_inset_lines(begin_line,
+                              generate_lines_in_chunks(lyx_string, line_start))
+    inset_len = sum(map(len, cell_lines)) - len(begin_line) + len(cell_lines) - 1
+    return cell_lines, line_start + inset_len
+
+
+def peek_two_lines(lyx_string, line_start):
+    """Return a tuple of the two lines of `lyx_string` starting at the index
+    `line_start`, split as `splitlines` would, with `None` for a line past the
+    end of the string."""
+    string_len = len(lyx_string)
+    if lyx_string.endswith("\n"):
+        string_len -= 1 # Like `splitlines`, don't start a line after the last newline.
+    lines = []
+    while len(lines) < 2 and line_start <= string_len:
+        line_end = lyx_string.find("\n", line_start, string_len)
+        if line_end == -1:
+            line_end = string_len
+        lines.append(lyx_string[line_start:line_end])
+        line_start = line_end + 1
+    return tuple(lines) + (None,) * (2 - len(lines))
+
+
+def generate_lines_in_chunks(lyx_string, line_start):
+    r"""Generate the lines of `lyx_string` from the index `line_start` on, as
+    `splitlines` would.  The string is split a chunk at a time, each chunk
+    running through the line after the next `\end_inset` line, so that only a
+    little more than one inset is split when reading an inset."""
+    string_len = len(lyx_string)
+    if lyx_string.endswith("\n"):
+        string_len -= 1 # Like `splitlines`, don't start a line after the last newline.
+    while line_start <= string_len:
+        chunk_end = lyx_string.find("\n\\end_inset", line_start, string_len)
+        if chunk_end != -1:
+            chunk_end = lyx_string.find("\n", chunk_end + 1, string_len) # Its end.
+        if chunk_end != -1:
+            chunk_end = lyx_string.find("\n", chunk_end + 1, string_len) # Next line.
+        if chunk_end == -1:
+            chunk_end = string_len
+        yield from lyx_string[line_start:chunk_end].split("\n")
+        line_start = chunk_end + 1
+
+
+def count_cookie_lines(lyx_string, start, end, magic_cookie_string):
+    """Return the number of lines of the text `lyx_string[start:end]` with the
+    magic cookie in them, not counting the lines beginning cell insets (as in
+    `scan_lyx_lines_for_cell_insets`).  Text without the cookie is only
+    searched once."""
+    if end <= start or lyx_string.find(magic_cookie_string, start, end) == -1:
+        return 0
+    return sum(1 for line in lyx_string[start:end].split("\n")
+               if magic_cookie_string in line
+                   and not line.startswith(cell_begin_prefix))
+
+
+def generate_cells_from_cell_insets(cell_insets, magic_cookie_string, *,
+                                    also_noncell=False, parse_cache=None,
+                                    cell_index=None, allow_cookie=False,
+                                    document_recipe=None):
+    """Generate the cells (and text, if `also_noncell`) from the tuples of the
+    iterable `cell_insets`, which come from one of the scanners.  The
+    arguments are described in `generate_cells_from_lyx_lines`."""
+    list_index = 0                   # The index of the next item in the full list.
+    cookie_lines_in_cells = 0
+    cookie_lines_total = 0
+    for text, text_cookie_lines, cell_inset in cell_insets:
+        cookie_lines_total += text_cookie_lines
+
+        # Yield the text before the cell (or the final text).
+        if also_noncell:
+            if document_recipe is not None:
+                document_recipe.append(text)
+            list_index += 1
+            yield text
+        if cell_inset is None:
+            break
 
-    # Add the final text piece if `also_noncell` is true.
-    if also_noncell:
-        cell_list.append("\n".join(text_between_cells))
+        # Get the cell, from the cache if its text is unchanged.
+        (basic_type, lang, cell_lines, starting_line_number, output_text,
+                                                          following_inset) = cell_inset
+        parsed = None
+        if parse_cache:
+            cell_hash = parse_cache.text_hash(
+                    "\n".join([*cell_lines, magic_cookie_string]))
+            parsed = parse_cache.get_cell(cell_hash)
+        if parsed is None:
+            parsed = parse_cell_inset_lines(basic_type, lang, cell_lines,
+                                            magic_cookie_string)
+            if parse_cache:
+                parse_cache.set_cell(cell_hash, *parsed)
+                parsed = (copy_parsed_cell(parsed[0]),) + parsed[1:]
+        new_cell, cell_cookie_lines_in_cell, cell_cookie_lines_total = parsed
+        cookie_lines_in_cells += cell_cookie_lines_in_cell
+        cookie_lines_total += cell_cookie_lines_total
+        ending_line_number = starting_line_number + len(cell_lines) - 1
+        new_cell.starting_line_number = starting_line_number
+        new_cell.ending_line_number = ending_line_number # Count the blank line after.
+        new_cell.output_inset_text = output_text
+        new_cell.following_inset = following_inset
+
+        # Finished creating the cell.
+        if cell_index is not None:
+            cell_index.add_cell(new_cell, list_index)
+        if document_recipe is not None:
+            document_recipe.append((cell_hash, starting_line_number,
+                                    ending_line_number, output_text, following_inset))
+        list_index += 1
+        yield new_cell
 
     # Do an error-check on the number of cookies found in the files.
     using_inset_edit_method = (config_dict["has_editable_insets_noeditor_mod"]
                                and config_dict["has_editable_insets"])
-    if (using_inset_edit_method and cookie_lines_total > 0) or cookie_lines_total > 1:
+    max_cookie_lines = 0 if using_inset_edit_method and not allow_cookie else 1
+    if cookie_lines_total > max_cookie_lines:
         gui.text_warning_popup("Warning: Multiple cookies were found in the file.\n\n"
                             "This can cause problems with cell-goto operations.")
     if not using_inset_edit_method and cookie_lines_in_cells > 1:
         gui.text_warning_popup("Warning: Multiple cookies were found in Lyx Notebook\n"
                             "cells in the file.\n\n"
                             "This will cause problems with cell evaluations.")
-    return cell_list
 
 def write_lyx_file_from_cell_list(to_file_name, all_cells):
     """Write out a .lyx file from the text in the list `all_cells`, which should
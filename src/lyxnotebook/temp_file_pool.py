@@ -0,0 +1,82 @@
+"""
+=========================================================================
+This file is part of LyX Notebook, which works with LyX but is an
+independent project.  License details (MIT) can be found in the file
+COPYING.
+
+Copyright (c) 2012 Allen Barker
+=========================================================================
+
+This module contains the class `TempFilePool`, a pool of reusable temporary
+files for passing text to Lyx.  New text is put into a cell by writing it to a
+file and sending the `file-insert-plaintext` LFUN with the file's name, so a
+multi-cell evaluation writes a file for every cell.
+
+The files of a pool are in a private directory (readable only by the user),
+made on a tmpfs (memory) filesystem when one is available, so the text never
+goes to a disk.  A file is created the first time it is needed and after that
+it is truncated and rewritten in place rather than deleted and created again.
+The directory and its files are removed when the pool is closed, or at exit.
+
+Typical use::
+
+    filename = pool.acquire()
+    try:
+        with open(filename, "w") as f:
+            f.write(text)
+        ... # Have Lyx read the file.
+    finally:
+        pool.release(filename)
+
+"""
+
+import os
+import atexit
+import shutil
+import tempfile
+
+
+class TempFilePool:
+    """A pool of reusable temporary files, in a directory made in the first
+    writable directory of `parent_dirs` (the system temporary directory if none
+    are writable)."""
+
+    def __init__(self, parent_dirs, prefix="lyxnotebook_files_"):
+        self.parent_dirs = parent_dirs
+        self.prefix = prefix
+        self.directory = None  # Made when the first file is needed.
+        self.free_filenames = [] # Files which can be reused.
+        self.num_files = 0
+
+    def make_directory(self):
+        """Make the private directory for the files, and have it removed at exit."""
+        for parent_dir in self.parent_dirs:
+            if parent_dir and os.access(parent_dir, os.W_OK):
+                break
+        else:
+            parent_dir = None # Use the default temporary directory.
+        self.directory = tempfile.mkdtemp(prefix=self.prefix, dir=parent_dir)
+        atexit.register(shutil.rmtree, self.directory, ignore_errors=True)
+
+    def acquire(self):
+        """Return the name of a file which isn't in use, for writing.  The file
+        may have old contents, so it should be opened with mode "w" to truncate
+        it."""
+        if self.free_filenames:
+            return self.free_filenames.pop()
+        if self.directory is None:
+            self.make_directory()
+        self.num_files += 1
+        return os.path.join(self.directory, "file{}.txt".format(self.num_files))
+
+    def release(self, filename):
+        """Return the file `filename`, from `acquire`, to the pool for reuse."""
+        self.free_filenames.append(filename)
+
+    def close(self):
+        """Remove the directory and all the files.  The pool can still be used
+        afterward, with a new directory."""
+        if self.directory is not None:
+            shutil.rmtree(self.directory, ignore_errors=True)
+        self.directory = None
+        self.free_filenames = []
@@ -0,0 +1,141 @@
+"""
+
+Benchmark the latency of Lyx Notebook user commands, from the key press to the
+last change being made in the document, without a running Lyx.
+
+The commands are run through `ControllerOfLyxAndInterpreters.respond_to_key_action`
+against a `MockLyxServer` (see `mock_lyx_server.py`) holding either a synthetic
+document of Python cells or a .lyx file given on the command line.  The cells
+are evaluated by real interpreters, so the cells of a .lyx file given here
+should be in a language whose interpreter is installed.  For each command the
+time per run and the number of LFUNs sent to the server per run are reported.
+
+Run from the top-level directory as::
+
+    python test/benchmark_key_actions.py [--lyx-file FILE] [--num-cells N]
+                                         [--repeats N] [--reply-delay SECS]
+                                         [--lfun-report]
+
+"""
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+
+from lyxnotebook.config_file_processing import config_dict, initialize_config_data
+from mock_lyx_server import MockLyxServer, make_lyx_document
+
+# The commands to time, and whether the cursor starts inside a code cell.
+key_actions_to_time = [
+        ("goto next any cell", False),
+        ("goto prev any cell", False),
+        ("goto next code cell", False),
+        ("open all cells", False),
+        ("close all cells", False),
+        ("evaluate current cell", True),
+        ("evaluate all code cells", False),
+        ("write all code cells to files", False),
+        ]
+
+
+def time_key_action(controller, server, key_action, cursor_in_cell, repeats):
+    """Return the list of run times for the key action, and the mean number
+    of LFUNs sent to the server for each run."""
+    code_cells = server.cells(basic_types=("Init", "Standard"))
+    times = []
+    start_num_commands = server.num_commands
+    for i in range(repeats):
+        # Start from a middle cell, so the goto commands have somewhere to go.
+        server.put_cursor_at_cell(code_cells[len(code_cells)//2], inside=cursor_in_cell)
+        start = time.perf_counter()
+        controller.respond_to_key_action(key_action)
+        controller.lyx_process.finish_pending_lfuns()
+        times.append(time.perf_counter() - start)
+    return times, (server.num_commands - start_num_commands) / repeats
+
+
+def print_summary(label, times, lfuns_per_run):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    median = times[len(times)//2]
+    print("{:<32} mean {:9.2f} ms   median {:9.2f} ms   max {:9.2f} ms   LFUNs {:6.1f}"
+          .format(label, 1000*mean, 1000*median, 1000*times[-1], lfuns_per_run))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--lyx-file", default=None,
+                        help="The .lyx document to use; default is a synthetic one.")
+    parser.add_argument("--num-cells", type=int, default=10,
+                        help="Number of code cells in the synthetic document.")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="Number of times to run each command.")
+    parser.add_argument("--reply-delay", type=float, default=0.0,
+                        help="Simulated Lyx processing time per LFUN, in seconds.")
+    parser.add_argument("--lfun-report", action="store_true",
+                        help="Also print the LFUN timing report for the commands.")
+    args = parser.parse_args()
+
+    # Set up a Lyx user directory holding the default config file.
+    tmp_dir = tempfile.mkdtemp(prefix="lyxnotebook_bench_")
+    shutil.copy(os.path.join(config_dict["lyx_notebook_source_dir"],
+                             "default_config_file_and_data_files",
+                             "default_config_file.cfg"),
+                os.path.join(tmp_dir, "lyxnotebook.cfg"))
+    initialize_config_data(tmp_dir)
+    config_dict["lyx_server_pipe"] = os.path.join(tmp_dir, "lyxpipe")
+    config_dict["lyx_temporary_directory"] = tmp_dir
+
+    buffer_filename = os.path.join(tmp_dir, "benchmark_document.lyx")
+    if args.lyx_file:
+        shutil.copy(args.lyx_file, buffer_filename)
+    else:
+        with open(buffer_filename, "w") as lyx_file:
+            lyx_file.write(make_lyx_document(args.num_cells))
+    server = MockLyxServer(config_dict["lyx_server_pipe"], lyx_filename=buffer_filename,
+                           reply_delay=args.reply_delay)
+
+    # Import after the config is set up, since some modules read it on import.
+    from lyxnotebook.controller_of_lyx_and_interpreters import \
+                                             ControllerOfLyxAndInterpreters
+    old_cwd = os.getcwd()
+    os.chdir(tmp_dir) # Lyx Notebook writes some files to the current directory.
+    controller = ControllerOfLyxAndInterpreters("benchmarkClient")
+
+    # Start the interpreters up before timing, by evaluating the cells once.
+    print("\nWarming up the interpreters.")
+    saved_stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        controller.respond_to_key_action("evaluate all code cells")
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved_stdout
+    controller.lyx_process.lfun_timing_stats.reset()
+
+    print("\nTiming {} runs of each command, document {} with {} code cells,"
+          " simulated Lyx reply delay {} ms.\n".format(args.repeats,
+                  args.lyx_file or "(synthetic)",
+                  len(server.cells(basic_types=("Init", "Standard"))),
+                  1000*args.reply_delay))
+    for key_action, cursor_in_cell in key_actions_to_time:
+        saved_stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+        try:
+            times, lfuns_per_run = time_key_action(controller, server, key_action,
+                                                   cursor_in_cell, args.repeats)
+        finally:
+            sys.stdout.close()
+            sys.stdout = saved_stdout
+        print_summary(key_action + ":", times, lfuns_per_run)
+    if args.lfun_report:
+        print(controller.lyx_process.lfun_timing_stats.report_string())
+
+    os.chdir(old_cwd)
+    server.stop()
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+
+Benchmark the round-trip latency of LFUNs sent to the Lyx server, comparing the
+selector-based wait on the server's output pipe to the older approach of
+sleeping a quarter second whenever a read of the pipe comes back empty.
+
+No running Lyx is needed.  A thread stands in for Lyx: it reads `LYXCMD` lines
+from a `lyxpipe.in` FIFO in a temporary directory and, after a simulated
+processing delay, writes an `INFO` reply to `lyxpipe.out`.
+
+Run from the top-level directory as::
+
+    python test/benchmark_lfun_round_trip.py [--num-lfuns N] [--reply-delay SECS]
+
+"""
+
+import os
+import time
+import tempfile
+import threading
+import argparse
+
+from lyxnotebook.config_file_processing import config_dict
+
+
+class EchoLyxServer:
+    """Answer every `LYXCMD` on the input pipe with an empty `INFO` reply, after
+    sleeping `reply_delay` seconds to simulate Lyx doing some work."""
+
+    def __init__(self, pipe_base, reply_delay):
+        self.pipe_in_filename = pipe_base + ".in"
+        self.pipe_out_filename = pipe_base + ".out"
+        self.reply_delay = reply_delay
+        os.mkfifo(self.pipe_in_filename)
+        os.mkfifo(self.pipe_out_filename)
+        # Like Lyx, hold the output pipe open read/write so it never hits EOF.
+        self.pipe_out = os.open(self.pipe_out_filename, os.O_RDWR)
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        pipe_in = os.open(self.pipe_in_filename, os.O_RDONLY) # Waits for the client.
+        pending = b""
+        while True:
+            data = os.read(pipe_in, 4096)
+            if not data:
+                break
+            pending += data
+            *lines, pending = pending.split(b"\n")
+            for line in lines:
+                _, client, function, argument = line.decode("utf-8").split(":", 3)
+                time.sleep(self.reply_delay)
+                reply = "INFO:{}:{}:\n".format(client, function)
+                os.write(self.pipe_out, reply.encode("utf-8"))
+        os.close(pipe_in)
+
+
+def time_round_trips(lyx_process, num_lfuns):
+    """Return the per-LFUN round-trip times, in seconds."""
+    times = []
+    for i in range(num_lfuns):
+        start = time.perf_counter()
+        lyx_process.process_lfun("server-get-layout")
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def print_summary(label, times):
+    times = sorted(times)
+    mean = sum(times) / len(times)
+    median = times[len(times)//2]
+    print("{:<28} mean {:9.3f} ms   median {:9.3f} ms   max {:9.3f} ms".format(
+          label, 1000*mean, 1000*median, 1000*times[-1]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-lfuns", type=int, default=20,
+                        help="Number of LFUN round trips to time for each reader.")
+    parser.add_argument("--reply-delay", type=float, default=0.001,
+                        help="Simulated Lyx processing time per LFUN, in seconds.")
+    args = parser.parse_args()
+
+    tmp_dir = tempfile.mkdtemp(prefix="lyxnotebook_bench_")
+    config_dict["lyx_server_pipe"] = os.path.join(tmp_dir, "lyxpipe")
+    config_dict["lyx_temporary_directory"] = tmp_dir
+    config_dict["magic_cookie_string"] = ">==>-"
+
+    # Import after the config is set up, since some modules read it on import.
+    from lyxnotebook.lyx_server_API_wrapper import InteractWithLyxCells
+
+    def polling_wait(timeout=None):
+        """The old behavior: sleep a quarter second whenever nothing was read."""
+        time.sleep(0.25 if timeout is None else min(timeout, 0.25))
+        return False
+
+    server = EchoLyxServer(config_dict["lyx_server_pipe"], args.reply_delay)
+    print("Timing {} LFUN round trips, simulated Lyx reply delay {} ms.\n"
+          .format(args.num_lfuns, 1000*args.reply_delay))
+    lyx_process = InteractWithLyxCells("benchmarkClient")
+
+    lyx_process.wait_for_server_readable = polling_wait # Shadow the method.
+    print_summary("before (0.25 s polling):", time_round_trips(lyx_process, args.num_lfuns))
+
+    del lyx_process.wait_for_server_readable
+    print_summary("after (selector wait):", time_round_trips(lyx_process, args.num_lfuns))
+
+
+if __name__ == "__main__":
+    main()
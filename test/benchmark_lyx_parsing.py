@@ -0,0 +1,188 @@
+"""
+
+Benchmark the parsing and writing of .lyx documents in
+`parse_and_write_lyx_files`, and check the results against stored baselines.
+
+The documents are `plain_test_file.lyx` and synthetic documents made from it
+by `make_synthetic_lyx_document`.  For each document these are measured:
+
+* `parse`: `get_all_cell_text_from_lyx_string`, for the cells only.
+* `parse_noncell`: the same with `also_noncell=True`, as used for rewriting.
+* `serialize`: `get_lyx_string_from_cell_list` on the parsed list.
+* `round_trip`: parsing, serializing and parsing the result again.
+
+The best time of several runs is reported, with the throughput in MB of the
+document per second, and the peak memory allocated during one run (measured
+separately with `tracemalloc`).
+
+The baselines are stored in `benchmark_lyx_parsing_baselines.json`.  The run
+fails, with exit status 1, when a time is more than `--time-tolerance` times
+its baseline or a peak memory is more than `--memory-tolerance` times its
+baseline.  Times depend on the machine, so after a deliberate change (or on a
+new machine) store new baselines with `--update-baselines`.
+
+Run from the top-level directory as::
+
+    python test/benchmark_lyx_parsing.py [--repeats N] [--update-baselines]
+
+"""
+
+import os
+import sys
+import gc
+import json
+import time
+import argparse
+import tracemalloc
+
+from lyxnotebook.config_file_processing import config_dict
+from lyxnotebook.parse_and_write_lyx_files import (get_all_cell_text_from_lyx_string,
+                                                   get_lyx_string_from_cell_list)
+from synthetic_lyx_documents import make_synthetic_lyx_document, default_template_filename
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+default_baselines_filename = os.path.join(test_dir, "benchmark_lyx_parsing_baselines.json")
+
+cookie = ">==>-"
+
+
+def make_documents():
+    """Return a dict mapping a document name to its Lyx-format string."""
+    with open(default_template_filename) as lyx_file:
+        plain_test_file = lyx_file.read()
+    return {
+        "plain_test_file": plain_test_file,
+        "small_50x5": make_synthetic_lyx_document(50, 5, seed=1),
+        "large_1000x20": make_synthetic_lyx_document(1000, 20, seed=2),
+        "prose_heavy_200x5": make_synthetic_lyx_document(200, 5, seed=3,
+                                                         prose_repeats=20),
+        }
+
+
+def parse(lyx_string, cell_list):
+    return get_all_cell_text_from_lyx_string(lyx_string, cookie)
+
+
+def parse_noncell(lyx_string, cell_list):
+    return get_all_cell_text_from_lyx_string(lyx_string, cookie, also_noncell=True)
+
+
+def serialize(lyx_string, cell_list):
+    return get_lyx_string_from_cell_list(cell_list)
+
+
+def round_trip(lyx_string, cell_list):
+    cell_list = get_all_cell_text_from_lyx_string(lyx_string, cookie, also_noncell=True)
+    new_lyx_string = get_lyx_string_from_cell_list(cell_list)
+    return get_all_cell_text_from_lyx_string(new_lyx_string, cookie, also_noncell=True)
+
+operations = [parse, parse_noncell, serialize, round_trip]
+
+
+def measure(operation, lyx_string, repeats):
+    """Return a tuple `(best_secs, peak_bytes)` for running `operation` on the
+    document `lyx_string`."""
+    cell_list = parse_noncell(lyx_string, None)
+    times = []
+    for i in range(repeats):
+        gc.collect()
+        gc.disable() # Collections at random times make the times much noisier.
+        try:
+            start_time = time.perf_counter()
+            operation(lyx_string, cell_list)
+            times.append(time.perf_counter() - start_time)
+        finally:
+            gc.enable()
+
+    gc.collect()
+    tracemalloc.start()
+    operation(lyx_string, cell_list)
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak_bytes
+
+
+def run_benchmarks(repeats):
+    """Return the results, a dict mapping "<document>/<operation>" to a dict of
+    the measurements."""
+    results = {}
+    for document_name, lyx_string in make_documents().items():
+        megabytes = len(lyx_string.encode("utf-8")) / 1e6
+        for operation in operations:
+            secs, peak_bytes = measure(operation, lyx_string, repeats)
+            results["{}/{}".format(document_name, operation.__name__)] = {
+                    "secs": secs,
+                    "mb_per_sec": megabytes / secs,
+                    "peak_mb": peak_bytes / 1e6}
+    return results
+
+
+def find_regressions(results, baselines, time_tolerance, memory_tolerance):
+    """Return a list of messages for the results which regressed past the
+    baselines."""
+    messages = []
+    for name, result in sorted(results.items()):
+        baseline = baselines.get(name)
+        if baseline is None:
+            continue
+        if result["secs"] > baseline["secs"] * time_tolerance:
+            messages.append("{}: {:.2f} ms is more than {}x the baseline {:.2f} ms"
+                            .format(name, 1000*result["secs"], time_tolerance,
+                                    1000*baseline["secs"]))
+        if result["peak_mb"] > baseline["peak_mb"] * memory_tolerance:
+            messages.append("{}: peak {:.2f} MB is more than {}x the baseline {:.2f} MB"
+                            .format(name, result["peak_mb"], memory_tolerance,
+                                    baseline["peak_mb"]))
+    return messages
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=9,
+                        help="times to run each operation, the best is reported")
+    parser.add_argument("--baselines", default=default_baselines_filename,
+                        help="the JSON file of baseline results")
+    parser.add_argument("--update-baselines", action="store_true",
+                        help="store the results as the new baselines")
+    parser.add_argument("--time-tolerance", type=float, default=2.0,
+                        help="fail when a time is more than this times its baseline")
+    parser.add_argument("--memory-tolerance", type=float, default=1.2,
+                        help="fail when a peak memory is more than this times its baseline")
+    args = parser.parse_args()
+
+    config_dict["has_editable_insets_noeditor_mod"] = False
+    config_dict["has_editable_insets"] = True
+
+    results = run_benchmarks(args.repeats)
+    baselines = {}
+    if os.path.exists(args.baselines):
+        with open(args.baselines) as baselines_file:
+            baselines = json.load(baselines_file)
+
+    for name, result in sorted(results.items()):
+        line = "{:<34} {:9.2f} ms {:8.2f} MB/s  peak {:7.2f} MB".format(name,
+                            1000*result["secs"], result["mb_per_sec"], result["peak_mb"])
+        if name in baselines:
+            line += "   ({:+.0f}% time vs baseline)".format(
+                            100 * (result["secs"] / baselines[name]["secs"] - 1))
+        print(line)
+
+    if args.update_baselines:
+        with open(args.baselines, "w") as baselines_file:
+            json.dump(results, baselines_file, indent=2, sort_keys=True)
+            baselines_file.write("\n")
+        print("\nStored the results as the baselines in", args.baselines)
+        return
+
+    regressions = find_regressions(results, baselines, args.time_tolerance,
+                                   args.memory_tolerance)
+    if regressions:
+        print("\nRegressions past the baselines:")
+        for message in regressions:
+            print("   " + message)
+        sys.exit(1)
+    print("\nNo regressions past the baselines.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""
+
+Benchmark parsing .lyx documents with the regex-driven scanner, which jumps
+from one cell inset to the next, against the scanner which looks at every
+line of the document.  The documents are synthetic, with a number of prose
+paragraphs between each pair of cells.
+
+Run from the top-level directory as::
+
+    python test/benchmark_lyx_scanner.py [--num-cells N] [--paragraphs N] [--repeats N]
+
+"""
+
+import time
+import argparse
+
+from lyxnotebook.config_file_processing import config_dict
+from lyxnotebook.parse_and_write_lyx_files import (
+                                         generate_cells_from_lyx_lines,
+                                         get_all_cell_text_from_lyx_string)
+from mock_lyx_server import make_lyx_document
+
+cookie = ">==>-"
+
+prose_paragraph = ("\\begin_layout Standard\n"
+                   "Some prose of the document, long enough to be wrapped by Lyx onto\n"
+                   "more than one line of the file, with a word in \n"
+                   "\\emph on\nemphasis\n\\emph default\n and a formula \n"
+                   "\\begin_inset Formula $x^{2}$\n\\end_inset\n\n.\n"
+                   "\\end_layout\n\n")
+
+
+def make_prose_document(num_cells, paragraphs_per_cell):
+    """Return a synthetic document with `num_cells` code cells and
+    `paragraphs_per_cell` prose paragraphs before each one."""
+    document = make_lyx_document(num_cells)
+    return document.replace("\\begin_layout Standard\nParagraph ",
+                            prose_paragraph * paragraphs_per_cell +
+                            "\\begin_layout Standard\nParagraph ")
+
+
+def parse_by_lines(lyx_string, also_noncell):
+    return list(generate_cells_from_lyx_lines(lyx_string.splitlines(), cookie,
+                                              also_noncell=also_noncell))
+
+
+def parse_by_regex(lyx_string, also_noncell):
+    return get_all_cell_text_from_lyx_string(lyx_string, cookie,
+                                             also_noncell=also_noncell)
+
+
+def best_time(function, repeats, *args):
+    """Return the shortest of `repeats` running times of `function(*args)`."""
+    times = []
+    for i in range(repeats):
+        start_time = time.perf_counter()
+        function(*args)
+        times.append(time.perf_counter() - start_time)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-cells", type=int, default=500,
+                        help="number of code cells in the documents")
+    parser.add_argument("--paragraphs", type=int, nargs="+", default=[0, 10, 50],
+                        help="prose paragraphs before each cell, one document each")
+    parser.add_argument("--repeats", type=int, default=5,
+                        help="times to parse each document, the best is reported")
+    args = parser.parse_args()
+
+    config_dict["has_editable_insets_noeditor_mod"] = False
+    config_dict["has_editable_insets"] = True
+
+    for paragraphs in args.paragraphs:
+        lyx_string = make_prose_document(args.num_cells, paragraphs)
+        for also_noncell in [False, True]:
+            line_secs = best_time(parse_by_lines, args.repeats, lyx_string, also_noncell)
+            regex_secs = best_time(parse_by_regex, args.repeats, lyx_string, also_noncell)
+            print("{:>5} paragraphs/cell {:>6.2f} MB also_noncell={!s:<5}  "
+                  "lines {:8.2f} ms   regex {:8.2f} ms   speedup {:5.2f}x"
+                  .format(paragraphs, len(lyx_string) / 1e6, also_noncell,
+                          1000*line_secs, 1000*regex_secs, line_secs / regex_secs))
+
+
+if __name__ == "__main__":
+    main()
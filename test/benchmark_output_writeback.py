@@ -0,0 +1,142 @@
+"""
+
+Benchmark writing an output cell with `replace_current_output_cell_text`, the
+writeback done after each code cell is evaluated, counting the round trips to
+the Lyx server.
+
+A round trip is a wait for a Lyx reply which has not yet arrived, during which
+Lyx Notebook is blocked (LFUNs sent without waiting for their replies are not
+round trips).  The writeback is run against a `MockLyxServer` (see
+`mock_lyx_server.py`) in each of the cases below, both probing the document
+to find the output cell and with the code cell from a snapshot of the
+document (as when evaluating), and the round trips, the LFUNs sent and the
+time are reported per run.  The time to take the snapshot is not included,
+since evaluating a cell takes one anyway.  With a nonzero `--reply-delay`
+the time is dominated by the round trips, as it is with a real Lyx.
+
+Run from the top-level directory as::
+
+    python test/benchmark_output_writeback.py [--repeats N] [--reply-delay SECS]
+
+"""
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import argparse
+
+from lyxnotebook.config_file_processing import config_dict, initialize_config_data
+from mock_lyx_server import MockLyxServer, make_lyx_document
+
+
+def existing_output(server, output_cell):
+    pass
+
+def empty_output(server, output_cell):
+    output_cell.lines = [""]
+
+def missing_output(server, output_cell):
+    server.items.remove(output_cell)
+
+# The cases, as tuples `(label, setup, line_list, create_if_necessary)`.  The
+# setup function changes the output cell following the code cell.
+writeback_cases = [
+        ("existing output", existing_output, ["new 1\n", "new 2\n"], True),
+        ("existing output, blank last line", existing_output, ["new 1\n", "\n"], True),
+        ("empty output", empty_output, ["new 1\n", "new 2\n"], True),
+        ("missing output, created", missing_output, ["new 1\n", "new 2\n"], True),
+        ("missing output, not created", missing_output, ["new 1\n"], False),
+        ]
+
+
+def count_round_trips(lyx_process):
+    """Make `lyx_process` count its waits for replies which have not arrived,
+    returning a one-element list holding the count."""
+    count = [0]
+    wait_for_lfun_reply = lyx_process.wait_for_lfun_reply
+    def counting_wait_for_lfun_reply(lfun_future):
+        if not lfun_future.done():
+            count[0] += 1
+        wait_for_lfun_reply(lfun_future)
+    lyx_process.wait_for_lfun_reply = counting_wait_for_lfun_reply
+    return count
+
+
+def time_writeback(server, lyx_process, round_trip_count, case, repeats,
+                   from_snapshot):
+    """Return the list of run times for the case, the mean number of round trips
+    and the mean number of LFUNs sent per run.  If `from_snapshot` is true the
+    code cell parsed from a snapshot of the document is passed in."""
+    label, setup, line_list, create_if_necessary = case
+    original_items = copy.deepcopy(server.items)
+    times = []
+    num_round_trips = 0
+    num_lfuns = 0
+    for i in range(repeats):
+        with server.lock:
+            server.items = copy.deepcopy(original_items)
+            code_cell = server.cells(basic_types=("Standard",))[0]
+            setup(server, server.items[server.items.index(code_cell) + 1])
+        snapshot_cell = None
+        if from_snapshot:
+            snapshot_cell = [cell for cell in lyx_process.get_all_cell_text()
+                             if cell.basic_type == "Standard"][0]
+        server.put_cursor_at_cell(code_cell)
+        start_round_trips = round_trip_count[0]
+        start_num_commands = server.num_commands
+        start = time.perf_counter()
+        lyx_process.replace_current_output_cell_text(line_list,
+                      create_if_necessary=create_if_necessary, assert_inside_cell=True,
+                      code_cell=snapshot_cell)
+        times.append(time.perf_counter() - start)
+        num_round_trips += round_trip_count[0] - start_round_trips
+        lyx_process.finish_pending_lfuns() # Any LFUNs sent without waiting.
+        num_lfuns += server.num_commands - start_num_commands
+    with server.lock:
+        server.items = original_items
+    return times, num_round_trips / repeats, num_lfuns / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--repeats", type=int, default=10,
+                        help="Number of times to run each case.")
+    parser.add_argument("--reply-delay", type=float, default=0.001,
+                        help="Simulated Lyx processing time per LFUN, in seconds.")
+    args = parser.parse_args()
+
+    # Set up a Lyx user directory holding the default config file.
+    tmp_dir = tempfile.mkdtemp(prefix="lyxnotebook_bench_")
+    shutil.copy(os.path.join(config_dict["lyx_notebook_source_dir"],
+                             "default_config_file_and_data_files",
+                             "default_config_file.cfg"),
+                os.path.join(tmp_dir, "lyxnotebook.cfg"))
+    initialize_config_data(tmp_dir)
+    config_dict["lyx_server_pipe"] = os.path.join(tmp_dir, "lyxpipe")
+    config_dict["lyx_temporary_directory"] = tmp_dir
+    server = MockLyxServer(config_dict["lyx_server_pipe"],
+                           lyx_string=make_lyx_document(3), reply_delay=args.reply_delay)
+
+    from lyxnotebook.lyx_server_API_wrapper import InteractWithLyxCells
+    lyx_process = InteractWithLyxCells("benchmarkClient")
+    round_trip_count = count_round_trips(lyx_process)
+
+    print("\nTiming {} runs of each case, simulated Lyx reply delay {} ms.\n"
+          .format(args.repeats, 1000*args.reply_delay))
+    for from_snapshot in (False, True):
+        print("With the code cell from a snapshot:" if from_snapshot else "Probing:")
+        for case in writeback_cases:
+            times, round_trips, lfuns = time_writeback(server, lyx_process,
+                                  round_trip_count, case, args.repeats, from_snapshot)
+            print("   {:<34} round trips {:4.1f}   LFUNs {:4.1f}   mean {:8.2f} ms".format(
+                  case[0] + ":", round_trips, lfuns, 1000*sum(times)/len(times)))
+
+    lyx_process.cell_text_file_pool.close()
+    server.stop()
+    shutil.rmtree(tmp_dir)
+
+
+if __name__ == "__main__":
+    main()
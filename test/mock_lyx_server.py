@@ -0,0 +1,625 @@
+"""
+
+A stand-in for a running Lyx process, for testing and benchmarking Lyx
+Notebook without Lyx.
+
+The class `MockLyxServer` creates the `lyxpipe.in` and `lyxpipe.out` FIFOs
+which the Lyx server uses, holds a document in memory, and answers the
+`LYXCMD` lines written to the input pipe from a background thread.  The
+document is loaded from a .lyx file (such as `testInteractWithLyxCells.lyx`)
+or from a string, for example one made by `make_lyx_document`.
+
+Only the Lyx Notebook cell insets are modeled in any detail.  The document is
+held as a list of items, each either a `MockCell` or a string of the Lyx-format
+text between cells.  The cursor is either inside a cell, at a (column, row)
+position of its text, or outside the cells just before one of the items.
+Ordinary text counts as a single cursor step, and searches only look inside
+cells.  The LFUNs used by `InteractWithLyxCells` are implemented with those
+simplifications; x,y positions are in characters and lines rather than pixels.
+Unknown LFUNs get an `ERROR` reply, as do the math LFUNs (the cursor is never
+in math), which matches what Lyx sends when a command is disabled.
+
+Typical use::
+
+    server = MockLyxServer(pipe_base, lyx_filename=...)
+    ... run Lyx Notebook code with config_dict["lyx_server_pipe"] = pipe_base ...
+    server.press_key("F4") # Send a NOTIFY as if a bound key were pressed.
+    server.stop()
+
+"""
+
+import os
+import time
+import threading
+import collections
+
+from lyxnotebook.parse_and_write_lyx_files import (
+                            lyx_format_code_line_to_text,
+                            convert_text_line_to_lyx_file_inset_format)
+
+cell_begin_prefix = r"\begin_inset Flex LyxNotebookCell:"
+
+
+class MockCell:
+    """A Lyx Notebook cell inset in the mock document.  The text is held as a
+    list of lines without newlines; an empty cell has the single line ""."""
+
+    def __init__(self, basic_type, language, lines=None, is_open=True):
+        self.basic_type = basic_type
+        self.language = language
+        self.lines = lines if lines else [""]
+        self.is_open = is_open
+
+    @property
+    def name(self):
+        """The Lyx inset name, as used by `inset-forall`."""
+        return "Flex:LyxNotebookCell:{}:{}".format(self.basic_type, self.language)
+
+    def lyx_string(self):
+        """Return the Lyx-format text of the cell, from the `\\begin_inset` line
+        through the `\\end_inset` line."""
+        pieces = [cell_begin_prefix + "{}:{}\n".format(self.basic_type, self.language),
+                  "status {}\n\n".format("open" if self.is_open else "collapsed")]
+        for line in self.lines:
+            pieces.append(convert_text_line_to_lyx_file_inset_format(line) + "\n")
+        pieces.append("\\end_inset\n")
+        return "".join(pieces)
+
+    def __repr__(self):
+        return "MockCell({!r}, {!r}, {!r})".format(self.basic_type, self.language,
+                                                   self.lines)
+
+
+def parse_lyx_string(lyx_string):
+    """Split a Lyx-format string into a list of items, alternating strings of
+    the text between cells and `MockCell` instances.  Whitespace-only text
+    between two cells is dropped; adjacent cells are separated again when the
+    document is written out."""
+    items = []
+    text_lines = []
+    lines = lyx_string.splitlines(True)
+    index = 0
+    while index < len(lines):
+        line = lines[index]
+        if not line.startswith(cell_begin_prefix):
+            text_lines.append(line)
+            index += 1
+            continue
+
+        text = "".join(text_lines)
+        if text.strip() or not items:
+            items.append(text)
+        text_lines = []
+
+        basic_type, language = line.rstrip().split(":")[-2:]
+        cell = MockCell(basic_type, language)
+        cell.lines = []
+        depth = 1
+        layout_lines = None
+        index += 1
+        while depth:
+            line = lines[index].rstrip("\n")
+            index += 1
+            if line.startswith(r"\begin_inset"):
+                depth += 1
+            elif line == r"\end_inset":
+                depth -= 1
+            if depth == 1 and layout_lines is None and line.startswith("status "):
+                cell.is_open = line.split()[1] == "open"
+            elif depth == 1 and line == r"\begin_layout Plain Layout":
+                layout_lines = []
+                index += 1 # Skip the empty line which begins the layout.
+            elif depth == 1 and line == r"\end_layout":
+                cell.lines.append(lyx_format_code_line_to_text(layout_lines)[:-1])
+                layout_lines = None
+            elif depth and layout_lines is not None:
+                layout_lines.append(line)
+        if not cell.lines:
+            cell.lines = [""]
+        items.append(cell)
+    items.append("".join(text_lines))
+    return items
+
+
+def make_lyx_document(num_cells, language="Python", num_init_cells=1):
+    """Return the text of a synthetic .lyx document with `num_cells` code cells
+    of the given language, each followed by an output cell.  The first
+    `num_init_cells` cells are Init cells and the rest are Standard cells."""
+    pieces = ["#LyX 2.3 created this file. For more info see http://www.lyx.org/\n",
+              "\\lyxformat 544\n\\begin_document\n\\begin_header\n",
+              "\\textclass article\n\\begin_modules\n",
+              "lyxNotebookCell{}\n\\end_modules\n".format(language),
+              "\\end_header\n\n\\begin_body\n\n"]
+    for i in range(num_cells):
+        basic_type = "Init" if i < num_init_cells else "Standard"
+        code = MockCell(basic_type, language,
+                        ["x{} = {}".format(i, i), "print(x{} * 2)".format(i)])
+        output = MockCell("Output", language, ["{}".format(2 * i)])
+        pieces.append("\\begin_layout Standard\nParagraph {} of text.\n"
+                      "\\end_layout\n\n\\begin_layout Standard\n".format(i))
+        pieces.append(code.lyx_string() + "\n\n" + output.lyx_string())
+        pieces.append("\n\n\\end_layout\n\n")
+    pieces.append("\\end_body\n\\end_document\n")
+    return "".join(pieces)
+
+
+class LfunError(Exception):
+    """Raised inside the mock when an LFUN fails; the message is the `ERROR`
+    reply data."""
+
+
+class MockLyxServer:
+    """Pretend to be a Lyx process with its server running on the pipes
+    `pipe_base + ".in"` and `pipe_base + ".out"`.  The document is read from
+    `lyx_filename` or taken from `lyx_string`, and `buffer_filename` is the
+    filename reported for the buffer (by default `lyx_filename`, or a file
+    written next to the pipes).  Each LFUN reply is delayed by `reply_delay`
+    seconds to simulate Lyx doing some work."""
+
+    def __init__(self, pipe_base, lyx_filename=None, lyx_string=None,
+                 buffer_filename=None, reply_delay=0.0):
+        if lyx_string is None:
+            with open(lyx_filename, "r") as lyx_file:
+                lyx_string = lyx_file.read()
+        if buffer_filename is None:
+            buffer_filename = lyx_filename
+        if buffer_filename is None:
+            buffer_filename = pipe_base + "_document.lyx"
+            with open(buffer_filename, "w") as lyx_file:
+                lyx_file.write(lyx_string)
+        self.buffer_filename = os.path.abspath(buffer_filename)
+        self.reply_delay = reply_delay
+
+        self.lock = threading.RLock()
+        self.items = parse_lyx_string(lyx_string)
+        self.item = 0          # The cursor is inside or just before this item.
+        self.row = None        # The cursor row, or `None` when outside the cells.
+        self.col = 0           # The cursor column.
+        self.selection = False # Whether the whole current cell is selected.
+
+        self.messages = []                         # Text of `message` LFUNs.
+        self.lfun_counts = collections.Counter()   # Count of each LFUN received.
+        self.num_commands = 0                      # Count of LYXCMD lines received.
+
+        self.pipe_in_filename = pipe_base + ".in"
+        self.pipe_out_filename = pipe_base + ".out"
+        os.mkfifo(self.pipe_in_filename)
+        os.mkfifo(self.pipe_out_filename)
+        # Like Lyx, hold the output pipe open read/write so it never hits EOF.  The
+        # input pipe is held the same way so opening it never blocks and so the
+        # `stop` method can wake the server thread.
+        self.pipe_out = os.open(self.pipe_out_filename, os.O_RDWR)
+        self.pipe_in = os.open(self.pipe_in_filename, os.O_RDWR)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    #
+    # Running the server.
+    #
+
+    def serve(self):
+        """Read and answer commands until `stop` is called."""
+        pending = bytearray()
+        while not self.stopped:
+            pending += os.read(self.pipe_in, 65536)
+            *lines, remainder = pending.split(b"\n")
+            pending = bytearray(remainder)
+            for line in lines:
+                if line and not self.stopped:
+                    self.handle_command_line(line.decode("utf-8"))
+
+    def stop(self):
+        """Stop the server thread and remove the pipes."""
+        self.stopped = True
+        os.write(self.pipe_in, b"\n") # Wake up the server thread.
+        self.thread.join()
+        os.close(self.pipe_in)
+        os.close(self.pipe_out)
+        os.remove(self.pipe_in_filename)
+        os.remove(self.pipe_out_filename)
+
+    def handle_command_line(self, line):
+        """Run the command from a single line of the input pipe and send the reply."""
+        fields = line.split(":", 3)
+        if fields[0] != "LYXCMD" or len(fields) < 3:
+            return # Ignore LYXSRV hello and bye messages, and junk.
+        client_name, function = fields[1], fields[2]
+        argument = fields[3] if len(fields) > 3 else ""
+        with self.lock:
+            self.num_commands += 1
+            if self.reply_delay:
+                time.sleep(self.reply_delay)
+            try:
+                reply = "INFO:{}:{}:{}\n".format(client_name, function,
+                                                 self.run_lfun(function, argument))
+            except LfunError as err:
+                reply = "ERROR:{}:{}:{}\n".format(client_name, function, err)
+            self.write_to_client(reply)
+
+    def write_to_client(self, string):
+        """Write to the output pipe, as the Lyx server does."""
+        os.write(self.pipe_out, string.encode("utf-8"))
+
+    def press_key(self, key):
+        """Send a NOTIFY event, as Lyx does when a key bound to server-notify
+        is pressed."""
+        with self.lock:
+            self.write_to_client("NOTIFY:{}\n".format(key))
+
+    #
+    # Inspecting and setting up the document.
+    #
+
+    def lyx_string(self):
+        """Return the current document in Lyx format."""
+        with self.lock:
+            pieces = []
+            for prev_item, item in zip([None] + self.items, self.items):
+                if isinstance(item, MockCell):
+                    if isinstance(prev_item, MockCell):
+                        pieces.append("\n\n")
+                    pieces.append(item.lyx_string())
+                else:
+                    pieces.append(item)
+            return "".join(pieces)
+
+    def cells(self, basic_types=("Init", "Standard", "Output")):
+        """Return a list of the cells of the given basic types, in order."""
+        with self.lock:
+            return [i for i in self.items
+                    if isinstance(i, MockCell) and i.basic_type in basic_types]
+
+    def put_cursor_at_cell(self, cell, inside=True):
+        """Put the cursor at the beginning of `cell`, one of the document's cells,
+        or if `inside` is false just before the cell."""
+        with self.lock:
+            self.item = self.items.index(cell)
+            self.row, self.col = (0, 0) if inside else (None, 0)
+            self.selection = False
+
+    def current_cell(self):
+        """Return the cell the cursor is inside, or `None`."""
+        if self.row is None:
+            return None
+        return self.items[self.item]
+
+    #
+    # LFUN implementations.  Each `lfun_` method takes the argument string and
+    # returns the reply data, or raises `LfunError`.
+    #
+
+    def run_lfun(self, function, argument):
+        """Run a single LFUN and return its reply data."""
+        self.lfun_counts[function] += 1
+        method = getattr(self, "lfun_" + function.replace("-", "_"), None)
+        if method is None:
+            raise LfunError("Unknown function")
+        result = method(argument)
+        return "" if result is None else result
+
+    def run_lfun_string(self, lfun_string):
+        """Run an LFUN given as a single string with its argument."""
+        function, _, argument = lfun_string.strip().partition(" ")
+        return self.run_lfun(function, argument)
+
+    def lfun_command_sequence(self, argument):
+        # Like Lyx, keep going when a command in the sequence fails.
+        for lfun_string in argument.split(";"):
+            if lfun_string.strip():
+                try:
+                    self.run_lfun_string(lfun_string)
+                except LfunError:
+                    pass
+
+    def lfun_command_alternatives(self, argument):
+        for lfun_string in argument.split(";"):
+            try:
+                return self.run_lfun_string(lfun_string)
+            except LfunError:
+                continue
+        raise LfunError("Command disabled")
+
+    def lfun_repeat(self, argument):
+        count, lfun_string = argument.split(maxsplit=1)
+        for i in range(int(count)):
+            self.run_lfun_string(lfun_string)
+
+    def lfun_inset_forall(self, argument):
+        name, lfun_string = argument.split(maxsplit=1)
+        saved_cursor = self.item, self.row, self.col
+        for cell in [i for i in self.items if isinstance(i, MockCell)]:
+            if cell.name.startswith(name):
+                self.item, self.row, self.col = self.items.index(cell), None, 0
+                self.selection = False
+                try:
+                    self.run_lfun_string(lfun_string)
+                except LfunError:
+                    pass
+        self.item, self.row, self.col = saved_cursor
+        self.selection = False
+        cell = self.current_cell()
+        if cell:
+            cell.is_open = True # The cell holding the cursor is never closed.
+            self.clamp_cursor()
+
+    def lfun_server_get_filename(self, argument):
+        return self.buffer_filename
+
+    def lfun_server_get_layout(self, argument):
+        return "Plain Layout" if self.current_cell() else "Standard"
+
+    def lfun_server_get_xy(self, argument):
+        if not self.current_cell():
+            return "0 0"
+        return "{} {}".format(self.col, self.row)
+
+    def lfun_server_set_xy(self, argument):
+        if self.current_cell():
+            self.col, self.row = (int(i) for i in argument.split())
+            self.clamp_cursor()
+
+    def lfun_server_goto_file_row(self, argument):
+        pass
+
+    def lfun_message(self, argument):
+        self.messages.append(argument)
+
+    def lfun_buffer_export_custom(self, argument):
+        export_format, command = argument.split(maxsplit=1)
+        if export_format != "lyx" or not command.startswith("mv $$FName "):
+            raise LfunError("Unsupported export: " + argument)
+        with open(command[len("mv $$FName "):].strip(), "w") as lyx_file:
+            lyx_file.write(self.lyx_string())
+
+    def lfun_buffer_write(self, argument):
+        with open(self.buffer_filename, "w") as lyx_file:
+            lyx_file.write(self.lyx_string())
+
+    def lfun_buffer_auto_save(self, argument):
+        pass
+
+    def lfun_buffer_reload(self, argument):
+        with open(self.buffer_filename, "r") as lyx_file:
+            self.items = parse_lyx_string(lyx_file.read())
+        self.lfun_buffer_begin("")
+
+    def lfun_file_open(self, argument):
+        pass
+
+    def lfun_buffer_begin(self, argument):
+        self.item, self.row, self.col = 0, None, 0
+        self.selection = False
+
+    def lfun_buffer_end(self, argument):
+        self.item, self.row, self.col = len(self.items), None, 0
+        self.selection = False
+
+    def lfun_char_right(self, argument):
+        self.selection = False
+        cell = self.current_cell()
+        if cell:
+            if self.col < len(cell.lines[self.row]):
+                self.col += 1
+            elif self.row < len(cell.lines) - 1:
+                self.row, self.col = self.row + 1, 0
+            else:
+                self.item, self.row, self.col = self.item + 1, None, 0
+        elif self.item < len(self.items):
+            item = self.items[self.item]
+            if isinstance(item, MockCell) and item.is_open:
+                self.row, self.col = 0, 0
+            else:
+                self.item += 1
+
+    def lfun_char_left(self, argument):
+        self.selection = False
+        cell = self.current_cell()
+        if cell:
+            if self.col > 0:
+                self.col -= 1
+            elif self.row > 0:
+                self.row -= 1
+                self.col = len(cell.lines[self.row])
+            else:
+                self.row = None
+        elif self.item > 0:
+            self.item -= 1
+            item = self.items[self.item]
+            if isinstance(item, MockCell) and item.is_open:
+                self.row = len(item.lines) - 1
+                self.col = len(item.lines[self.row])
+
+    def lfun_word_forward(self, argument):
+        cell = self.current_cell()
+        if cell and self.col < len(cell.lines[self.row]):
+            self.col = len(cell.lines[self.row])
+        elif cell:
+            self.lfun_char_right("")
+        else:
+            self.item = min(self.item + 1, len(self.items))
+
+    def lfun_word_backward(self, argument):
+        cell = self.current_cell()
+        if cell and self.col > 0:
+            self.col = 0
+        elif cell:
+            self.lfun_char_left("")
+        else:
+            self.item = max(self.item - 1, 0)
+
+    def lfun_line_begin(self, argument):
+        if self.current_cell():
+            self.col = 0
+
+    def lfun_line_end(self, argument):
+        cell = self.current_cell()
+        if cell:
+            self.col = len(cell.lines[self.row])
+
+    def lfun_paragraph_up(self, argument):
+        if self.current_cell():
+            self.row, self.col = max(self.row - 1, 0), 0
+
+    def lfun_paragraph_down(self, argument):
+        cell = self.current_cell()
+        if cell:
+            self.row, self.col = min(self.row + 1, len(cell.lines) - 1), 0
+
+    def lfun_inset_begin(self, argument):
+        if self.current_cell():
+            if (self.row, self.col) == (0, 0):
+                self.row = None # Already at the beginning, so leave the cell.
+            else:
+                self.row, self.col = 0, 0
+
+    def lfun_escape(self, argument):
+        if self.selection:
+            self.selection = False
+        elif self.current_cell():
+            self.item, self.row, self.col = self.item + 1, None, 0
+
+    def lfun_inset_select_all(self, argument):
+        if self.current_cell():
+            self.selection = True
+
+    def lfun_inset_toggle(self, argument):
+        cell = self.current_cell()
+        if not cell and self.item < len(self.items):
+            cell = self.items[self.item]
+        if not isinstance(cell, MockCell):
+            raise LfunError("Command disabled")
+        action = argument.strip() or "toggle"
+        cell.is_open = not cell.is_open if action == "toggle" else action == "open"
+        if not cell.is_open and self.current_cell() is cell:
+            self.row, self.col = None, 0
+
+    def lfun_flex_insert(self, argument):
+        basic_type, language = argument.strip().split(":")[-2:]
+        if self.current_cell():
+            self.item += 1 # Insets are not nested in the mock.
+        self.items.insert(self.item, MockCell(basic_type, language))
+        self.row, self.col = 0, 0
+        self.selection = False
+
+    def lfun_self_insert(self, argument):
+        if self.current_cell():
+            self.insert_text(argument)
+
+    def lfun_newline_insert(self, argument):
+        if self.current_cell():
+            self.insert_text("\n")
+
+    def lfun_file_insert_plaintext(self, argument):
+        if not self.current_cell():
+            raise LfunError("Command disabled")
+        with open(argument.strip(), "r") as text_file:
+            self.insert_text(text_file.read())
+
+    def lfun_char_delete_forward(self, argument):
+        cell = self.current_cell()
+        if not cell:
+            return
+        if self.selection:
+            self.delete_selection()
+        elif self.col < len(cell.lines[self.row]):
+            line = cell.lines[self.row]
+            cell.lines[self.row] = line[:self.col] + line[self.col+1:]
+        elif self.row < len(cell.lines) - 1:
+            cell.lines[self.row] += cell.lines.pop(self.row + 1)
+
+    def lfun_char_delete_backward(self, argument):
+        cell = self.current_cell()
+        if not cell:
+            return
+        if self.selection:
+            self.delete_selection()
+        elif self.col > 0 or self.row > 0:
+            self.lfun_char_left("")
+            self.lfun_char_delete_forward("")
+
+    def lfun_word_find_forward(self, argument):
+        self.find_text(argument, forward=True)
+
+    def lfun_word_find_backward(self, argument):
+        self.find_text(argument, forward=False)
+
+    def lfun_inset_edit(self, argument):
+        cell = self.current_cell()
+        if not cell:
+            raise LfunError("Command disabled")
+        filename = "{}_inset_edit_{}.txt".format(self.pipe_in_filename[:-3], self.item)
+        with open(filename, "w") as text_file:
+            text_file.write("\n".join(cell.lines))
+        return filename
+
+    def lfun_inset_end_edit(self, argument):
+        pass
+
+    def lfun_inset_insert(self, argument):
+        pass
+
+    def lfun_math_space(self, argument):
+        raise LfunError("Command disabled")
+
+    def lfun_math_insert(self, argument):
+        raise LfunError("Command disabled")
+
+    #
+    # Helper routines for the LFUNs.
+    #
+
+    def clamp_cursor(self):
+        """Move the cursor inside the current cell's text if it is beyond it."""
+        cell = self.current_cell()
+        self.row = max(0, min(self.row, len(cell.lines) - 1))
+        self.col = max(0, min(self.col, len(cell.lines[self.row])))
+
+    def delete_selection(self):
+        """Delete the selected text, which is always all the text in the cell."""
+        self.current_cell().lines = [""]
+        self.row, self.col = 0, 0
+        self.selection = False
+
+    def insert_text(self, text):
+        """Insert text at the cursor, replacing any selection, and leave the
+        cursor after it."""
+        if self.selection:
+            self.delete_selection()
+        cell = self.current_cell()
+        line = cell.lines[self.row]
+        before, after = line[:self.col], line[self.col:]
+        new_lines = (before + text).split("\n")
+        start_row = self.row
+        self.row = start_row + len(new_lines) - 1
+        self.col = len(new_lines[-1])
+        new_lines[-1] += after
+        cell.lines[start_row:start_row+1] = new_lines
+
+    def find_text(self, text, forward):
+        """Search the cell text for `text` and move the cursor to the end (forward)
+        or the beginning (backward) of the first match.  Only matches starting
+        after the cursor (forward) or before it (backward) count."""
+        if self.row is None:
+            cursor = (self.item, -1, 0)
+        else:
+            cursor = (self.item, self.row, self.col)
+        matches = []
+        for item_num, cell in enumerate(self.items):
+            if not isinstance(cell, MockCell):
+                continue
+            for row, line in enumerate(cell.lines):
+                col = line.find(text)
+                while col != -1:
+                    matches.append((item_num, row, col))
+                    col = line.find(text, col + 1)
+        if forward:
+            matches = [m for m in matches if m >= cursor]
+        else:
+            matches = [m for m in reversed(matches) if m < cursor]
+        if not matches:
+            return
+        self.item, self.row, self.col = matches[0]
+        if forward:
+            self.col += len(text)
+        self.selection = False
@@ -0,0 +1,134 @@
+"""
+
+A generator of synthetic .lyx documents for testing and benchmarking the
+parsing and writing of .lyx files.
+
+The header, the end and the prose of the documents are taken from a template
+.lyx file, by default `plain_test_file.lyx`.  The body alternates the prose of
+the template with paragraphs holding a code cell and its output cell.  The code
+cells mix languages and have long lines, backslashes and double quotes, which
+Lyx writes as `\\backslash` lines and as `\\begin_inset Quotes` insets.
+
+Typical use::
+
+    document = make_synthetic_lyx_document(num_cells=100, lines_per_cell=10)
+    assert [cell.text_code_lines for cell in ...] == document.code_cells
+
+"""
+
+import os
+import random
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+default_template_filename = os.path.join(test_dir, "plain_test_file.lyx")
+
+cell_begin_prefix = "\\begin_inset Flex LyxNotebookCell:"
+
+default_languages = ("Python", "PythonTwo", "Bash", "R")
+
+words = ["alpha", "beta", "gamma", "delta", "x", "y", "z", "total", "count",
+         "value", "result", "data", "print", "for", "in", "if", "return", "0",
+         "1", "42", "3.14", "+", "-", "*", "==", "(", ")", "[", "]", ","]
+
+
+class SyntheticLyxDocument(str):
+    """The Lyx-format text of a synthetic document (it is a string), with the
+    attribute `code_cells`, the list of tuples `(basic_type, language,
+    text_lines)` of its code cells in document order."""
+
+
+def read_template(template_filename):
+    """Return a tuple `(header, prose, ending)` of strings from the .lyx file
+    `template_filename`.  The header runs through the `\\begin_body` line, the
+    prose is the body before the paragraph holding the first cell, and the
+    ending runs from the `\\end_body` line."""
+    with open(template_filename) as template_file:
+        template = template_file.read()
+    body_start = template.index("\\begin_body\n") + len("\\begin_body\n")
+    body_end = template.rindex("\\end_body")
+    first_cell = template.find("\n" + cell_begin_prefix, body_start, body_end)
+    if first_cell == -1:
+        prose_end = body_end
+    else:
+        prose_end = template.rindex("\n\\begin_layout", body_start, first_cell) + 1
+    return template[:body_start], template[body_start:prose_end], template[body_end:]
+
+
+def make_code_line(rng):
+    """Return a random line of code (without a newline)."""
+    kind = rng.random()
+    indent = " " * rng.choice([0, 0, 4, 8])
+    if kind < 0.1: # A long line, which Lyx wraps.
+        return indent + " ".join(rng.choice(words) for i in range(rng.randint(25, 45)))
+    if kind < 0.25:
+        return indent + 'print("{} {}")'.format(rng.choice(words), rng.choice(words))
+    if kind < 0.35:
+        return indent + 'pattern = r"\\{}\\s+{}"'.format(rng.choice(words), rng.choice(words))
+    if kind < 0.4:
+        return ""
+    return indent + " ".join(rng.choice(words) for i in range(rng.randint(2, 10)))
+
+
+def text_line_to_lyx_lines(text_line):
+    """Return the Lyx-format lines, without newlines, of the Plain Layout for
+    the line `text_line` of a cell, the way Lyx writes it.  Long lines are
+    broken after spaces (the break is not part of the text), backslashes become
+    `\\backslash` lines and double quotes become quote insets."""
+    lyx_lines = ["\\begin_layout Plain Layout", ""]
+    current = ""
+    for char in text_line:
+        if char == "\\":
+            lyx_lines.extend([current, "\\backslash"])
+            current = ""
+        elif char == '"':
+            lyx_lines.extend([current, "\\begin_inset Quotes eld", "\\end_inset", ""])
+            current = ""
+        else:
+            current += char
+            if char == " " and len(current) > 70:
+                lyx_lines.append(current)
+                current = ""
+    lyx_lines.extend([current, "\\end_layout", ""])
+    return lyx_lines
+
+
+def cell_lyx_lines(basic_type, language, text_lines):
+    """Return the Lyx-format lines, without newlines, of a cell inset."""
+    lyx_lines = [cell_begin_prefix + "{}:{}".format(basic_type, language),
+                 "status open", ""]
+    for text_line in text_lines or [""]:
+        lyx_lines.extend(text_line_to_lyx_lines(text_line))
+    lyx_lines.extend(["\\end_inset", "", ""])
+    return lyx_lines
+
+
+def make_synthetic_lyx_document(num_cells, lines_per_cell, *, seed=0,
+                                languages=default_languages, num_init_cells=2,
+                                output_lines=3, prose_repeats=1,
+                                template_filename=default_template_filename):
+    """Return a `SyntheticLyxDocument` with `num_cells` code cells of
+    `lines_per_cell` lines each, in random languages from `languages`, each
+    followed by an output cell with `output_lines` lines.  The first
+    `num_init_cells` cells are Init cells.  The prose of the template is put
+    `prose_repeats` times before each cell.  The same `seed` always gives
+    the same document."""
+    rng = random.Random(seed)
+    header, prose, ending = read_template(template_filename)
+    pieces = [header]
+    code_cells = []
+    for i in range(num_cells):
+        pieces.append(prose * prose_repeats)
+        basic_type = "Init" if i < num_init_cells else "Standard"
+        language = rng.choice(languages)
+        text_lines = [make_code_line(rng) for j in range(lines_per_cell)]
+        output_text_lines = [make_code_line(rng) for j in range(output_lines)]
+        code_cells.append((basic_type, language, [line + "\n" for line in text_lines]))
+        lyx_lines = ["\\begin_layout Standard", "Cell {} of the document.".format(i)]
+        lyx_lines += cell_lyx_lines(basic_type, language, text_lines)
+        lyx_lines += cell_lyx_lines("Output", language, output_text_lines)
+        lyx_lines += ["\\end_layout", ""]
+        pieces.append("\n".join(lyx_lines) + "\n")
+    pieces.append(ending)
+    document = SyntheticLyxDocument("".join(pieces))
+    document.code_cells = code_cells
+    return document
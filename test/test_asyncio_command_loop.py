@@ -0,0 +1,65 @@
+"""
+
+Tests of the thread handling of `AsyncioCommandLoop`: popups from commands
+running in the worker thread are shown in the event loop thread, and keys
+pressed during a multi-cell evaluation are halt requests.
+
+"""
+
+import asyncio
+import threading
+import types
+
+from lyxnotebook import gui
+from lyxnotebook.asyncio_command_loop import AsyncioCommandLoop
+from lyxnotebook.command_queue import CoalescingCommandQueue
+
+
+def make_command_loop():
+    controller = types.SimpleNamespace(lyx_process=None, keymap={"F1": "evaluate current cell"},
+                                       command_queue=CoalescingCommandQueue(),
+                                       get_menu_choices=lambda: [],
+                                       checking_for_halt=False,
+                                       halt_key_pressed=threading.Event())
+    return AsyncioCommandLoop(controller)
+
+
+def test_popups_from_worker_run_in_loop_thread(monkeypatch):
+    popup_threads = []
+    monkeypatch.setattr(gui.sg, "popup_yes_no",
+                        lambda *args, **kwargs: popup_threads.append(
+                                               threading.current_thread()) or "Yes")
+    command_loop = make_command_loop()
+
+    async def main():
+        command_loop.loop = asyncio.get_running_loop()
+        command_loop.loop_thread = threading.current_thread()
+        monkeypatch.setattr(gui, "gui_thread_caller", command_loop.call_in_loop_thread)
+        replies = []
+        await command_loop.run_in_worker_thread(
+                lambda: replies.append(gui.yesno_popup("Halt?")))
+        assert gui.yesno_popup("From the loop thread.")
+        return replies
+
+    assert asyncio.run(main()) == [True]
+    assert popup_threads == [threading.main_thread()] * 2
+
+
+def test_key_during_multi_cell_evaluation_requests_halt():
+    command_loop = make_command_loop()
+    controller = command_loop.controller
+
+    async def main():
+        command_loop.loop = asyncio.get_running_loop()
+        command_loop.commands_queued = asyncio.Event()
+        command_loop.running_key_action = "evaluate all code cells"
+        controller.checking_for_halt = True
+        command_loop.handle_key("F1")
+        assert controller.halt_key_pressed.is_set()
+        assert not controller.command_queue
+        controller.checking_for_halt = False
+        command_loop.handle_key("F1")
+        assert [c.key_action for c in controller.command_queue.clear()] == [
+                                                          "evaluate current cell"]
+
+    asyncio.run(main())
@@ -0,0 +1,132 @@
+"""
+
+Tests that parsing Lyx strings with a `CellParseCache` gives the same cells as
+parsing without one, while reparsing only the cells that changed, and tests of
+the `CellIndex` filled in while parsing and of the lazily-made `Cell` lines.
+
+"""
+
+import pytest
+
+from lyxnotebook.config_file_processing import config_dict
+from lyxnotebook.parse_and_write_lyx_files import (CellParseCache, CellIndex,
+                                        code_text_hash, get_all_cell_text_from_lyx_string)
+from mock_lyx_server import make_lyx_document
+
+cookie = ">==>-"
+
+
+@pytest.fixture(autouse=True)
+def cookie_config(monkeypatch):
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", False)
+    monkeypatch.setitem(config_dict, "has_editable_insets", True)
+
+
+def cell_data(cell_list):
+    return [c if isinstance(c, str) else (c.get_cell_type(), c.text_code_lines,
+            c.lyx_starting_lines, c.lyx_code_lines, c.lyx_ending_lines,
+            c.starting_line_number, c.ending_line_number) for c in cell_list]
+
+
+@pytest.mark.parametrize("options", [{}, {"also_noncell": True}, {"init": False}])
+def test_cached_parse_matches_uncached(options):
+    parse_cache = CellParseCache()
+    lyx_string = make_lyx_document(6)
+    uncached = get_all_cell_text_from_lyx_string(lyx_string, cookie, **options)
+    for i in range(2):
+        cached = get_all_cell_text_from_lyx_string(lyx_string, cookie,
+                                                   parse_cache=parse_cache, **options)
+        assert cell_data(cached) == cell_data(uncached)
+
+
+def test_only_changed_cells_are_reparsed():
+    parse_cache = CellParseCache()
+    lyx_string = make_lyx_document(6)
+    get_all_cell_text_from_lyx_string(lyx_string, cookie, parse_cache=parse_cache)
+    assert parse_cache.num_cells_parsed == 6
+
+    changed_string = lyx_string.replace("x3 = 3", "x3 = 33")
+    cells = get_all_cell_text_from_lyx_string(changed_string, cookie,
+                                              parse_cache=parse_cache)
+    assert parse_cache.num_cells_parsed == 7
+    assert cells[3].text_code_lines[0] == "x3 = 33\n"
+
+
+@pytest.mark.parametrize("max_cached_cells", [3, 1])
+def test_cache_eviction_keeps_document_usable(monkeypatch, max_cached_cells):
+    monkeypatch.setattr(CellParseCache, "max_cached_cells", max_cached_cells)
+    parse_cache = CellParseCache()
+    for num_cells in [8, 4, 4, 8]:
+        lyx_string = make_lyx_document(num_cells)
+        uncached = get_all_cell_text_from_lyx_string(lyx_string, cookie)
+        for i in range(2):
+            cached = get_all_cell_text_from_lyx_string(lyx_string, cookie,
+                                                       parse_cache=parse_cache)
+            assert cell_data(cached) == cell_data(uncached)
+        assert len(parse_cache.cells_by_hash) <= max(max_cached_cells, num_cells)
+
+
+def test_returned_cells_are_copies():
+    parse_cache = CellParseCache()
+    lyx_string = make_lyx_document(2)
+    cells = get_all_cell_text_from_lyx_string(lyx_string, cookie, parse_cache=parse_cache)
+    cells[1].text_code_lines.append("changed\n")
+    cells[1].evaluation_output = ["output\n"]
+    cells = get_all_cell_text_from_lyx_string(lyx_string, cookie, parse_cache=parse_cache)
+    assert cells[1].text_code_lines == ["x1 = 1\n", "print(x1 * 2)\n"]
+    assert cells[1].evaluation_output is None
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+def test_cell_index_finds_cells_by_code(use_cache):
+    parse_cache = CellParseCache() if use_cache else None
+    lyx_string = make_lyx_document(4).replace("x3 = 3\n", "x1 = 1\n")
+    lyx_string = lyx_string.replace("print(x3 * 2)", "print(x1 * 2)")
+    for i in range(2): # The second time comes from the cache, if used.
+        cell_index = CellIndex()
+        cells = get_all_cell_text_from_lyx_string(lyx_string, cookie, also_noncell=True,
+                                 parse_cache=parse_cache, cell_index=cell_index)
+        assert len(cell_index.entries) == 4
+        assert cell_index.find_ordinals(["x2 = 2\n", "print(x2 * 2)\n"]) == [2]
+        assert cell_index.find_ordinals(["x1 = 1\n", "print(x1 * 2)\n"]) == [1, 3]
+        assert cell_index.find_ordinals(["no such code\n"]) == []
+        entry = cell_index.entries[2]
+        assert cells[entry.list_index].text_code_lines[0] == "x2 = 2\n"
+        assert (entry.basic_type, entry.language) == ("Standard", "Python")
+
+
+def test_cell_lines_are_made_when_used():
+    lyx_string = make_lyx_document(3).replace("x1 = 1", cookie + "x1 = 1")
+    cells = get_all_cell_text_from_lyx_string(lyx_string, cookie)
+    assert not hasattr(cells[0], "__dict__")
+    assert cells[1].has_cookie_inside
+    assert cells[1].text_code_lines == ["x1 = 1\n", "print(x1 * 2)\n"]
+    assert cells[2]._text_code_lines is None # Not made until used.
+    assert list(cells[2]) == ["x2 = 2\n", "print(x2 * 2)\n"]
+    assert cells[2].lyx_string_format().endswith("\\end_inset\n")
+    assert cells[2].code_hash == code_text_hash(["x2 = 2\n", "print(x2 * 2)\n"])
+    cells[2].text_code_lines = ["changed\n"]
+    assert cells[2][0] == "changed\n" and len(cells[2]) == 1
+    cells[2].create_empty_cell()
+    assert cells[2].lyx_code_lines == [] and cells[2].code_hash is None
+
+
+def test_code_hash_follows_changes_to_the_code():
+    cell = get_all_cell_text_from_lyx_string(make_lyx_document(2), cookie)[1]
+    assert cell.code_hash == code_text_hash(["x1 = 1\n", "print(x1 * 2)\n"])
+    cell.append("x1 += 1\n")
+    assert cell.code_hash == code_text_hash(["x1 = 1\n", "print(x1 * 2)\n", "x1 += 1\n"])
+    cell[0] = "x1 = 5\n"
+    assert cell.code_hash == code_text_hash(["x1 = 5\n", "print(x1 * 2)\n", "x1 += 1\n"])
+    cell.text_code_lines = ["pass\n"]
+    assert cell.code_hash == code_text_hash(["pass\n"])
+
+    # Setting the Lyx-format lines leaves the text lines, and so the hash, alone
+    # (even when the text lines weren't made yet).
+    for use_hash_first in [True, False]:
+        cell = get_all_cell_text_from_lyx_string(make_lyx_document(2), cookie)[1]
+        if use_hash_first:
+            assert cell.code_hash == code_text_hash(["x1 = 1\n", "print(x1 * 2)\n"])
+        cell.lyx_code_lines = ["\\begin_layout Plain Layout", "y = 2", "\\end_layout", ""]
+        assert cell.text_code_lines == ["x1 = 1\n", "print(x1 * 2)\n"]
+        assert cell.code_hash == code_text_hash(cell.text_code_lines)
@@ -0,0 +1,87 @@
+"""
+
+Tests of getting the cells of a master document merged with the cells of its
+child documents.
+
+"""
+
+import os
+import pytest
+
+from lyxnotebook.config_file_processing import config_dict
+from lyxnotebook.child_documents import (find_child_documents,
+                                         get_all_cell_text_with_child_documents)
+from mock_lyx_server import MockCell, make_lyx_document
+
+cookie = ">==>-"
+
+
+@pytest.fixture(autouse=True)
+def cookie_config(monkeypatch):
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", False)
+    monkeypatch.setitem(config_dict, "has_editable_insets", True)
+
+
+def include_inset(filename):
+    return ("\\begin_layout Standard\n\\begin_inset CommandInset include\n"
+            "LatexCommand include\nfilename \"{}\"\n\n\\end_inset\n\n\n"
+            "\\end_layout\n\n".format(filename))
+
+
+def make_document(name, num_cells, includes=()):
+    """Return a document with `num_cells` cells whose code is tagged with
+    `name`, followed by include insets for the filenames `includes`."""
+    document = make_lyx_document(num_cells, num_init_cells=0)
+    for i in range(num_cells):
+        document = document.replace("x{} = {}\n".format(i, i),
+                                    "{} = {}\n".format(name, i))
+    return document.replace("\\end_body", "".join(include_inset(filename)
+                                                  for filename in includes)
+                            + "\\end_body")
+
+
+def cell_names(cells):
+    return [cell.text_code_lines[0].split(" = ")[0] + cell.text_code_lines[0][-2]
+            for cell in cells]
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_child_cells_are_merged_in_order(tmp_path, max_workers):
+    os.mkdir(tmp_path / "chapters")
+    with open(tmp_path / "chapters" / "one.lyx", "w") as lyx_file:
+        lyx_file.write(make_document("one", 2, ["grandchild.lyx"]))
+    with open(tmp_path / "chapters" / "grandchild.lyx", "w") as lyx_file:
+        lyx_file.write(make_document("grand", 1))
+    with open(tmp_path / "two.lyx", "w") as lyx_file:
+        lyx_file.write(make_document("two", 1, ["two.lyx"])) # Includes itself.
+
+    # Put the includes between the cells of the master.
+    master = make_document("master", 2)
+    second_cell = master.index("\\begin_layout Standard\nParagraph 1 ")
+    master = (master[:second_cell] + include_inset("chapters/one.lyx")
+              + master[second_cell:].replace("\\end_body", include_inset("two.lyx")
+                                             + include_inset("missing.lyx")
+                                             + "\\end_body"))
+
+    assert [os.path.basename(filename) for line_num, filename
+            in find_child_documents(master, str(tmp_path))] == [
+                                        "one.lyx", "two.lyx", "missing.lyx"]
+    cells = get_all_cell_text_with_child_documents(master, str(tmp_path), cookie,
+                                                   max_workers=max_workers)
+    assert cell_names(cells) == ["master0", "one0", "one1", "grand0", "master1",
+                                 "two0"]
+
+
+@pytest.mark.parametrize("max_workers", [1, 2])
+def test_truncated_child_document(tmp_path, max_workers):
+    # A child with no \end_document line, as when it is only partly saved.
+    truncated = make_document("cut", 2)
+    truncated = truncated[:truncated.index("\\end_body")]
+    with open(tmp_path / "cut.lyx", "w") as lyx_file:
+        lyx_file.write(truncated)
+    with open(tmp_path / "whole.lyx", "w") as lyx_file:
+        lyx_file.write(make_document("whole", 1))
+    master = make_document("master", 1, ["cut.lyx", "whole.lyx"])
+    cells = get_all_cell_text_with_child_documents(master, str(tmp_path), cookie,
+                                                   max_workers=max_workers)
+    assert cell_names(cells) == ["master0", "cut0", "cut1", "whole0"]
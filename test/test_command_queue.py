@@ -0,0 +1,45 @@
+"""
+
+Tests of the `CoalescingCommandQueue` which holds commands for keys pressed
+while another command runs.
+
+"""
+
+from lyxnotebook.command_queue import CoalescingCommandQueue
+
+
+def queued(queue):
+    return [(c.key_action, c.count) for c in queue.commands]
+
+
+def test_goto_burst_becomes_count():
+    queue = CoalescingCommandQueue()
+    for i in range(3):
+        queue.push("goto next code cell")
+    queue.push("goto prev code cell")
+    assert queued(queue) == [("goto next code cell", 3), ("goto prev code cell", 1)]
+    assert queue.num_merged["goto next code cell"] == 2
+
+
+def test_repeated_evaluate_collapses_unless_cursor_moved():
+    queue = CoalescingCommandQueue()
+    for i in range(3):
+        queue.push("evaluate current cell")
+    queue.push("goto next code cell")
+    queue.push("evaluate current cell")
+    assert queued(queue) == [("evaluate current cell", 1), ("goto next code cell", 1),
+                             ("evaluate current cell", 1)]
+
+
+def test_superseded_commands_are_dropped():
+    queue = CoalescingCommandQueue()
+    queue.push("evaluate current cell")
+    queue.push("open all cells")
+    queue.push("close all output cells")
+    queue.push("close all cells")
+    queue.push("evaluate all init cells")
+    queue.push("evaluate all code cells")
+    assert queued(queue) == [("evaluate current cell", 1), ("close all cells", 1),
+                             ("evaluate all code cells", 1)]
+    assert queue.pop().key_action == "evaluate current cell"
+    assert len(queue.clear()) == 2 and not queue
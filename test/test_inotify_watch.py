@@ -0,0 +1,35 @@
+"""
+
+Tests of the inotify watch used to read finished exports from Lyx.
+
+"""
+
+import os
+import pytest
+
+from lyxnotebook.inotify_watch import InotifyWatch
+
+try:
+    InotifyWatch(os.getcwd()).close()
+except OSError:
+    pytest.skip("inotify is not available", allow_module_level=True)
+
+
+def test_finished_files_are_reported(tmp_path):
+    watch = InotifyWatch(str(tmp_path))
+    assert not watch.wait_for_file("written.lyx", 0)
+    with open(tmp_path / "written.lyx", "w") as f:
+        f.write("text")
+    assert watch.wait_for_file("written.lyx", 1)
+
+    other_dir = tmp_path / "other"
+    other_dir.mkdir()
+    (other_dir / "moved.lyx").write_text("text")
+    os.rename(other_dir / "moved.lyx", tmp_path / "moved.lyx")
+    assert watch.wait_for_file("moved.lyx", 1)
+
+    with open(tmp_path / "stale.lyx", "w") as f:
+        f.write("text")
+    watch.discard_pending()
+    assert not watch.wait_for_file("stale.lyx", 0)
+    watch.close()
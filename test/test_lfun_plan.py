@@ -0,0 +1,33 @@
+"""
+
+Tests of compiling an `LfunPlan` into server commands.
+
+"""
+
+from lyxnotebook.lfun_plan import LfunPlan
+
+
+def test_consecutive_commands_are_fused():
+    plan = LfunPlan()
+    plan.commands("inset-select-all", "escape", "inset-toggle open")
+    math_space = plan.query("math-space", warn=False)
+    layout = plan.query("server-get-layout")
+    plan.command("char-left")
+    assert (math_space, layout) == (0, 1)
+    assert plan.compile() == [
+            ("command-sequence", "inset-select-all;escape;inset-toggle open", True, False),
+            ("math-space", "", False, True),
+            ("server-get-layout", "", True, True),
+            ("char-left", "", True, False)]
+
+
+def test_commands_with_semicolons_are_sent_alone():
+    plan = LfunPlan()
+    plan.command("inset-select-all")
+    plan.command("math-insert", "x;y")
+    plan.command("server-set-xy", "0 0")
+    assert plan.compile() == [
+            ("inset-select-all", "", True, False),
+            ("math-insert", "x;y", True, False),
+            ("server-set-xy", "0 0", True, False)]
+    assert LfunPlan().compile() == []
@@ -0,0 +1,62 @@
+"""
+
+Tests of the LFUN timing statistics and reports.
+
+"""
+
+import csv
+import json
+import pytest
+
+from lyxnotebook.lfun_timing import LfunTimingStats, percentile
+
+
+def test_percentile_is_nearest_rank():
+    values = list(range(1, 101))
+    assert percentile(values, 50) == 50
+    assert percentile(values, 99) == 99
+    assert percentile([7], 90) == 7
+
+
+def make_stats():
+    stats = LfunTimingStats()
+    for i in range(10):
+        stats.record_lfun("evaluate current cell", "inside_math_inset", "math-space",
+                          0.001 * (i + 1), 30, 40)
+    stats.record_lfun("evaluate current cell", "inside_cell", "server-get-layout",
+                      0.5, 35, 50)
+    stats.record_lfun("goto next any cell", "goto_next_cell", "inset-forall",
+                      0.002, 90, 30)
+    stats.record_key_action("evaluate current cell", 1.0)
+    return stats
+
+
+def test_report_rows_are_grouped_and_ordered():
+    rows = make_stats().report_rows()
+    assert [(r["key_action"], r["lfun"]) for r in rows] == [
+            ("evaluate current cell", "server-get-layout"),
+            ("evaluate current cell", "math-space"),
+            ("goto next any cell", "inset-forall")]
+    math_row = rows[1]
+    assert math_row["count"] == 10
+    assert math_row["p90_secs"] == pytest.approx(0.009)
+    assert math_row["bytes_out"] == 300 and math_row["bytes_in"] == 400
+
+
+def test_key_action_summary():
+    summary = make_stats().report_key_actions()
+    assert summary["evaluate current cell"]["count"] == 1
+    assert summary["evaluate current cell"]["lfun_count"] == 11
+    assert summary["goto next any cell"]["count"] == 0
+    assert "inside_math_inset" in make_stats().report_string()
+
+
+def test_report_files(tmp_path):
+    stats = make_stats()
+    stats.write_report_file(str(tmp_path / "report.json"))
+    with open(tmp_path / "report.json") as report_file:
+        assert len(json.load(report_file)["lfuns"]) == 3
+    stats.write_report_file(str(tmp_path / "report.csv"))
+    with open(tmp_path / "report.csv", newline="") as report_file:
+        assert [r["helper"] for r in csv.DictReader(report_file)] == [
+                "inside_cell", "inside_math_inset", "goto_next_cell"]
@@ -10,3 +10,129 @@ import lyxnotebook
 
 # TODO
 
+
+import os
+import pytest
+from lyxnotebook.config_file_processing import config_dict
+from lyxnotebook.parse_and_write_lyx_files import (count_cells_in_lyx_string,
+                                         scan_lyx_lines_for_cell_insets,
+                                         scan_lyx_string_for_cell_insets,
+                                         get_all_cell_text_from_lyx_string,
+                                         get_lyx_string_from_cell_list,
+                                         CellParseCache)
+from synthetic_lyx_documents import make_synthetic_lyx_document
+from mock_lyx_server import make_lyx_document
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+
+
+def test_count_cells_in_lyx_string():
+    with open(os.path.join(test_dir, "testInteractWithLyxCells.lyx")) as lyx_file:
+        lyx_string = lyx_file.read()
+    counts = count_cells_in_lyx_string(lyx_string)
+    header_lines = [line for line in lyx_string.splitlines()
+                    if line.startswith(r"\begin_inset Flex LyxNotebookCell:")]
+    assert sum(counts.values()) == len(header_lines)
+    assert count_cells_in_lyx_string(
+            "\\begin_inset Flex LyxNotebookCell:Init:Python\n"
+            "\\begin_inset Flex LyxNotebookCell:Output:Python \n"
+            "\\begin_inset Flex LyxNotebookCell:Standard:Python\n"
+            "\\begin_inset Flex LyxNotebookCell:Standard:Python\n"
+            ) == {("Init", "Python"): 1, ("Output", "Python"): 1,
+                  ("Standard", "Python"): 2}
+
+
+@pytest.mark.parametrize("options", [{}, {"code_language": "Python"},
+                                     {"init": False}, {"keep_text": False}])
+def test_string_scanner_matches_line_scanner(options):
+    with open(os.path.join(test_dir, "testInteractWithLyxCells.lyx")) as lyx_file:
+        lyx_string = lyx_file.read()
+    cookie = ">==>-"
+    lyx_string = lyx_string.replace("\\begin_body\n", "\\begin_body\n"
+                                    + cookie + " in the prose\n", 1)
+    for test_string in [lyx_string, lyx_string.rstrip("\n"),
+                        lyx_string[:len(lyx_string)//2]]:
+        line_scan = list(scan_lyx_lines_for_cell_insets(test_string.splitlines(),
+                                                        cookie, **options))
+        string_scan = list(scan_lyx_string_for_cell_insets(test_string, cookie,
+                                                           **options))
+        assert string_scan == line_scan
+        assert line_scan[0][1] == 1 # The cookie line.
+
+
+def test_synthetic_document_round_trip(monkeypatch):
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", False)
+    monkeypatch.setitem(config_dict, "has_editable_insets", True)
+    cookie = ">==>-"
+    document = make_synthetic_lyx_document(40, 8, seed=5)
+    all_cells = get_all_cell_text_from_lyx_string(document, cookie, also_noncell=True)
+    cells = [(c.basic_type, c.language, c.text_code_lines) for c in all_cells
+             if not isinstance(c, str)]
+    assert cells == document.code_cells
+    assert any('"' in line for basic_type, language, lines in cells for line in lines)
+    assert any("\\" in line for basic_type, language, lines in cells for line in lines)
+
+    new_document = get_lyx_string_from_cell_list(all_cells)
+    new_cells = get_all_cell_text_from_lyx_string(new_document, cookie)
+    assert [(c.basic_type, c.language, c.text_code_lines)
+            for c in new_cells] == document.code_cells
+
+
+def test_output_cells_following_code_cells(monkeypatch):
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", False)
+    monkeypatch.setitem(config_dict, "has_editable_insets", True)
+    cookie = ">==>-"
+    lyx_string = make_lyx_document(3)
+    # Take away the output cell of the last code cell.
+    output_start = lyx_string.rindex("\n\n\\begin_inset Flex LyxNotebookCell:Output")
+    output_end = lyx_string.index("\\end_inset\n", output_start) + len("\\end_inset\n")
+    lyx_string = lyx_string[:output_start] + lyx_string[output_end:]
+    parse_cache = CellParseCache()
+    for changed_output in [False, True]:
+        if changed_output:
+            lyx_string = lyx_string.replace("\n2\n\\end_layout", "\n3\n\\end_layout")
+        for options in [{}, {"parse_cache": parse_cache}, {"parse_cache": parse_cache}]:
+            cells = get_all_cell_text_from_lyx_string(lyx_string, cookie, **options)
+            assert cells[0].output_matches(["0\n"])
+            assert cells[1].output_matches(["3\r\n"] if changed_output
+                                           else ["2\n"])
+            assert not cells[1].output_matches(["4\n"])
+            assert cells[2].output_inset_text is None
+            assert not cells[2].output_matches([])
+            assert [c.following_inset for c in cells] == ["output", "output", "none"]
+
+    line_scan = list(scan_lyx_lines_for_cell_insets(lyx_string.splitlines(), cookie))
+    string_scan = list(scan_lyx_string_for_cell_insets(lyx_string, cookie))
+    assert string_scan == line_scan
+
+
+def test_what_follows_code_cells(monkeypatch):
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", False)
+    monkeypatch.setitem(config_dict, "has_editable_insets", True)
+    cookie = ">==>-"
+    lyx_string = make_lyx_document(6)
+    # Replace the output cells after the first with an empty output cell, a
+    # math inset, text, another inset and nothing (leaving the end of the
+    # paragraph), working from the end.
+    replacements = ["\n\n\\begin_inset Flex LyxNotebookCell:Output:Python\nstatus open\n\n"
+                        "\\begin_layout Plain Layout\n\n\\end_layout\n\n\\end_inset\n",
+                    "\n\n\\begin_inset Formula $x^{2}$\n\\end_inset\n",
+                    "\nsome text",
+                    "\n\n\\begin_inset Quotes eld\n\\end_inset\n",
+                    ""]
+    for replacement in reversed(replacements):
+        output_start = lyx_string.rindex("\n\n\\begin_inset Flex LyxNotebookCell:Output")
+        output_end = lyx_string.index("\\end_inset\n", output_start) + len("\\end_inset\n")
+        lyx_string = lyx_string[:output_start] + replacement + lyx_string[output_end:]
+
+    parse_cache = CellParseCache()
+    for options in [{}, {"parse_cache": parse_cache}, {"parse_cache": parse_cache}]:
+        cells = get_all_cell_text_from_lyx_string(lyx_string, cookie, **options)
+        assert [c.following_inset for c in cells] == ["output", "output", "math",
+                                                      "none", "other", "none"]
+        assert [c.output_is_empty for c in cells] == [False, True, False, False,
+                                                      False, False]
+
+    line_scan = list(scan_lyx_lines_for_cell_insets(lyx_string.splitlines(), cookie))
+    string_scan = list(scan_lyx_string_for_cell_insets(lyx_string, cookie))
+    assert string_scan == line_scan
@@ -0,0 +1,60 @@
+"""
+
+Tests of the framing of events read from the Lyx server output pipe.
+
+"""
+
+import os
+import fcntl
+
+from lyxnotebook.lyx_server_API_wrapper import LyxServerEventReader, LyxServerEvent
+
+
+def nonblocking_pipe():
+    read_fd, write_fd = os.pipe()
+    flags = fcntl.fcntl(read_fd, fcntl.F_GETFL)
+    fcntl.fcntl(read_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+    return read_fd, write_fd
+
+
+def test_events_come_out_in_order():
+    read_fd, write_fd = nonblocking_pipe()
+    reader = LyxServerEventReader(read_fd)
+    os.write(write_fd, b"NOTIFY:F4\nINFO:client:server-get-layout:Plain Layout\n"
+                       b"ERROR:client:math-space:Command disabled\n")
+    reader.read_available()
+    assert list(reader.events) == [
+            LyxServerEvent("NOTIFY", "", "", "F4"),
+            LyxServerEvent("INFO", "client", "server-get-layout", "Plain Layout"),
+            LyxServerEvent("ERROR", "client", "math-space", "Command disabled")]
+
+
+def test_partial_lines_are_kept_until_complete():
+    read_fd, write_fd = nonblocking_pipe()
+    reader = LyxServerEventReader(read_fd)
+    line = "INFO:client:server-get-filename:/home/üser/café.lyx\n".encode("utf-8")
+    split_point = line.index("é".encode("utf-8")) + 1 # Inside the multibyte char.
+    os.write(write_fd, line[:split_point])
+    reader.read_available()
+    assert not reader.events
+    os.write(write_fd, line[split_point:])
+    reader.read_available()
+    assert reader.events.popleft().data == "/home/üser/café.lyx"
+
+
+def test_long_reply_is_read_whole():
+    read_fd, write_fd = nonblocking_pipe()
+    reader = LyxServerEventReader(read_fd)
+    data = "x" * 5000
+    os.write(write_fd, "INFO:client:inset-edit:{}\n".format(data).encode("utf-8"))
+    assert reader.read_available() > 5000
+    assert reader.events.popleft().data == data
+    assert not reader.at_eof
+
+
+def test_eof_is_flagged():
+    read_fd, write_fd = nonblocking_pipe()
+    reader = LyxServerEventReader(read_fd)
+    os.close(write_fd)
+    reader.read_available()
+    assert reader.at_eof
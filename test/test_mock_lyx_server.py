@@ -0,0 +1,455 @@
+"""
+
+End-to-end tests of `InteractWithLyxCells` running against the mock Lyx server
+in `mock_lyx_server.py`.
+
+"""
+
+import os
+import copy
+import shutil
+import select
+import threading
+import tracemalloc
+import pytest
+
+from lyxnotebook.config_file_processing import config_dict, initialize_config_data
+from lyxnotebook import gui
+from lyxnotebook import controller_of_lyx_and_interpreters
+from lyxnotebook.lyx_server_API_wrapper import (InteractWithLyxCells,
+                           LyxServerClosedError, LyxServerWriteTimeout)
+from mock_lyx_server import (MockLyxServer, MockCell, make_lyx_document,
+                             parse_lyx_string)
+
+
+@pytest.fixture
+def server_and_lyx_process(tmp_path, monkeypatch):
+    config_dict["lyx_server_pipe"] = str(tmp_path / "lyxpipe")
+    config_dict["lyx_temporary_directory"] = str(tmp_path)
+    config_dict["magic_cookie_string"] = ">==>-"
+    config_dict["has_editable_insets_noeditor_mod"] = False
+    config_dict["has_editable_insets"] = True
+    config_dict["lyx_server_write_timeout_secs"] = 30
+    config_dict["export_to_session_directory"] = True
+    config_dict["include_child_documents"] = False
+    config_dict["single_pass_evaluate_all"] = True
+    config_dict["stream_output_to_lyx"] = False
+    monkeypatch.chdir(tmp_path)
+    buffer_filename = str(tmp_path / "document.lyx")
+    with open(buffer_filename, "w") as lyx_file:
+        lyx_file.write(make_lyx_document(3))
+    server = MockLyxServer(config_dict["lyx_server_pipe"], lyx_filename=buffer_filename)
+    lyx_process = InteractWithLyxCells("testClient")
+    yield server, lyx_process
+    lyx_process.finish_pending_lfuns()
+    lyx_process.server_event_selector.close()
+    if lyx_process.export_watch:
+        lyx_process.export_watch.close()
+    lyx_process.cell_text_file_pool.close()
+    os.close(lyx_process.lyx_server_pipe_in)
+    os.close(lyx_process.lyx_server_pipe_out)
+    server.stop()
+
+
+@pytest.fixture
+def controller(server_and_lyx_process, tmp_path, monkeypatch):
+    """A controller using the Lyx process of `server_and_lyx_process`, with the
+    other config settings from the default config file."""
+    server, lyx_process = server_and_lyx_process
+    saved_config = dict(config_dict)
+    user_dir = tmp_path / "lyx_user_dir"
+    os.mkdir(user_dir)
+    shutil.copy(os.path.join(config_dict["lyx_notebook_source_dir"],
+                             "default_config_file_and_data_files",
+                             "default_config_file.cfg"),
+                user_dir / "lyxnotebook.cfg")
+    initialize_config_data(str(user_dir))
+    config_dict.update(saved_config) # Keep the settings of the fixture.
+    monkeypatch.setattr(controller_of_lyx_and_interpreters, "InteractWithLyxCells",
+                        lambda clientname: lyx_process)
+    controller = controller_of_lyx_and_interpreters.ControllerOfLyxAndInterpreters(
+                                                                     "testClient")
+    yield controller
+    controller.all_interps.reset_all_interpreters_for_all_buffers()
+    config_dict.clear()
+    config_dict.update(saved_config)
+
+
+def test_get_all_cell_text(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    cells = lyx_process.get_all_cell_text()
+    assert [c.get_cell_type() for c in cells] == [("Init", "Python"),
+                                  ("Standard", "Python"), ("Standard", "Python")]
+    assert cells[1].text_code_lines == ["x1 = 1\n", "print(x1 * 2)\n"]
+
+
+def test_generated_cells_use_flat_memory(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    peak_sizes = []
+    for num_cells in [200, 2000]:
+        with server.lock:
+            server.items = parse_lyx_string(make_lyx_document(num_cells))
+        cells = lyx_process.generate_all_cell_text()
+        next(cells) # The buffer is exported now.
+        tracemalloc.start()
+        try:
+            num_generated = 1 + sum(1 for cell in cells)
+            peak_sizes.append(tracemalloc.get_traced_memory()[1])
+        finally:
+            tracemalloc.stop()
+        assert num_generated == num_cells
+    # Allow for the buffers of the mock server thread, which are also traced.
+    assert peak_sizes[1] < peak_sizes[0] + 200000
+
+
+def test_get_global_cell_info(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    assert lyx_process.get_global_cell_info() == (1, 2, 3)
+
+
+def test_get_all_cell_text_without_session_directory(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    lyx_process.export_watch = None # Use the polling method.
+    cells = lyx_process.get_all_cell_text()
+    assert len(cells) == 3
+    assert not os.path.exists(os.path.join(os.path.dirname(server.buffer_filename),
+                                           "tmp_save_file_lyx_notebook_xxxxx.lyxnotebook"))
+
+
+def test_write_all_cell_code_to_file(server_and_lyx_process, tmp_path):
+    server, lyx_process = server_and_lyx_process
+    code_filename = str(tmp_path / "document.py")
+    unused_filename = str(tmp_path / "document.sage")
+    lyx_process.write_all_cell_code_to_file([(code_filename, "Python", "#"),
+                                             (unused_filename, "Sage", "#")])
+    assert not os.path.exists(unused_filename)
+    with open(code_filename) as code_file:
+        code = code_file.read()
+    assert "# File of all Python cells" in code
+    assert code.index("# Init cell number 1.") < code.index("# Standard cell number 1.")
+    assert code.index("# Standard cell number 1.") < code.index("x1 = 1\n")
+    assert "# Standard cell number 2." in code
+
+
+def test_goto_next_and_prev_cell(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cells = server.cells(basic_types=("Init", "Standard"))
+    server.put_cursor_at_cell(code_cells[0])
+    lyx_process.goto_next_cell(output=False)
+    assert server.current_cell() is code_cells[1]
+    assert lyx_process.server_get_xy() == (0, 0)
+    lyx_process.goto_prev_cell(output=False)
+    assert server.current_cell() is code_cells[0]
+    assert not any(">==>-" in line for c in server.cells() for line in c.lines)
+
+
+def test_replace_output_cell_text(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cell = server.cells(basic_types=("Standard",))[0]
+    server.put_cursor_at_cell(code_cell)
+    cell = lyx_process.get_current_cell_text()
+    assert cell.text_code_lines == ["x1 = 1\n", "print(x1 * 2)\n"]
+    lyx_process.replace_current_output_cell_text(["first\n", "second\n"],
+                                                 assert_inside_cell=True)
+    lyx_process.finish_pending_lfuns()
+    output_cell = server.items[server.items.index(code_cell) + 1]
+    assert output_cell.basic_type == "Output"
+    assert output_cell.lines == ["first", "second"]
+
+
+def test_output_cell_is_created_when_missing(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cell = server.cells(basic_types=("Standard",))[0]
+    server.items.remove(server.items[server.items.index(code_cell) + 1])
+    server.put_cursor_at_cell(code_cell)
+    lyx_process.replace_current_output_cell_text(["new\n"], assert_inside_cell=True)
+    lyx_process.finish_pending_lfuns()
+    output_cell = server.items[server.items.index(code_cell) + 1]
+    assert isinstance(output_cell, MockCell) and output_cell.basic_type == "Output"
+    assert output_cell.lines == ["new"]
+
+
+def test_output_cell_writeback_cases(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cells = server.cells(basic_types=("Standard",))
+    output_cell = server.items[server.items.index(code_cells[0]) + 1]
+    output_cell.lines = [""] # An empty output cell.
+    server.put_cursor_at_cell(code_cells[0])
+    lyx_process.replace_current_output_cell_text(["a\n", "\n"], assert_inside_cell=True,
+                                                 goto_begin_after=True)
+    lyx_process.finish_pending_lfuns()
+    assert output_cell.lines == ["a", ""]
+    assert server.current_cell() is output_cell and lyx_process.server_get_xy() == (0, 0)
+
+    # With `create_if_necessary` false, the cursor ends up back in the code cell.
+    server.items.remove(server.items[server.items.index(code_cells[1]) + 1])
+    server.put_cursor_at_cell(code_cells[1])
+    lyx_process.replace_current_output_cell_text(["new\n"], assert_inside_cell=True,
+                                                 create_if_necessary=False)
+    lyx_process.finish_pending_lfuns()
+    assert server.current_cell() is code_cells[1]
+    assert len(server.cells(basic_types=("Output",))) == 2
+
+
+def test_output_cell_writeback_from_snapshot(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cells = server.cells(basic_types=("Init", "Standard"))
+    output_cells = server.cells(basic_types=("Output",))
+    output_cells[1].lines = [""]
+    server.items.remove(output_cells[2])
+    snapshot = lyx_process.get_all_cell_text()
+    assert [c.following_inset for c in snapshot] == ["output", "output", "none"]
+    for code_cell, snapshot_cell in zip(code_cells, snapshot):
+        server.put_cursor_at_cell(code_cell)
+        num_commands = server.num_commands
+        lyx_process.replace_current_output_cell_text(["new\n"], assert_inside_cell=True,
+                                                     code_cell=snapshot_cell)
+        lyx_process.finish_pending_lfuns()
+        assert server.num_commands == num_commands + 1 # A single command-sequence.
+    assert [c.lines for c in server.cells(basic_types=("Output",))] == [["new"]] * 3
+    assert server.items[server.items.index(code_cells[2]) + 1].basic_type == "Output"
+
+
+def test_streamed_output_returns_cursor_to_code_cell(server_and_lyx_process):
+    # As in `ControllerOfLyxAndInterpreters.write_partial_output`.
+    server, lyx_process = server_and_lyx_process
+    code_cells = server.cells(basic_types=("Standard",))
+    server.items.remove(server.items[server.items.index(code_cells[1]) + 1])
+    snapshot = lyx_process.get_all_cell_text()
+    for code_cell, snapshot_cell in zip(code_cells, snapshot[1:]):
+        server.put_cursor_at_cell(code_cell)
+        lyx_process.replace_current_output_cell_text(["partial\n"],
+                      assert_inside_cell=True, goto_begin_after=True,
+                      code_cell=snapshot_cell)
+        lyx_process.submit_lfun("command-sequence", "char-left;char-left")
+        lyx_process.finish_pending_lfuns()
+        assert server.current_cell() is code_cell
+        assert server.items[server.items.index(code_cell) + 1].lines == ["partial"]
+
+
+def test_query_replies_are_cached_within_a_command(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    server.put_cursor_at_cell(server.cells(basic_types=("Standard",))[0])
+    lyx_process.begin_reply_cache()
+    try:
+        num_commands = server.num_commands
+        assert lyx_process.server_get_filename() == server.buffer_filename
+        assert lyx_process.server_get_layout() == "Plain Layout"
+        assert lyx_process.server_get_filename() == server.buffer_filename
+        assert lyx_process.server_get_layout() == "Plain Layout"
+        assert server.num_commands == num_commands + 2 # Repeats sent nothing.
+        lyx_process.server_get_xy() # Leaves the layout alone.
+        assert lyx_process.server_get_layout() == "Plain Layout"
+        assert server.num_commands == num_commands + 3
+    finally:
+        lyx_process.end_reply_cache()
+    lyx_process.server_get_layout()
+    assert server.num_commands == num_commands + 4 # Not cached between commands.
+
+
+def test_layout_change_in_sequence_drops_cached_layout(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    server.put_cursor_at_cell(server.cells(basic_types=("Standard",))[0])
+    lyx_process.begin_reply_cache()
+    try:
+        assert lyx_process.server_get_layout() == "Plain Layout"
+        lyx_process.server_get_filename()
+        lyx_process.process_lfun_seq("message leaving the cell", "escape")
+        num_commands = server.num_commands
+        assert lyx_process.server_get_layout() == "Standard"
+        lyx_process.server_get_filename() # Still cached.
+        assert server.num_commands == num_commands + 1
+    finally:
+        lyx_process.end_reply_cache()
+
+
+def test_buffer_switch_drops_cached_filename(server_and_lyx_process, tmp_path):
+    server, lyx_process = server_and_lyx_process
+    other_filename = str(tmp_path / "other.lyx")
+    lyx_process.begin_reply_cache()
+    try:
+        assert lyx_process.server_get_filename() == server.buffer_filename
+        server.buffer_filename = other_filename # What opening it does in Lyx.
+        lyx_process.process_lfun("file-open", other_filename)
+        num_commands = server.num_commands
+        assert lyx_process.server_get_filename() == other_filename
+        assert server.num_commands == num_commands + 1
+    finally:
+        lyx_process.end_reply_cache()
+
+
+def test_lfun_round_trips_are_timed_by_helper(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    server.put_cursor_at_cell(server.cells()[0])
+    lyx_process.current_key_action = "test action"
+    lyx_process.inside_math_inset()
+    lyx_process.inside_empty_cell()
+    lyx_process.finish_pending_lfuns()
+    keys = set(lyx_process.lfun_timing_stats.lfun_samples)
+    assert ("test action", "inside_math_inset", "math-space") in keys
+    assert ("test action", "get_xy_and_cell_end_xy", "server-set-xy") in keys
+    assert ("test action", "inside_empty_cell", "server-set-xy") in keys
+
+
+def test_replies_dispatched_by_another_thread(server_and_lyx_process):
+    # The asyncio loop reads the server while commands run in a worker thread.
+    server, lyx_process = server_and_lyx_process
+    lyx_process.server_events_read_elsewhere = True
+    result = []
+    worker = threading.Thread(target=lambda: result.append(
+                                          lyx_process.get_all_cell_text()))
+    worker.start()
+    server.press_key("S-F10")
+    notify_events = []
+    while worker.is_alive():
+        select.select([lyx_process.lyx_server_pipe_out], [], [], 0.05)
+        notify_events += lyx_process.dispatch_available_server_events()
+    worker.join()
+    assert len(result[0]) == 3
+    assert [event.data for event in notify_events] == ["S-F10"]
+    lyx_process.server_events_read_elsewhere = False
+
+
+def test_large_lfun_is_written_in_pieces(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    code_cell = server.cells(basic_types=("Standard",))[0]
+    server.put_cursor_at_cell(code_cell)
+    long_text = "x" * 300000 # Much bigger than the pipe buffer.
+    lyx_process.process_lfun("self-insert", long_text)
+    assert long_text in code_cell.lines[0]
+
+
+def swap_in_pipe(lyx_process, write_fd):
+    """Make `lyx_process` write its LFUNs to `write_fd`, returning the old fd."""
+    old_fd = lyx_process.lyx_server_pipe_in
+    os.set_blocking(write_fd, False)
+    lyx_process.lyx_server_pipe_in = write_fd
+    lyx_process.server_write_poll = select.poll()
+    lyx_process.server_write_poll.register(write_fd, select.POLLOUT)
+    return old_fd
+
+
+def test_write_to_server_errors(server_and_lyx_process, monkeypatch):
+    server, lyx_process = server_and_lyx_process
+    monkeypatch.setitem(config_dict, "lyx_server_write_timeout_secs", 0)
+    read_fd, write_fd = os.pipe()
+    old_fd = swap_in_pipe(lyx_process, write_fd)
+    try:
+        with pytest.raises(LyxServerWriteTimeout): # Nothing reads the pipe.
+            lyx_process.write_to_server(b"x" * 300000)
+        os.close(read_fd)
+        with pytest.raises(LyxServerClosedError):
+            lyx_process.write_to_server(b"x")
+    finally:
+        os.close(write_fd)
+        lyx_process.lyx_server_pipe_in = old_fd
+
+
+def test_keys_pressed_while_waiting_are_saved(server_and_lyx_process):
+    server, lyx_process = server_and_lyx_process
+    server.press_key("F4")
+    lyx_process.server_get_filename()
+    assert [event.data for event in lyx_process.ignored_notify_events] == ["F4"]
+
+
+def test_identical_cells_found_by_inset_edit(server_and_lyx_process, monkeypatch):
+    server, lyx_process = server_and_lyx_process
+    monkeypatch.setitem(config_dict, "has_editable_insets_noeditor_mod", True)
+    popups = []
+    monkeypatch.setattr(gui, "text_warning_popup", popups.append)
+    code_cells = server.cells(basic_types=("Standard",))
+    code_cells[1].lines = list(code_cells[0].lines)
+    server.put_cursor_at_cell(code_cells[1])
+    all_cells = lyx_process.get_all_cell_text()
+    cell = lyx_process.get_current_cell_text()
+    assert cell.starting_line_number == all_cells[2].starting_line_number
+    assert not popups
+    assert not any(">==>-" in line for c in server.cells() for line in c.lines)
+
+
+def make_mixed_document(server):
+    """Change the document of `server` to have Init, Standard and empty cells
+    (the last with and without an output cell), with stale outputs."""
+    with server.lock:
+        server.items = parse_lyx_string(make_lyx_document(6, num_init_cells=2))
+        code_cells = server.cells(basic_types=("Init", "Standard"))
+        code_cells[1].lines = [""]
+        code_cells[3].lines = [""]
+        code_cells[5].lines = [""]
+        server.items.remove(server.items[server.items.index(code_cells[5]) + 1])
+        for output_cell in server.cells(basic_types=("Output",)):
+            output_cell.lines = ["stale"]
+    return code_cells
+
+
+def cell_contents(server):
+    return [(cell.basic_type, cell.lines) for cell in server.cells()]
+
+
+def test_single_pass_evaluate_all_matches_stepwise(server_and_lyx_process, controller):
+    server, lyx_process = server_and_lyx_process
+    documents = []
+    for single_pass in [False, True]:
+        config_dict["single_pass_evaluate_all"] = single_pass
+        make_mixed_document(server)
+        controller.respond_to_key_action("evaluate all code cells")
+        lyx_process.finish_pending_lfuns()
+        documents.append(cell_contents(server))
+    assert documents[1] == documents[0]
+    assert [lines for basic_type, lines in documents[1]] == [
+            ["x0 = 0", "print(x0 * 2)"], ["0", ""], [""], ["stale"],
+            ["x2 = 2", "print(x2 * 2)"], ["4", ""], [""], ["stale"],
+            ["x4 = 4", "print(x4 * 2)"], ["8", ""], [""]]
+
+
+@pytest.mark.parametrize("single_pass", [True, False])
+def test_evaluate_all_with_closed_cells(server_and_lyx_process, controller, single_pass):
+    # The Init and Standard cells have to be opened to go from one to the next.
+    server, lyx_process = server_and_lyx_process
+    config_dict["single_pass_evaluate_all"] = single_pass
+    with server.lock:
+        server.items = parse_lyx_string(make_lyx_document(5, num_init_cells=2))
+        for cell in server.cells():
+            cell.is_open = False
+            if cell.basic_type == "Output":
+                cell.lines = ["stale"]
+    controller.respond_to_key_action("evaluate all code cells")
+    lyx_process.finish_pending_lfuns()
+    for i, code_cell in enumerate(server.cells(basic_types=("Init", "Standard"))):
+        output_cell = server.items[server.items.index(code_cell) + 1]
+        assert output_cell.lines == [str(2 * i), ""]
+
+
+def test_halted_single_pass_evaluate_all_writes_outputs(server_and_lyx_process,
+                                                        controller):
+    server, lyx_process = server_and_lyx_process
+    config_dict["single_pass_evaluate_all"] = True
+    code_cells = make_mixed_document(server)
+    halt_checks = iter([False, False, False, True]) # Halt before the fourth cell.
+    controller.check_for_ignored_server_notify = lambda: next(halt_checks)
+    controller.respond_to_key_action("evaluate all code cells")
+    lyx_process.finish_pending_lfuns()
+    outputs = [server.items[server.items.index(cell) + 1].lines for cell in code_cells[:5]]
+    assert outputs == [["0", ""], ["stale"], ["4", ""], ["stale"], ["stale"]]
+
+
+def test_code_cell_is_rewritten_only_when_changed(server_and_lyx_process, controller):
+    server, lyx_process = server_and_lyx_process
+    code_cell = server.cells(basic_types=("Standard",))[0]
+    server.put_cursor_at_cell(code_cell)
+    controller.respond_to_key_action("evaluate current cell")
+    lyx_process.finish_pending_lfuns()
+    assert server.lfun_counts["file-insert-plaintext"] == 0 # The output is unchanged too.
+    assert server.lfun_counts["inset-select-all"] == 0
+    assert code_cell.lines == ["x1 = 1", "print(x1 * 2)"]
+
+    # Processing which changes the code makes it be written back.
+    def add_comment(cell):
+        cell.text_code_lines = cell.text_code_lines + ["# Processed.\n"]
+        return cell
+    controller.wrap_long_lines = add_comment
+    server.put_cursor_at_cell(code_cell)
+    controller.respond_to_key_action("evaluate current cell")
+    lyx_process.finish_pending_lfuns()
+    assert server.lfun_counts["file-insert-plaintext"] == 1
+    assert code_cell.lines == ["x1 = 1", "print(x1 * 2)", "# Processed."]
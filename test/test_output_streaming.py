@@ -0,0 +1,59 @@
+"""
+
+Tests of deciding when to write the partial output of a cell with an
+`OutputStreamer`.
+
+"""
+
+from lyxnotebook.output_streaming import OutputStreamer
+
+
+class FakeClock:
+    """A clock which only moves when told to."""
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+def make_streamer(**kwargs):
+    writes = []
+    clock = FakeClock()
+    streamer = OutputStreamer(writes.append, clock=clock, **kwargs)
+    return streamer, writes, clock
+
+
+def test_writes_at_the_interval():
+    streamer, writes, clock = make_streamer(interval_secs=2)
+    assert not streamer.update(["a\n"])
+    clock.time = 2
+    assert streamer.update(["a\n"])
+    clock.time = 3
+    assert not streamer.update(["a\n", "b\n"])
+    clock.time = 4
+    assert not streamer.update(["a\n"]) # Unchanged.
+    assert streamer.update(["a\n", "b\n"])
+    assert writes == [["a\n"], ["a\n", "b\n"]]
+    assert streamer.num_writes == 2
+
+
+def test_writes_every_n_lines_with_minimum_interval():
+    streamer, writes, clock = make_streamer(interval_secs=0, every_lines=3,
+                                            min_interval_secs=0.5)
+    clock.time = 1
+    assert not streamer.update(["1\n", "2\n"])
+    assert streamer.update(["1\n", "2\n", "3\n"])
+    clock.time = 1.2
+    assert not streamer.update([str(i) + "\n" for i in range(10)]) # Too soon.
+    clock.time = 1.5
+    assert streamer.update([str(i) + "\n" for i in range(10)])
+    assert [len(lines) for lines in writes] == [3, 10]
+
+
+def test_whitespace_output_is_not_written():
+    streamer, writes, clock = make_streamer(interval_secs=1)
+    clock.time = 5
+    assert not streamer.update([])
+    assert not streamer.update(["\n", "  \n"])
+    assert writes == []
@@ -0,0 +1,33 @@
+"""
+
+Tests of the pool of reusable temporary files used to put text into cells.
+
+"""
+
+import os
+
+from lyxnotebook.temp_file_pool import TempFilePool
+
+
+def test_files_are_reused_and_removed(tmp_path):
+    pool = TempFilePool([str(tmp_path / "missing"), str(tmp_path)], prefix="pool_")
+    first = pool.acquire()
+    assert os.path.dirname(os.path.dirname(first)) == str(tmp_path)
+    assert (os.stat(os.path.dirname(first)).st_mode & 0o777) == 0o700
+    with open(first, "w") as f:
+        f.write("longer old text")
+    second = pool.acquire()
+    assert second != first
+    pool.release(first)
+
+    reused = pool.acquire()
+    assert reused == first
+    with open(reused, "w") as f:
+        f.write("new")
+    with open(reused) as f:
+        assert f.read() == "new"
+
+    pool.close()
+    assert not os.path.exists(os.path.dirname(first))
+    assert os.path.exists(os.path.dirname(pool.acquire()))
+    pool.close()